@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# msct_atlas
+# Compiled label folder (e.g. white matter atlas or template) for the extraction of metrics within labels.
+#
+# All labels listed in info_label.txt are stored as a sparse matrix (CSR) of partial volume weights [nb_labels x
+# nb_voxels], where voxels are the voxels (in RPI orientation) that are non-null in at least one label. The compiled
+# atlas is written once in the label folder (file info_label.npz, uncompressed) and reused as long as info_label.txt and
+# the label files are not modified. If the label folder is not writable, it is stored in $SCT_CACHE/atlas (see
+# msct_cache) when SCT_CACHE is set.
+#
+# USAGE
+# atlas = Atlas('label/atlas/')
+# atlas.weights[:, atlas.get_voxels_in_slices([2, 3, 4])], atlas.voxels, atlas.label_name, ...
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2015 Polytechnique Montreal <www.neuro.polymtl.ca>
+# Created: 2015-08-19
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import json
+import hashlib
+import numpy as np
+import sct_utils as sct
+
+
+class Atlas(object):
+    def __init__(self, path_label, file_info_label='info_label.txt', verbose=1):
+        """
+        Load the compiled atlas of a label folder (it is compiled first if needed).
+        :param path_label: folder including info_label.txt and the labels
+        """
+        self.path_label = sct.slash_at_the_end(os.path.abspath(path_label), 1)
+        self.file_info_label = file_info_label
+        self.verbose = verbose
+        self.label_id, self.label_name, self.label_file = [], [], []
+        self.shape = None  # dimensions of the labels in RPI orientation
+        self.orientation = ''  # orientation of the label files
+        self.voxels = None  # voxels (index in the flattened RPI volume) that are non-null in at least one label
+        self.weights = None  # scipy.sparse.csr_matrix [nb_labels x nb_voxels]
+
+        key = self.get_key()
+        for fname_compiled in self.get_fname_compiled(key):
+            if os.path.isfile(fname_compiled) and self.load(fname_compiled, key):
+                sct.printv('.. Load compiled atlas: '+fname_compiled, verbose)
+                return
+        self.compile()
+        for fname_compiled in self.get_fname_compiled(key):
+            try:
+                self.save(fname_compiled, key)
+                sct.printv('.. Compiled atlas saved: '+fname_compiled, verbose)
+                return
+            except (IOError, OSError):
+                pass
+
+    def get_key(self):
+        """Key of the label folder: name, modification time and size of info_label.txt and of all label files."""
+        self.label_id, self.label_name, self.label_file = read_label_file(self.path_label, self.file_info_label)
+        files = [self.file_info_label] + self.label_file
+        return json.dumps([[f, os.path.getmtime(self.path_label+f), os.path.getsize(self.path_label+f)] for f in files])
+
+    def get_fname_compiled(self, key):
+        """Candidate locations of the compiled atlas: label folder, then SCT_CACHE (if set)."""
+        list_fname = [self.path_label+sct.extract_fname(self.file_info_label)[1]+'.npz']
+        path_cache = os.environ.get('SCT_CACHE', '')
+        if path_cache:
+            list_fname.append(os.path.join(path_cache, 'atlas', hashlib.sha1(self.path_label+key).hexdigest()+'.npz'))
+        return list_fname
+
+    def compile(self):
+        """Load all labels (in RPI orientation) and build the sparse matrix of weights."""
+        from nibabel import load
+        from sct_orientation import get_orientation_from_header
+
+        sct.printv('.. Compile atlas: '+self.path_label, self.verbose)
+        list_data = []
+        for fname in self.label_file:
+            list_data.append(load_rpi(self.path_label+fname))
+        self.orientation = get_orientation_from_header(load(self.path_label+self.label_file[0]).get_header())
+        self.shape = list_data[0].shape
+        self.voxels, self.weights = labels_to_sparse(list_data)
+
+    def load(self, fname_compiled, key):
+        """Load a compiled atlas. Return False if it does not match the current label folder."""
+        from scipy.sparse import csr_matrix
+        try:
+            compiled = np.load(fname_compiled)
+            if str(compiled['key']) != key:
+                return False
+            self.shape = tuple(compiled['shape'])
+            self.orientation = str(compiled['orientation'])
+            self.voxels = compiled['voxels']
+            self.weights = csr_matrix((compiled['data'], compiled['indices'], compiled['indptr']), shape=(len(self.label_id), len(self.voxels)))
+        except (IOError, KeyError, ValueError):
+            return False
+        return True
+
+    def save(self, fname_compiled, key):
+        sct.write_atomic(fname_compiled, lambda fname_tmp: np.savez(
+            fname_tmp, key=key, shape=self.shape, orientation=self.orientation, voxels=self.voxels,
+            data=self.weights.data, indices=self.weights.indices, indptr=self.weights.indptr))
+
+    def get_voxels_in_slices(self, slices):
+        """Return the indices of the voxels (columns of weights) that are in the given slices (RPI orientation)."""
+        in_slices = np.zeros(self.shape[2], dtype=bool)
+        in_slices[slices] = True
+        return np.flatnonzero(in_slices[self.voxels % self.shape[2]])
+
+
+def labels_to_sparse(list_data):
+    """
+    Convert labels (list of 3D arrays of same dimensions) to a sparse matrix of weights.
+    :return: voxels, weights: voxels (index in the flattened volume) that are non-null in at least one label, and
+    scipy.sparse.csr_matrix [nb_labels x nb_voxels]
+    """
+    from scipy.sparse import csr_matrix
+
+    dtype = np.result_type(np.float32, *[data.dtype for data in list_data])
+    index = [np.flatnonzero(data) for data in list_data]
+    voxels = np.unique(np.concatenate(index))
+    indptr = np.cumsum([0] + [len(i) for i in index])
+    indices = np.searchsorted(voxels, np.concatenate(index))
+    values = np.concatenate([np.take(data, i).astype(dtype) for data, i in zip(list_data, index)])
+    return voxels, csr_matrix((values, indices, indptr), shape=(len(list_data), len(voxels)))
+
+
+#=======================================================================================================================
+# Load data in RPI orientation (reorientation is done in memory)
+#=======================================================================================================================
+def load_rpi(fname):
+    from msct_image import Image
+    im = Image(fname, verbose=0)
+    im.change_orientation('RPI')
+    return im.data
+
+
+#=======================================================================================================================
+# Read label.txt file which is located inside label folder
+#=======================================================================================================================
+def read_label_file(path_info_label, file_info_label):
+
+    # file name of info_label.txt
+    fname_label = path_info_label+file_info_label
+
+    # Check info_label.txt existence
+    sct.check_file_exist(fname_label)
+
+    # Read file
+    f = open(fname_label)
+
+    # Extract all lines in file.txt
+    lines = [lines for lines in f.readlines() if lines.strip()]
+
+    # separate header from (every line starting with "#")
+    lines = [lines[i] for i in range(0, len(lines)) if lines[i][0] != '#']
+
+    # read each line
+    label_id = []
+    label_name = []
+    label_file = []
+    for i in range(0, len(lines)-1):
+        line = lines[i].split(',')
+        label_id.append(int(line[0]))
+        label_name.append(line[1].strip())
+        label_file.append(line[2][:-1].strip())
+    # An error could occur at the last line (deletion of the last character of the .txt file), the 5 following code
+    # lines enable to avoid this error:
+    line = lines[-1].split(',')
+    label_id.append(int(line[0]))
+    label_name.append(line[1].strip())
+    line[2]=line[2]+' '
+    label_file.append(line[2].strip())
+
+    # check if all files listed are present in folder. If not, WARNING.
+    # print '\nCheck existence of all files listed in '+file_info_label+' ...'
+    for fname in label_file:
+        sct.check_file_exist(path_info_label+fname)
+        # if os.path.isfile(path_info_label+fname) or os.path.isfile(path_info_label+fname + '.nii') or \
+        #         os.path.isfile(path_info_label+fname + '.nii.gz'):
+        #     sct.printv('  OK: '+path_info_label+fname, param.verbose)
+        #     pass
+        # else:
+        #     sct.printv('  ERROR: ' + path_info_label+fname + ' does not exist\n', 1, 'error')
+
+    # Close file.txt
+    f.close()
+
+    return [label_id, label_name, label_file]
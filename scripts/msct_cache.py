@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# msct_cache
+# Content-addressed cache for the external commands launched with sct_utils.run().
+#
+# The cache is enabled by setting the environment variable SCT_CACHE to a folder (or by using the flag -cache <folder>
+# with scripts using msct_parser). For each command, a key is computed from the command line and the content of all the
+# files it refers to (names without extension are completed as FSL does, globs are expanded). Files created or modified
+# by the command (in the working folder and in the folders of the files it refers to) are stored in the cache. When the
+# same command is run again on the same inputs, the outputs are copied back instead of running the command.
+# Commands are not cached if they refer to files that cannot be resolved (folders, globs matching no file, file names
+# that exist neither before nor after the command). Outputs are not stored for commands run concurrently (see
+# sct_utils.run_many), since files created by other commands in the same folders could not be told apart.
+# The size of the cache is bounded by SCT_CACHE_SIZE (in MB, default: 10240): least recently used entries are removed.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2015 Polytechnique Montreal <www.neuro.polymtl.ca>
+# Created: 2015-08-10
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import re
+import json
+import shutil
+import glob
+import hashlib
+
+# commands that are not worth caching (or that should always be executed)
+commands_not_cached = ['rm', 'mv', 'cp', 'mkdir', 'cd', 'ls', 'echo', 'cat', 'grep', 'which', 'free', 'hostinfo', 'sct_check_dependences']
+
+
+class CacheEntry(object):
+    """State of a command between the lookup in the cache and the storage of its outputs."""
+    def __init__(self, cmd, key, files_before, unresolved=None):
+        self.cmd = cmd
+        self.key = key
+        self.files_before = files_before
+        self.unresolved = unresolved or []  # file names that did not exist before the command (outputs)
+        self.output = ''
+
+
+class RunCache(object):
+    def __init__(self, path_cache, size_max=None):
+        self.path_cache = os.path.abspath(path_cache)
+        if size_max is None:
+            size_max = float(os.environ.get('SCT_CACHE_SIZE', 10240))
+        self.size_max = size_max * 1024 * 1024  # in bytes
+        self.hash_files = dict()  # memoization of file hashes: path -> (mtime, size, hash)
+        if not os.path.isdir(self.path_cache):
+            os.makedirs(self.path_cache)
+
+    def is_cacheable(self, cmd):
+        for command in re.split(';|&&|\|', cmd):
+            words = command.split()
+            if words and words[0] in commands_not_cached:
+                return False
+        return True
+
+    def get_paths(self, cmd):
+        """Return all the words of the command that could be paths (ANTs syntax "[a,b]" is handled)."""
+        return [w for w in re.split('[\s,\[\]=;\'"]+', cmd) if w and not w.startswith('-')]
+
+    def get_inputs(self, cmd):
+        """
+        Resolve the files the command refers to.
+        :return: (files, unresolved): existing files, and words that look like file names but do not exist (outputs, or
+        inputs that cannot be resolved, see store). None if an input cannot be hashed (folder or glob matching no file).
+        """
+        from sct_utils import find_nifti_file
+
+        files, unresolved = set(), []
+        for path in self.get_paths(cmd):
+            if glob.has_magic(path):
+                list_fname = [f for f in glob.glob(path) if os.path.isfile(f)]
+                if not list_fname:
+                    return None
+                files.update(list_fname)
+            elif os.path.isdir(path):
+                return None
+            elif find_nifti_file(path):
+                fname = find_nifti_file(path)
+                files.add(fname)
+                # Analyze images: data is in a separate file
+                for ext_hdr, ext_img in [('.hdr', '.img'), ('.hdr.gz', '.img.gz')]:
+                    if fname.endswith(ext_hdr) and os.path.isfile(fname[:-len(ext_hdr)]+ext_img):
+                        files.add(fname[:-len(ext_hdr)]+ext_img)
+            elif is_file_name(path):
+                unresolved.append(path)
+        return sorted([os.path.normpath(f) for f in files]), unresolved
+
+    def hash_file(self, fname):
+        stat = os.stat(fname)
+        if fname in self.hash_files and self.hash_files[fname][:2] == (stat.st_mtime, stat.st_size):
+            return self.hash_files[fname][2]
+        sha = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), ''):
+                sha.update(block)
+        self.hash_files[fname] = (stat.st_mtime, stat.st_size, sha.hexdigest())
+        return sha.hexdigest()
+
+    def list_files(self, cmd):
+        """List files (with mtime and size) in the working folder and in the folders of the files used by the command."""
+        folders = set(['.'])
+        for path in self.get_paths(cmd):
+            folder = os.path.dirname(path)
+            if folder and os.path.isdir(folder):
+                folders.add(folder)
+        files = dict()
+        for folder in folders:
+            for fname in os.listdir(folder):
+                fname = os.path.normpath(os.path.join(folder, fname))
+                if os.path.isfile(fname):
+                    stat = os.stat(fname)
+                    files[fname] = (stat.st_mtime, stat.st_size)
+        return files
+
+    def lookup(self, cmd):
+        """
+        Compute the key of a command and try to restore its outputs.
+        :return: (restored, entry). If restored is False, the entry should be given to store() once the command is done.
+        The entry is None if the command cannot be cached.
+        """
+        inputs = self.get_inputs(cmd)
+        if inputs is None:
+            return False, None
+        files, unresolved = inputs
+        sha = hashlib.sha1(cmd)
+        for fname in files:
+            sha.update(fname + ':' + self.hash_file(fname))
+        entry = CacheEntry(cmd, sha.hexdigest(), None, unresolved)
+        if self.restore(entry):
+            return True, entry
+        entry.files_before = self.list_files(cmd)
+        return False, entry
+
+    def restore(self, entry):
+        path_entry = os.path.join(self.path_cache, entry.key)
+        fname_manifest = os.path.join(path_entry, 'cache.json')
+        if not os.path.isfile(fname_manifest):
+            return False
+        with open(fname_manifest) as f:
+            manifest = json.load(f)
+        for i, fname in enumerate(manifest['files']):
+            folder = os.path.dirname(fname)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            shutil.copyfile(os.path.join(path_entry, str(i)), fname)
+        entry.output = manifest['output'].encode('utf-8')
+        # mark entry as recently used
+        os.utime(fname_manifest, None)
+        return True
+
+    def store(self, entry, output):
+        """
+        Store the files created or modified by the command. Nothing is stored if the command deleted files, if it was
+        run concurrently with other commands, or if it referred to file names that still do not exist (inputs that
+        could not be resolved).
+        """
+        if os.environ.get('SCT_RUN_CONCURRENT', '') == '1':
+            return
+        from sct_utils import find_nifti_file
+        if [path for path in entry.unresolved if not find_nifti_file(path)]:
+            return
+        files_after = self.list_files(entry.cmd)
+        if [f for f in entry.files_before if f not in files_after]:
+            return
+        files_out = [f for f in files_after if entry.files_before.get(f) != files_after[f]]
+        if not files_out:
+            return
+        path_entry = os.path.join(self.path_cache, entry.key)
+        if os.path.isdir(path_entry):
+            return
+        # write in a temporary folder first, so that concurrent runs never see an incomplete entry
+        path_tmp = path_entry + '.tmp' + str(os.getpid())
+        os.makedirs(path_tmp)
+        manifest = {'cmd': entry.cmd, 'output': output, 'files': [], 'size': 0}
+        for i, fname in enumerate(files_out):
+            shutil.copyfile(fname, os.path.join(path_tmp, str(i)))
+            manifest['files'].append(fname if os.path.isabs(fname) else os.path.relpath(fname))
+            manifest['size'] += files_after[fname][1]
+        with open(os.path.join(path_tmp, 'cache.json'), 'w') as f:
+            json.dump(manifest, f)
+        try:
+            os.rename(path_tmp, path_entry)
+        except OSError:
+            # entry was created by another process in the meantime
+            shutil.rmtree(path_tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is smaller than size_max."""
+        entries = []
+        for key in os.listdir(self.path_cache):
+            fname_manifest = os.path.join(self.path_cache, key, 'cache.json')
+            if os.path.isfile(fname_manifest):
+                with open(fname_manifest) as f:
+                    size = json.load(f)['size']
+                entries.append((os.path.getmtime(fname_manifest), size, key))
+        size_total = sum([e[1] for e in entries])
+        for last_used, size, key in sorted(entries):
+            if size_total <= self.size_max:
+                break
+            shutil.rmtree(os.path.join(self.path_cache, key), ignore_errors=True)
+            size_total -= size
+
+
+def is_file_name(word):
+    """Return True if a word of a command looks like a file name (path or extension)."""
+    return '/' in word or re.search(r'\.[A-Za-z][A-Za-z0-9]*$', word) is not None
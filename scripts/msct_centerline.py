@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# msct_centerline
+# Centerline of a spinal cord segmentation or centerline image: center of mass of each slice, smoothed coordinates and
+# derivatives.
+#
+# Fitted centerlines are memoized by content of the image and fitting parameters, so that scripts (or steps of the
+# same script) working on the same segmentation do not fit it again. If the environment variable SCT_CACHE is set (see
+# msct_cache), fitted centerlines are also stored in $SCT_CACHE/centerline and shared between scripts.
+#
+# USAGE
+# centerline = Centerline('segmentation_rpi.nii.gz').fit(algo_fitting='hanning', window_length=80)
+# centerline.x_fit, centerline.y_fit, centerline.z_fit, centerline.x_deriv, ...
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2015 Polytechnique Montreal <www.neuro.polymtl.ca>
+# Created: 2015-08-17
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import hashlib
+import numpy as np
+import sct_utils as sct
+
+
+class Centerline(object):
+    # fitted centerlines: (hash of the image, algo_fitting, type_window, window_length) -> (x_fit, y_fit, z_fit, x_deriv, y_deriv, z_deriv)
+    fits = dict()
+
+    def __init__(self, fname, verbose=0, data=None):
+        """
+        Get the center of mass of all non-empty slices of an image (in RPI orientation).
+        :param fname: centerline or segmentation
+        :param data: data of the image, if already loaded (e.g. binarized, for the unweighted mean of the voxels of each
+        slice). Only the header of fname is then read.
+        """
+        from nibabel import load
+
+        self.fname = fname
+        self.verbose = verbose
+        image = load(fname)
+        self.px, self.py, self.pz = [float(p) for p in image.get_header().get_zooms()[0:3]]
+        data = np.asarray(image.get_data() if data is None else data)
+
+        sha = hashlib.sha1(np.ascontiguousarray(data).data)
+        sha.update(str((data.shape, data.dtype.str, self.px, self.py, self.pz)))
+        self.hash = sha.hexdigest()
+
+        # N.B. len(z) can be smaller than nz in case the centerline is smaller than the input volume
+        sct.printv('.. Get center of mass of the centerline/segmentation...', verbose)
+        self.z = np.nonzero(data.any(axis=(0, 1)))[0]
+        # center of mass of each slice, from sums along y (for x) and along x (for y)
+        sum_xz, sum_yz = data.sum(axis=1, dtype=np.float64), data.sum(axis=0, dtype=np.float64)
+        sum_z = sum_xz.sum(axis=0)[self.z]
+        self.x = np.arange(data.shape[0]).dot(sum_xz)[self.z] / sum_z
+        self.y = np.arange(data.shape[1]).dot(sum_yz)[self.z] / sum_z
+
+        self.x_fit, self.y_fit, self.z_fit = None, None, None
+        self.x_deriv, self.y_deriv, self.z_deriv = None, None, None
+
+    def fit(self, algo_fitting='hanning', type_window='hanning', window_length=80):
+        """
+        Smooth the centerline and compute its derivative.
+        :param algo_fitting: 'hanning' or 'nurbs'
+        :param type_window: window of smoothing (see msct_smooth.smoothing_window)
+        :param window_length: length of the window, in mm
+        :return: self
+        """
+        key = (self.hash, algo_fitting, type_window, window_length)
+        if key not in Centerline.fits:
+            fname_cache = self.get_fname_cache(key)
+            if fname_cache and os.path.isfile(fname_cache):
+                sct.printv('.. Load fitted centerline from cache', self.verbose)
+                fit = np.load(fname_cache)
+                Centerline.fits[key] = tuple([fit[name] for name in ['x_fit', 'y_fit', 'z_fit', 'x_deriv', 'y_deriv', 'z_deriv']])
+            else:
+                Centerline.fits[key] = self.compute_fit(algo_fitting, type_window, window_length)
+                if fname_cache:
+                    self.save_fit(fname_cache, Centerline.fits[key])
+        self.x_fit, self.y_fit, self.z_fit, self.x_deriv, self.y_deriv, self.z_deriv = Centerline.fits[key]
+        return self
+
+    def compute_fit(self, algo_fitting, type_window, window_length):
+        from msct_smooth import smoothing_window, evaluate_derivative_3D, b_spline_nurbs
+
+        sct.printv('.. Smoothing algo = '+algo_fitting, self.verbose)
+        if algo_fitting == 'hanning':
+            # 2D smoothing
+            sct.printv('.. Windows length = '+str(window_length), self.verbose)
+            x_fit = smoothing_window(self.x, window_len=window_length/self.pz, window=type_window, verbose=self.verbose)
+            y_fit = smoothing_window(self.y, window_len=window_length/self.pz, window=type_window, verbose=self.verbose)
+            z_fit = self.z
+            x_deriv, y_deriv, z_deriv = evaluate_derivative_3D(x_fit, y_fit, z_fit, self.px, self.py, self.pz)
+        elif algo_fitting == 'nurbs':
+            x_fit, y_fit, z_fit, x_deriv, y_deriv, z_deriv = b_spline_nurbs(self.x, self.y, self.z, nbControl=None, verbose=self.verbose)
+        else:
+            sct.printv('ERROR: wrong algorithm for fitting', 1, 'error')
+
+        return tuple([np.asarray(v) for v in [x_fit, y_fit, z_fit, x_deriv, y_deriv, z_deriv]])
+
+    def get_fname_cache(self, key):
+        """Return the file storing a fitted centerline in SCT_CACHE (None if the cache is disabled)."""
+        path_cache = os.environ.get('SCT_CACHE', '')
+        if not path_cache:
+            return None
+        return os.path.join(path_cache, 'centerline', hashlib.sha1(str(key)).hexdigest()+'.npz')
+
+    def save_fit(self, fname_cache, fit):
+        sct.write_atomic(fname_cache, lambda fname_tmp: np.savez(
+            fname_tmp, **dict(zip(['x_fit', 'y_fit', 'z_fit', 'x_deriv', 'y_deriv', 'z_deriv'], fit))))
+
+
+def get_tangents(points):
+    """
+    Unit tangents of a curve given by its points [nb_points x 3], from central differences (one-sided at the ends). A
+    single point gets the z axis.
+    """
+    points = np.asarray(points, dtype=float)
+    if len(points) < 2:
+        return np.tile([0.0, 0.0, 1.0], (len(points), 1))
+    tangents = np.empty_like(points)
+    tangents[1:-1] = (points[2:] - points[:-2]) / 2
+    tangents[0], tangents[-1] = points[1] - points[0], points[-1] - points[-2]
+    return tangents / np.sqrt((tangents ** 2).sum(axis=1))[:, np.newaxis]
@@ -16,11 +16,12 @@ class Image(object):
     """
 
     """
-    def __init__(self, param=None, hdr=None, orientation=None, absolutepath="", verbose=1, split=False):
+    def __init__(self, param=None, hdr=None, orientation=None, absolutepath="", verbose=1, split=False, lazy=False):
         from numpy import zeros, ndarray, generic
         from sct_utils import extract_fname
 
         # initialization of all parameters
+        self._proxy = None  # nibabel array proxy, used in lazy mode until data are accessed
         self.data = None
         self.hdr = None
         self.orientation = None
@@ -34,7 +35,7 @@ class Image(object):
 
         # load an image from file
         if type(param) is str:
-            self.loadFromPath(param, verbose)
+            self.loadFromPath(param, verbose, lazy)
         # copy constructor
         elif isinstance(param, type(self)):
             self.copy(param)
@@ -62,15 +63,48 @@ class Image(object):
             self.data = self.split_data()
         """
 
+    @property
+    def data(self):
+        # in lazy mode, data are mapped from the file the first time they are accessed
+        if self._data is None and self._proxy is not None:
+            self._data = self._map_data()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._proxy = None
+
+    def is_lazy(self):
+        """True if the data have not been read from the file yet."""
+        return self._data is None and self._proxy is not None
+
+    def _map_data(self):
+        """
+        Get the data of a lazy image from the proxy of the file it was loaded from (even if the image was renamed).
+        Uncompressed nifti files are memory-mapped in copy-on-write mode: only the parts of the file that are read are
+        loaded in memory, and modifications of the array are never written to the file. Compressed files are read
+        entirely.
+        """
+        from numpy import asarray
+        return asarray(self._proxy)
+
     def __deepcopy__(self, memo):
         from copy import deepcopy
+        if self.is_lazy():
+            # both images share the file proxy: data will be mapped independently (copy-on-write) by each of them
+            return type(self)(self)
         return type(self)(deepcopy(self.data,memo),deepcopy(self.hdr,memo),deepcopy(self.orientation,memo),deepcopy(self.absolutepath,memo))
 
     def copy(self, image=None):
         from copy import deepcopy
         from sct_utils import extract_fname
         if image is not None:
-            self.data = deepcopy(image.data)
+            if image.is_lazy():
+                self.data = None
+                self._proxy = image._proxy
+            else:
+                self.data = deepcopy(image.data)
             self.dim = deepcopy(image.dim)
             self.hdr = deepcopy(image.hdr)
             self.orientation = deepcopy(image.orientation)
@@ -79,28 +113,72 @@ class Image(object):
         else:
             return deepcopy(self)
 
-    def loadFromPath(self, path, verbose):
+    def loadFromPath(self, path, verbose, lazy=False):
         """
         This function load an image from an absolute path using nibabel library
         :param path: path of the file from which the image will be loaded
+        :param lazy: if True, voxel data are not read until they are accessed (see get_slice, get_volume, iter_slices
+               and iter_volumes to read only part of the data)
         :return:
         """
         from nibabel import load, spatialimages
-        from sct_utils import check_file_exist, printv, extract_fname, get_dimension
-        from sct_orientation import get_orientation
+        from sct_utils import check_file_exist, printv, extract_fname
+        from sct_orientation import get_orientation_from_header
+
+        from os.path import abspath
 
         check_file_exist(path, verbose=verbose)
         try:
-            im_file = load(path)
+            # absolute path: the proxy of a lazy image still finds the file if the current folder changes
+            im_file = load(abspath(path), mmap='c')
         except spatialimages.ImageFileError:
             printv('Error: make sure ' + path + ' is an image.', 1, 'error')
-        self.orientation = get_orientation(path)
-        self.data = im_file.get_data()
+        if lazy:
+            self.data = None
+            self._proxy = im_file.dataobj
+        else:
+            self.data = im_file.get_data()
         self.hdr = im_file.get_header()
+        self.orientation = get_orientation_from_header(self.hdr)
         self.absolutepath = path
         self.path, self.file_name, self.ext = extract_fname(path)
-        nx, ny, nz, nt, px, py, pz, pt = get_dimension(path)
-        self.dim = [nx, ny, nz]
+        shape = list(self.hdr.get_data_shape()) + [1, 1]
+        self.dim = shape[:3]
+
+    def get_slice(self, iz):
+        """Return axial slice iz (the array is 2D for 3D images, and 3D (x, y, t) for 4D images)."""
+        from numpy import asarray
+        if self.is_lazy():
+            return asarray(self._proxy[:, :, iz, ...])
+        return self.data[:, :, iz, ...]
+
+    def get_volume(self, it):
+        """Return volume it of a 4D image (a 3D image has one volume)."""
+        from numpy import asarray
+        shape = self.hdr.get_data_shape() if self.is_lazy() else self.data.shape
+        if len(shape) <= 3:
+            if it != 0:
+                raise IndexError('volume '+str(it)+' is out of bounds for a 3D image')
+            return asarray(self._proxy) if self.is_lazy() else self.data
+        if self.is_lazy():
+            return asarray(self._proxy[:, :, :, it])
+        return self.data[:, :, :, it]
+
+    def get_nb_volumes(self):
+        shape = self.hdr.get_data_shape() if self.is_lazy() else self.data.shape
+        if len(shape) > 3:
+            return shape[3]
+        return 1
+
+    def iter_slices(self):
+        """Iterate over axial slices, reading one slice at a time from the file in lazy mode."""
+        for iz in range(self.dim[2]):
+            yield self.get_slice(iz)
+
+    def iter_volumes(self):
+        """Iterate over the volumes of a 4D image, reading one volume at a time from the file in lazy mode."""
+        for it in range(self.get_nb_volumes()):
+            yield self.get_volume(it)
 
     def setFileName(self, filename):
         from sct_utils import extract_fname
@@ -316,17 +394,17 @@ class Image(object):
 
     def change_orientation(self, orientation='RPI', inversion_orient=False):
         """
-        This function changes the orientation of the data by swapping the image axis.
-        Warning: the nifti image header is not changed!!!
+        This function changes the orientation of the data by flipping and permuting the image axes (see
+        sct_orientation.reorient_data). The data become a view on the original array (no copy) and the header is
+        updated accordingly. Works on 3D and 4D data.
         :param orientation: string of three character representing the new orientation (ex: AIL, default: RPI)
-               inversion_orient: boolean. If True, the data change to match the orientation in the header, based on the orientation provided as the argument orientation.
+               inversion_orient: boolean. If True, the data change to match the orientation in the header, based on the orientation provided as the argument orientation. In that case, the header is not changed.
         :return:
         """
-        opposite_character = {'L': 'R', 'R': 'L', 'A': 'P', 'P': 'A', 'I': 'S', 'S': 'I'}
+        from sct_orientation import get_orientation_from_header, reorient_data, reorient_header
 
         if self.orientation is None:
-            from sct_orientation import get_orientation
-            self.orientation = get_orientation(self.file_name)
+            self.orientation = get_orientation_from_header(self.hdr)
 
         if inversion_orient:
             temp_orientation = self.orientation
@@ -334,40 +412,10 @@ class Image(object):
             orientation = temp_orientation
 
         # change the orientation of the image
-        perm = [0, 1, 2]
-        inversion = [1, 1, 1]
-        for i, character in enumerate(self.orientation):
-            try:
-                perm[i] = orientation.index(character)
-            except ValueError:
-                perm[i] = orientation.index(opposite_character[character])
-                inversion[i] = -1
-
-        # axes inversion
-        self.data = self.data[::inversion[0], ::inversion[1], ::inversion[2]]
-
-        # axes manipulations
-        from numpy import swapaxes
-
-        if perm == [1, 0, 2]:
-            self.data = swapaxes(self.data, 0, 1)
-        elif perm == [2, 1, 0]:
-            self.data = swapaxes(self.data, 0, 2)
-        elif perm == [0, 2, 1]:
-            self.data = swapaxes(self.data, 1, 2)
-        elif perm == [2, 1, 0]:
-            self.data = swapaxes(self.data, 0, 2)
-        elif perm == [2, 0, 1]:
-            self.data = swapaxes(self.data, 0, 2)  # transform [2, 0, 1] to [1, 0, 2]
-            self.data = swapaxes(self.data, 0, 1)  # transform [1, 0, 2] to [0, 1, 2]
-        elif perm == [1, 2, 0]:
-            self.data = swapaxes(self.data, 0, 2)  # transform [1, 2, 0] to [0, 2, 1]
-            self.data = swapaxes(self.data, 1, 2)  # transform [0, 2, 1] to [0, 1, 2]
-        elif perm == [0, 1, 2]:
-            # do nothing
-            pass
-        else:
-            print 'Error: wrong orientation'
+        if self.hdr is not None and not inversion_orient:
+            self.hdr = reorient_header(self.hdr, self.data.shape, self.orientation, orientation)
+        self.data = reorient_data(self.data, self.orientation, orientation)
+        self.dim = list(self.data.shape[:3])
 
         self.orientation = orientation
 
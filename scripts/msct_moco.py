@@ -76,33 +76,43 @@ def moco(param):
 
     # Motion correction: initialization
     index = np.arange(nt)
-    file_data_splitT_num = []
-    file_data_splitT_moco_num = []
+    file_data_splitT_num = [file_data_splitT + str(it).zfill(4) for it in index]
+    file_data_splitT_moco_num = [file_data + suffix + '_T' + str(it).zfill(4) for it in index]
     failed_transfo = [0 for i in range(nt)]
-    file_mat = [[] for i in range(nt)]
+    file_mat = [folder_mat + 'mat.T' + str(it) for it in index]
 
-    # Motion correction: Loop across T
-    for indice_index in range(nt):
-
-        # create indices and display stuff
+    # Motion correction of the first volumes: they are registered one after another, because each registered volume is
+    # averaged with the target image (iterative averaging)
+    nb_serial = min(nt, 10) if param.iterative_averaging else 0
+    for indice_index in range(nb_serial):
         it = index[indice_index]
-        file_data_splitT_num.append(file_data_splitT + str(it).zfill(4))
-        file_data_splitT_moco_num.append(file_data + suffix + '_T' + str(it).zfill(4))
         sct.printv(('\nVolume '+str((it))+'/'+str(nt-1)+':'), verbose)
-        file_mat[it] = folder_mat + 'mat.T' + str(it)
 
         # run 3D registration
         failed_transfo[it] = register(param, file_data_splitT_num[it], file_target, file_mat[it], file_data_splitT_moco_num[it])
 
         # average registered volume with target image
         # N.B. use weighted averaging: (target * nb_it + moco) / (nb_it + 1)
-        if param.iterative_averaging and indice_index<10 and failed_transfo[it] == 0:
+        if failed_transfo[it] == 0:
             sct.run('isct_c3d '+file_target+ext+' -scale '+str(indice_index+1)+' '+file_data_splitT_moco_num[it]+ext+' -add -scale '+str(float(1)/(indice_index+2))+' -o '+file_target+ext)
 
-    # Replace failed transformation with the closest good one
+    # Motion correction of the other volumes: they are independent, so they are registered concurrently
+    if nb_serial < nt:
+        sct.printv('\nVolumes '+str(index[nb_serial])+' to '+str(nt-1)+' (concurrently)...', verbose)
+        list_it = [index[indice_index] for indice_index in range(nb_serial, nt)]
+        list_cmd = [register_cmd(param, file_data_splitT_num[it], file_target, file_mat[it], file_data_splitT_moco_num[it]) for it in list_it]
+        # memory of one registration (in GB): process overhead, and about 10 volumes (images, gradients, displacement
+        # field) in double
+        ram_per_job = 0.1 + 10 * nx * ny * nz * 8 / 1024.**3
+        sct.run_many(list_cmd, verbose, nb_workers=param.nb_workers, ram_per_job=ram_per_job, error_exit=False)
+        for it in list_it:
+            failed_transfo[it] = check_registration(param, file_data_splitT_moco_num[it])
+
+    # Replace failed transformation with the closest good one (once all volumes are registered)
     sct.printv(('\nReplace failed transformations...'), verbose)
     fT = [i for i, j in enumerate(failed_transfo) if j == 1]
     gT = [i for i, j in enumerate(failed_transfo) if j == 0]
+    list_cmd = []
     for it in range(len(fT)):
         abs_dist = [abs(gT[i]-fT[it]) for i in range(len(gT))]
         if not abs_dist == []:
@@ -111,11 +121,15 @@ def moco(param):
             # copy transformation
             sct.run('cp '+file_mat[gT[index_good]]+'Warp.nii.gz'+' '+file_mat[fT[it]]+'Warp.nii.gz')
             # apply transformation
-            sct.run('sct_apply_transfo -i '+file_data_splitT_num[fT[it]]+'.nii -d '+file_target+'.nii -w '+file_mat[fT[it]]+'Warp.nii.gz'+' -o '+file_data_splitT_moco_num[fT[it]]+'.nii'+' -p '+param.interp, verbose)
+            list_cmd.append('sct_apply_transfo -i '+file_data_splitT_num[fT[it]]+'.nii -d '+file_target+'.nii -w '+file_mat[fT[it]]+'Warp.nii.gz'+' -o '+file_data_splitT_moco_num[fT[it]]+'.nii'+' -x '+param.interp)
         else:
             # exit program if no transformation exists.
             sct.printv('\nERROR in '+os.path.basename(__file__)+': No good transformation exist. Exit program.\n', verbose, 'error')
             sys.exit(2)
+    if list_cmd:
+        from sct_apply_transfo import get_ram_per_job
+        ram_per_job = get_ram_per_job(file_target+'.nii', [file_mat[fT[0]]+'Warp.nii.gz'])
+        sct.run_many(list_cmd, verbose, nb_workers=param.nb_workers, ram_per_job=ram_per_job)
 
     # Merge data along T
     file_data_moco = file_data+suffix
@@ -127,13 +141,103 @@ def moco(param):
         sct.run(cmd, verbose)
 
 
+#=======================================================================================================================
+# average_groups:  mean of groups of volumes, computed in one pass over 4D data
+#=======================================================================================================================
+def average_groups(fname_data, groups, verbose=1):
+    """
+    Read 4D data once (volume by volume, memory-mapped) and compute the mean of each group of volumes.
+    :param groups: list of lists of volume indexes (a volume can be in several groups, e.g. [[0], [3], [0, 3]])
+    :return: data_mean, header: array [nx x ny x nz x nb_groups] (float32) and header of the 4D data
+    """
+    from nibabel import load
+
+    image = load(fname_data)
+    nx, ny, nz, nt = image.shape[0:4]
+    # groups that include each volume, so that each volume is read once
+    groups_volume = [[] for it in range(nt)]
+    for i_group, group in enumerate(groups):
+        for it in group:
+            groups_volume[it].append(i_group)
+    sct.printv('.. Average '+str(len(groups))+' group(s) of volumes in '+fname_data, verbose)
+    data_sum = np.zeros((nx, ny, nz, len(groups)))
+    for it in range(nt):
+        if groups_volume[it]:
+            volume = np.asarray(image.dataobj[..., it]).astype(float)
+            for i_group in groups_volume[it]:
+                data_sum[..., i_group] += volume
+    data_sum /= np.array([len(group) for group in groups], dtype=float)
+    return data_sum.astype(np.float32), image.get_header()
+
+
+#=======================================================================================================================
+# save_volumes:  write 3D or 4D data (float32) with the geometry of a header (or of affine, if given)
+#=======================================================================================================================
+def save_volumes(data, header, fname, affine=None):
+    from nibabel import save, Nifti1Image
+
+    header = header.copy()
+    header.set_data_dtype(np.float32)
+    image = Nifti1Image(data, affine, header)
+    image.get_header().set_zooms(header.get_zooms()[0:3]+header.get_zooms()[3:data.ndim])
+    save(image, fname)
+
+
+#=======================================================================================================================
+# StreamWriter:  4D NIfTI file written volume by volume
+#=======================================================================================================================
+class StreamWriter(object):
+    def __init__(self, fname, header, pt=1.):
+        """
+        Uncompressed 4D NIfTI file to which volumes are appended (float32). The header is updated after each volume, so
+        that the file is always a valid image of the volumes written so far.
+        :param header: header of a 3D volume (geometry of the output)
+        :param pt: time between volumes (pixdim[4])
+        """
+        self.fname = fname
+        self.header = header.copy()
+        del self.header.extensions[:]
+        self.header['vox_offset'] = 0
+        self.header.set_data_dtype(np.float32)
+        self.header.set_slope_inter(1, 0)
+        self.header.set_data_shape(header.get_data_shape()[0:3]+(1,))
+        self.header.set_zooms(header.get_zooms()[0:3]+(pt,))
+        self.nt = 0
+        self.file = open(fname, 'wb')
+
+    def append(self, data):
+        """Append a 3D volume."""
+        if self.nt == 0:
+            self.write_header()
+        self.file.seek(0, 2)
+        self.file.write(np.asarray(data).astype(self.header.get_data_dtype()).tostring('F'))
+        self.nt += 1
+        self.write_header()
+
+    def write_header(self):
+        self.header.set_data_shape(self.header.get_data_shape()[0:3]+(self.nt,))
+        self.file.seek(0)
+        self.header.write_to(self.file)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
 #=======================================================================================================================
 # register:  registration of two volumes (or two images)
 #=======================================================================================================================
 def register(param, file_src, file_dest, file_mat, file_out):
 
-    # initialization
-    failed_transfo = 0  # by default, failed matrix is 0 (i.e., no failure)
+    # run registration, then return status of failure
+    sct.run(register_cmd(param, file_src, file_dest, file_mat, file_out), param.verbose)
+    return check_registration(param, file_out)
+
+
+#=======================================================================================================================
+# register_cmd:  command for the registration of two volumes (or two images)
+#=======================================================================================================================
+def register_cmd(param, file_src, file_dest, file_mat, file_out):
 
     # get metric radius (if MeanSquares, CC) or nb bins (if MI)
     if param.param[3] == 'MI':
@@ -156,16 +260,19 @@ def register(param, file_src, file_dest, file_mat, file_out):
             cmd += ' -x '+param.fname_mask
     if param.todo == 'apply':
         cmd = 'sct_apply_transfo -i '+file_src+'.nii -d '+file_dest+'.nii -w '+file_mat+'Warp.nii.gz'+' -o '+file_out+'.nii'+' -x '+param.interp
-    status, output = sct.run(cmd, param.verbose)
+    return cmd
+
+
+#=======================================================================================================================
+# check_registration:  return 1 if the registration failed (no output file), 0 otherwise
+#=======================================================================================================================
+def check_registration(param, file_out):
 
     # check if output file exists
     if not os.path.isfile(file_out+'.nii'):
-        # sct.printv(output, verbose, 'error')
-        sct.printv('WARNING in '+os.path.basename(__file__)+': Improper calculation of mutual information. Either the mask you provided is too small, or the subject moved a lot. If you see too many messages like this try with a bigger mask. Using previous transformation for this volume.', param.verbose, 'warning')
-        failed_transfo = 1
-
-    # return status of failure
-    return failed_transfo
+        sct.printv('WARNING in '+os.path.basename(__file__)+': Improper calculation of mutual information. Either the mask you provided is too small, or the subject moved a lot. If you see too many messages like this try with a bigger mask. Using previous transformation for this volume ('+file_out+').', param.verbose, 'warning')
+        return 1
+    return 0
 
 
 # #=======================================================================================================================
@@ -187,115 +294,163 @@ def register(param, file_src, file_dest, file_mat, file_out):
 #     return failed_transfo
 
 
+#=======================================================================================================================
+# load_mat:  moco matrices of a folder, as one array
+#=======================================================================================================================
+def load_mat(folder_mat, nt=None, nz=None, verbose=1):
+    """
+    Load the matrices of a mat folder: from the store mat.npz if it exists (see save_mat), otherwise from the text files
+    mat.T<t>_Z<z>.txt (each file is read once).
+    :param nt, nz: number of volumes and slices. Default: largest indexes found in the folder
+    :return: matrices, failed: arrays [nt x nz x 4 x 4] and [nt x nz] (bool, True if there is no matrix: identity is used)
+    """
+    import re
+
+    folder_mat = sct.slash_at_the_end(folder_mat, 1)
+    if os.path.isfile(folder_mat+'mat.npz'):
+        store = np.load(folder_mat+'mat.npz')
+        matrices, failed = store['matrices'], store['failed']
+        if (nt is None or nt == matrices.shape[0]) and (nz is None or nz == matrices.shape[1]):
+            return matrices, failed
+    files = dict()
+    for fname in os.listdir(folder_mat):
+        match = re.match(r'mat\.T(\d+)_Z(\d+)\.txt$', fname)
+        if match:
+            files[(int(match.group(1)), int(match.group(2)))] = folder_mat+fname
+    if nt is None:
+        nt = max([it for it, iz in files]) + 1 if files else 0
+    if nz is None:
+        nz = max([iz for it, iz in files]) + 1 if files else 0
+    sct.printv('.. Load '+str(len(files))+' matrices from '+folder_mat, verbose)
+    matrices = np.tile(np.identity(4), (nt, nz, 1, 1))
+    failed = np.ones((nt, nz), dtype=bool)
+    for (it, iz), fname in files.items():
+        if it < nt and iz < nz:
+            matrices[it, iz] = np.loadtxt(fname)[0:4, 0:4]
+            failed[it, iz] = False
+    return matrices, failed
+
+
+#=======================================================================================================================
+# save_mat:  write moco matrices of a folder in one file
+#=======================================================================================================================
+def save_mat(folder_mat, matrices, failed):
+    """Write matrices [nt x nz x 4 x 4] and failed [nt x nz] in the store mat.npz of the folder (see load_mat)."""
+    folder_mat = sct.slash_at_the_end(folder_mat, 1)
+    sct.write_atomic(folder_mat+'mat.npz', lambda fname_tmp: np.savez(fname_tmp, matrices=matrices, failed=failed))
+
+
+#=======================================================================================================================
+# export_mat:  write moco matrices of a folder as text files
+#=======================================================================================================================
+def export_mat(folder_mat, verbose=1):
+    """Write the matrices of the store mat.npz as text files mat.T<t>_Z<z>.txt (except failed ones)."""
+    folder_mat = sct.slash_at_the_end(folder_mat, 1)
+    matrices, failed = load_mat(folder_mat, verbose=verbose)
+    sct.printv('.. Export '+str(np.count_nonzero(~failed))+' matrices in '+folder_mat, verbose)
+    for it, iz in zip(*np.nonzero(~failed)):
+        np.savetxt(folder_mat+'mat.T'+str(it)+'_Z'+str(iz)+'.txt', matrices[it, iz], fmt="%s", delimiter='  ', newline='\n')
+
+
 #=======================================================================================================================
 # spline
 #=======================================================================================================================
 def spline(folder_mat,nt,nz,verbose,index_b0 = [],graph=0):
-    # get path of the toolbox
-    status, path_sct = commands.getstatusoutput('echo $SCT_DIR')
-    # append path that contains scripts, to be able to load modules
-    sys.path.append(path_sct + '/scripts')
-    import sct_utils as sct
-
+    """
+    Regularize translations along T (all slices and both axes at once). Matrices are read from the folder (see
+    load_mat) and the regularized ones are written in the store mat.npz (text files are not modified, use export_mat).
+    """
     sct.printv('\n\n\n------------------------------------------------------------------------------',verbose)
     sct.printv('Spline Regularization along T: Smoothing Patient Motion...',verbose)
 
-    file_mat = [[[] for i in range(nz)] for i in range(nt)]
-    for it in range(nt):
-        for iz in range(nz):
-            file_mat[it][iz] = folder_mat + 'mat.T' + str(it) + '_Z' + str(iz) + '.txt'
-
-    #Copying the existing Matrices to another folder
-    old_mat = folder_mat + 'old/'
-    if not os.path.exists(old_mat): os.makedirs(old_mat)
-    cmd = 'cp ' + folder_mat + '*.txt ' + old_mat
-    status, output = sct.run(cmd, verbose)
-
     sct.printv('\nloading matrices...',verbose)
-    X = [[[] for i in range(nt)] for i in range(nz)]
-    Y = [[[] for i in range(nt)] for i in range(nz)]
-    X_smooth = [[[] for i in range(nt)] for i in range(nz)]
-    Y_smooth = [[[] for i in range(nt)] for i in range(nz)]
-    for iz in range(nz):
-        for it in range(nt):
-            file =  open(file_mat[it][iz])
-            Matrix = np.loadtxt(file)
-            file.close()
-
-            X[iz][it] = Matrix[0,3]
-            Y[iz][it] = Matrix[1,3]
-
-    # Generate motion splines
+    matrices, failed = load_mat(folder_mat, nt, nz, verbose)
+    X = matrices[:, :, 0, 3]
+    Y = matrices[:, :, 1, 3]
+
+    # Generate motion splines (failed volumes are not used for fitting, they get the fitted values)
     sct.printv('\nGenerate motion splines...',verbose)
     T = np.arange(nt)
+    valid = ~failed.any(axis=1)
+    if np.count_nonzero(valid) <= 3:
+        sct.printv('WARNING: not enough volumes for spline regularization, motion is not smoothed.', verbose, 'warning')
+        return
+    XY_smooth = smooth_spline(T[valid], np.concatenate((X, Y), axis=1)[valid])(T)
+    X_smooth, Y_smooth = XY_smooth[:, 0:nz], XY_smooth[:, nz:]
+
     if graph:
         import pylab as pl
-
-    for iz in range(nz):
-
-#        frequency = scipy.fftpack.fftfreq(len(X[iz][:]), d=1)
-#        spectrum = np.abs(scipy.fftpack.fft(X[iz][:], n=None, axis=-1, overwrite_x=False))
-#        Wn = np.amax(frequency)/10
-#        N = 5              #Order of the filter
-#        b, a = scipy.signal.iirfilter(N, Wn, rp=None, rs=None, btype='low', analog=False, ftype='butter', output='ba')
-#        X_smooth[iz][:] = scipy.signal.filtfilt(b, a, X[iz][:], axis=-1, padtype=None)
-
-        spline = scipy.interpolate.UnivariateSpline(T, X[iz][:], w=None, bbox=[None, None], k=3, s=None)
-        X_smooth[iz][:] = spline(T)
-
-        if graph:
-            pl.plot(T,X_smooth[iz][:],label='spline_smoothing')
-            pl.plot(T,X[iz][:],marker='*',linestyle='None',label='original_val')
-            if len(index_b0)!=0:
-                T_b0 = [T[i_b0] for i_b0 in index_b0]
-                X_b0 = [X[iz][i_b0] for i_b0 in index_b0]
-                pl.plot(T_b0,X_b0,marker='D',linestyle='None',color='k',label='b=0')
-            pl.title('X')
-            pl.grid()
-            pl.legend()
-            pl.show()
-
-#        frequency = scipy.fftpack.fftfreq(len(Y[iz][:]), d=1)
-#        spectrum = np.abs(scipy.fftpack.fft(Y[iz][:], n=None, axis=-1, overwrite_x=False))
-#        Wn = np.amax(frequency)/10
-#        N = 5              #Order of the filter
-#        b, a = scipy.signal.iirfilter(N, Wn, rp=None, rs=None, btype='low', analog=False, ftype='butter', output='ba')
-#        Y_smooth[iz][:] = scipy.signal.filtfilt(b, a, Y[iz][:], axis=-1, padtype=None)
-
-        spline = scipy.interpolate.UnivariateSpline(T, Y[iz][:], w=None, bbox=[None, None], k=3, s=None)
-        Y_smooth[iz][:] = spline(T)
-
-        if graph:
-            pl.plot(T,Y_smooth[iz][:],label='spline_smoothing')
-            pl.plot(T,Y[iz][:],marker='*', linestyle='None',label='original_val')
-            if len(index_b0)!=0:
-                T_b0 = [T[i_b0] for i_b0 in index_b0]
-                Y_b0 = [Y[iz][i_b0] for i_b0 in index_b0]
-                pl.plot(T_b0,Y_b0,marker='D',linestyle='None',color='k',label='b=0')
-            pl.title('Y')
-            pl.grid()
-            pl.legend()
-            pl.show()
+        for iz in range(nz):
+            for title, values, values_smooth in [('X', X, X_smooth), ('Y', Y, Y_smooth)]:
+                pl.plot(T,values_smooth[:, iz],label='spline_smoothing')
+                pl.plot(T,values[:, iz],marker='*',linestyle='None',label='original_val')
+                if len(index_b0)!=0:
+                    pl.plot(T[index_b0],values[index_b0, iz],marker='D',linestyle='None',color='k',label='b=0')
+                pl.title(title)
+                pl.grid()
+                pl.legend()
+                pl.show()
 
     #Storing the final Matrices
     sct.printv('\nStoring the final Matrices...',verbose)
-    for iz in range(nz):
-        for it in range(nt):
-            file =  open(file_mat[it][iz])
-            Matrix = np.loadtxt(file)
-            file.close()
-
-            Matrix[0,3] = X_smooth[iz][it]
-            Matrix[1,3] = Y_smooth[iz][it]
-
-            file =  open(file_mat[it][iz],'w')
-            np.savetxt(file_mat[it][iz], Matrix, fmt="%s", delimiter='  ', newline='\n')
-            file.close()
+    matrices = matrices.copy()
+    matrices[:, :, 0, 3] = X_smooth
+    matrices[:, :, 1, 3] = Y_smooth
+    save_mat(folder_mat, matrices, failed)
 
     sct.printv('\n...Done. Patient motion has been smoothed', verbose)
     sct.printv('------------------------------------------------------------------------------\n',verbose)
 
 
+#=======================================================================================================================
+# smooth_spline:  cubic smoothing spline of several series at once
+#=======================================================================================================================
+def smooth_spline(x, y, s=None, k=3):
+    """
+    Least-squares spline of several series sampled at the same points, with knots shared by all series. As for
+    scipy.interpolate.UnivariateSpline, the number of knots is increased until the sum of squared residuals is <= s
+    (default: number of points) for every series. Each fit is one least-squares solve for all series.
+    :param x: increasing abscissa [nb_points]
+    :param y: series [nb_points x nb_series]
+    :return: function that evaluates all series at given abscissa [nb_points x nb_series]
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if s is None:
+        s = n
+    # if no spline can be fitted (fewer than k+1 distinct points), the series are smoothed to their mean
+    fit = lambda xi: np.tile(np.mean(y, axis=0), (len(xi), 1))
+    for nb_knots in range(n-k):
+        # interior knots on data points, evenly distributed (n-k-1 knots: interpolation)
+        knots_interior = x[np.round(np.linspace(0, n-1, nb_knots+2)[1:-1]).astype(int)]
+        knots = np.concatenate(([x[0]]*(k+1), knots_interior, [x[-1]]*(k+1)))
+        basis = bspline_basis(x, knots, k)
+        coefs, residuals, rank, singular_values = np.linalg.lstsq(basis, y, rcond=-1)
+        if rank < basis.shape[1]:
+            # knots not supported by the data points (Schoenberg-Whitney conditions)
+            continue
+        fit = lambda xi, knots=knots, coefs=coefs: bspline_basis(xi, knots, k).dot(coefs)
+        if np.all(np.sum((basis.dot(coefs) - y)**2, axis=0) <= s):
+            break
+    return fit
+
+
+def bspline_basis(x, knots, k):
+    """
+    B-spline basis of degree k evaluated at x [nb_points x nb_coefficients]: column j is the spline whose
+    coefficients are all 0 except the j-th (scipy.interpolate.splev).
+    """
+    from scipy.interpolate import splev
+    nb_coefs = len(knots) - k - 1
+    basis = np.zeros((len(x), nb_coefs))
+    for j in range(nb_coefs):
+        coefs = np.zeros(len(knots))
+        coefs[j] = 1
+        basis[:, j] = splev(x, (knots, coefs, k))
+    return basis
+
+
 #=======================================================================================================================
 # combine_matrix
 #=======================================================================================================================
@@ -307,31 +462,22 @@ def combine_matrix(param):
     # param.verbose
 
     sct.printv('\nCombine matrices...', param.verbose)
-    # list all mat files in source mat folder
-    m2c_fnames = [ fname for fname in os.listdir(param.mat_2_combine) if os.path.isfile(os.path.join(param.mat_2_combine, fname)) ]
-    # loop across files
-    for fname in m2c_fnames:
-        if os.path.isfile(os.path.join(param.mat_final, fname)):
-            # read source matrix
-            file = open(os.path.join(param.mat_2_combine, fname))
-            Matrix_m2c = np.loadtxt(file)
-            file.close()
-            # read destination matrix
-            file = open(os.path.join(param.mat_final, fname))
-            Matrix_f = np.loadtxt(file)
-            file.close()
-            # initialize final matrix
-            Matrix_final = np.identity(4)
-            # multiplies rotation matrix (3x3)
-            Matrix_final[0:3, 0:3] = Matrix_f[0:3, 0:3] * Matrix_m2c[0:3, 0:3]
-            # add translations matrix (3x1)
-            Matrix_final[0, 3] = Matrix_f[0, 3] + Matrix_m2c[0, 3]
-            Matrix_final[1, 3] = Matrix_f[1, 3] + Matrix_m2c[1, 3]
-            Matrix_final[2, 3] = Matrix_f[2, 3] + Matrix_m2c[2, 3]
-            # write final matrix (overwrite destination)
-            file = open(os.path.join(param.mat_final, fname), 'w')
-            np.savetxt(os.path.join(param.mat_final, fname), Matrix_final, fmt="%s", delimiter='  ', newline='\n')
-            file.close()
+    matrices_m2c, failed_m2c = load_mat(param.mat_2_combine, verbose=param.verbose)
+    matrices_f, failed_f = load_mat(param.mat_final, verbose=param.verbose)
+    # combine matrices that exist in both folders
+    nt, nz = min(matrices_m2c.shape[0], matrices_f.shape[0]), min(matrices_m2c.shape[1], matrices_f.shape[1])
+    m2c, f = matrices_m2c[0:nt, 0:nz], matrices_f[0:nt, 0:nz]
+    both = ~failed_m2c[0:nt, 0:nz] & ~failed_f[0:nt, 0:nz]
+    # initialize final matrix
+    matrices_final = np.tile(np.identity(4), (nt, nz, 1, 1))
+    # multiplies rotation matrix (3x3)
+    matrices_final[:, :, 0:3, 0:3] = f[:, :, 0:3, 0:3] * m2c[:, :, 0:3, 0:3]
+    # add translations matrix (3x1)
+    matrices_final[:, :, 0:3, 3] = f[:, :, 0:3, 3] + m2c[:, :, 0:3, 3]
+    # write final matrices (overwrite destination)
+    matrices_f = matrices_f.copy()
+    matrices_f[0:nt, 0:nz][both] = matrices_final[both]
+    save_mat(param.mat_final, matrices_f, failed_f)
 
 #
 # #=======================================================================================================================
@@ -16,6 +16,11 @@
 # - lists, for example list of coordinate: [[','],'Coordinate']
 # - None, return True when detected (example of boolean)
 #
+# Options common to all scripts (handled by the parser, not returned in the dictionary):
+# -cache <folder>: cache outputs of external commands launched with sct_utils.run (see msct_cache)
+# -profile <file>: record time and resources used by external commands and stages in <file> (see msct_profiler)
+# -nb-workers <int>: maximum number of external commands run concurrently (see sct_utils.run_many)
+#
 # The parser returns a dictionary with all mandatory arguments as well as optional arguments with default values.
 #
 # Usage:
@@ -260,6 +265,9 @@ class Parser:
             doc_sourceforge.generate()
             exit(1)
 
+        # common options, available for all scripts. They are passed to child processes through environment variables.
+        arguments = self.parse_common_options(arguments)
+
         # initialize results
         dictionary = dict()
 
@@ -345,6 +353,30 @@ class Parser:
         # return a dictionary with each option name as a key and the input as the value
         return dictionary
 
+    def parse_common_options(self, arguments):
+        """
+        Handle options that are common to all scripts and remove them from the list of arguments:
+        -cache <folder>: cache outputs of external commands in <folder> (see msct_cache)
+        -profile <file>: record time and resources used by external commands and stages in <file> (see msct_profiler)
+        -nb-workers <int>: maximum number of external commands run concurrently (see sct_utils.run_many)
+        """
+        from os import environ
+        from os.path import abspath
+        arguments = list(arguments)
+        for name, variable in [('-cache', 'SCT_CACHE'), ('-profile', 'SCT_PROFILE'), ('-nb-workers', 'SCT_NB_WORKERS')]:
+            if name in arguments and name not in self.options:
+                index = arguments.index(name)
+                if index+1 >= len(arguments):
+                    self.usage.error("ERROR: Option " + name + " needs an argument...")
+                if variable == 'SCT_NB_WORKERS':
+                    if not arguments[index+1].isdigit() or int(arguments[index+1]) < 1:
+                        self.usage.error("ERROR: Option " + name + " needs a positive integer...")
+                    environ[variable] = arguments[index+1]
+                else:
+                    environ[variable] = abspath(arguments[index+1])
+                del arguments[index:index+2]
+        return arguments
+
 ########################################################################################################################
 ####### USAGE
 ########################################################################################################################
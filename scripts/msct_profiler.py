@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# msct_profiler
+# Record the cost of external commands (sct_utils.run) and of named pipeline stages (sct_utils.set_stage).
+#
+# Profiling is enabled by setting the environment variable SCT_PROFILE to a file name (or by using the flag
+# -profile <file> with scripts using msct_parser). Events are appended to this file as soon as they are done, in the
+# Chrome trace format (open it with chrome://tracing). Child processes (e.g. sct_* scripts called by other scripts)
+# append to the same file and appear as separate processes (pid) in the trace.
+# Each event stores the wall time, the CPU time, the peak RSS of the child process (for commands), the exit status and
+# the calling function.
+#
+# To rank the stages and the external programs by cost:
+# msct_profiler.py -i <file>
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2015 Polytechnique Montreal <www.neuro.polymtl.ca>
+# Created: 2015-08-12
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import sys
+import json
+import time
+
+
+class Profiler(object):
+    def __init__(self, fname):
+        self.fname = os.path.abspath(fname)
+        self.pid = os.getpid()
+        self.script = os.path.basename(sys.argv[0])
+        # current stage of the script: [name, wall time, python cpu time, children cpu time]
+        self.stage = None
+
+    def add_event(self, name, category, time_start, duration, args):
+        """Append an event to the trace file. Times are in seconds."""
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid, 'tid': 0,
+                 'ts': int(time_start * 1e6), 'dur': int(duration * 1e6), 'args': args}
+        if self.stage is not None:
+            event['args']['stage'] = self.stage[0]
+        event['args']['script'] = self.script
+        # one write in append mode, so that concurrent processes do not mix their events
+        fd = os.open(self.fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            line = json.dumps(event)+',\n'
+            if os.fstat(fd).st_size == 0:
+                line = '[\n'+line
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def add_command(self, cmd, caller, time_start, duration, status, rusage=None):
+        args = {'cmd': cmd, 'caller': caller, 'status': status}
+        if rusage is not None:
+            args['cpu_time'] = rusage.ru_utime + rusage.ru_stime
+            # ru_maxrss is in kilobytes on Linux and in bytes on OSX
+            args['rss_max_mb'] = rusage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+        # name of the event is the program called (skip "export VAR=value;" prefixes)
+        programs = [c.split()[0] for c in cmd.split(';') if c.split() and c.split()[0] != 'export']
+        self.add_event(programs[0] if programs else cmd, 'command', time_start, duration, args)
+
+    def set_stage(self, name=None):
+        """End the current stage (if any) and start a new one (if name is not None)."""
+        time_now, times = time.time(), os.times()
+        if self.stage is not None:
+            stage_name, time_start, cpu_start, cpu_children_start = self.stage
+            self.stage = None
+            self.add_event(stage_name, 'stage', time_start, time_now - time_start,
+                           {'cpu_time': times[0] + times[1] - cpu_start,
+                            'cpu_time_children': times[2] + times[3] - cpu_children_start})
+        if name is not None:
+            self.stage = [name, time_now, times[0] + times[1], times[2] + times[3]]
+
+
+def read_trace(fname):
+    """Read a trace file written by Profiler (the closing bracket is optional in the Chrome trace format)."""
+    content = open(fname).read().strip()
+    if content.endswith(','):
+        content = content[:-1]
+    if not content.endswith(']'):
+        content += ']'
+    return json.loads(content)
+
+
+def summarize(fname):
+    """Print stages and external programs ranked by total wall time."""
+    events = read_trace(fname)
+    for category, title in [('stage', 'STAGES'), ('command', 'EXTERNAL PROGRAMS')]:
+        total = dict()
+        for event in [e for e in events if e['cat'] == category]:
+            key = event['args']['script']+': '+event['name'] if category == 'stage' else event['name']
+            wall, cpu, count = total.get(key, (0, 0, 0))
+            total[key] = (wall + event['dur'] / 1e6, cpu + event['args'].get('cpu_time', 0), count + 1)
+        print '\n'+title
+        print '  '+'wall (s)'.rjust(10)+'cpu (s)'.rjust(10)+'calls'.rjust(8)+'  name'
+        for key, (wall, cpu, count) in sorted(total.items(), key=lambda item: -item[1][0]):
+            print '  '+('%.1f' % wall).rjust(10)+('%.1f' % cpu).rjust(10)+str(count).rjust(8)+'  '+key
+
+
+#=======================================================================================================================
+# Start program
+#=======================================================================================================================
+if __name__ == "__main__":
+    from msct_parser import Parser
+
+    parser = Parser(__file__)
+    parser.usage.set_description('Rank stages and external programs recorded in a profiling file (see SCT_PROFILE).')
+    parser.add_option("-i", "file", "profiling file", True, "profile.json")
+    arguments = parser.parse(sys.argv[1:])
+
+    summarize(arguments["-i"])
@@ -126,6 +126,50 @@ def register_slicereg2d_translation(src, dest, window_length=31, paramreg=Paramr
     generate_warping_field(src, -x_disp_smooth, -y_disp_smooth, fname=warp_inverse_out)
 
 
+def register_slicereg2d_fft(src, dest, window_length=31, fname_mask='', warp_forward_out='step0Warp.nii.gz', warp_inverse_out='step0InverseWarp.nii.gz',
+                            factor=2, verbose=0):
+    """Slice-by-slice regularized registration by translation of two images, using phase correlation.
+
+    We first estimate for each slice the translation by phase correlation (all slices at once with FFTs, see
+    register_images_fft). Then we remove outliers using Median Absolute Deviation technique (MAD) and smooth the
+    translations along x and y axis using moving average hanning window. Eventually, we generate two warping fields
+    (forward and inverse) resulting from this regularized registration technique.
+    The images must be of same size.
+
+    input:
+        src: name of moving image (type: string)
+        dest: name of fixed image (type: string)
+        window_length[optional]: size of window for moving average smoothing (type: int)
+        fname_mask[optional]: name of mask file, in the space of the destination image (type: string)
+        warp_forward_out[optional]: name of output forward warp (type: string)
+        warp_inverse_out[optional]: name of output inverse warp (type: string)
+        factor[optional]: sensibility factor for outlier detection (higher the factor, smaller the detection)
+            (type: int or float)
+        verbose[optional]: display parameter (type: int, value: 0,1 or 2)
+
+    output:
+        creation of warping field files of name 'warp_forward_out' and 'warp_inverse_out'.
+    """
+    from msct_register_regularized import register_images_fft, generate_warping_field
+    from msct_smooth import smoothing_window, outliers_detection, outliers_completion
+
+    # Calculate displacement
+    x_disp_a, y_disp_a = register_images_fft(src, dest, mask=fname_mask, verbose=verbose)
+    # Detect outliers
+    mask_x_a = outliers_detection(x_disp_a, type='median', factor=factor, return_filtered_signal='no', verbose=verbose)
+    mask_y_a = outliers_detection(y_disp_a, type='median', factor=factor, return_filtered_signal='no', verbose=verbose)
+    # Replace value of outliers by linear interpolation using closest non-outlier points
+    x_disp_a_no_outliers = outliers_completion(mask_x_a, verbose=0)
+    y_disp_a_no_outliers = outliers_completion(mask_y_a, verbose=0)
+    # Smooth results
+    x_disp_smooth = smoothing_window(x_disp_a_no_outliers, window_len=int(window_length), window='hanning', verbose=verbose)
+    y_disp_smooth = smoothing_window(y_disp_a_no_outliers, window_len=int(window_length), window='hanning', verbose=verbose)
+    # Generate warping field
+    generate_warping_field(dest, x_disp_smooth, y_disp_smooth, fname=warp_forward_out)
+    # Inverse warping field
+    generate_warping_field(src, -x_disp_smooth, -y_disp_smooth, fname=warp_inverse_out)
+
+
 def register_slicereg2d_rigid(src, dest, window_length=31, paramreg=Paramreg(step='0', type='im', algo='Rigid', metric='MeanSquares', iter='10', shrink='1', smooth='0', gradStep='0.5'),
                               fname_mask='', warp_forward_out='step0Warp.nii.gz', warp_inverse_out='step0InverseWarp.nii.gz', factor=2, remove_temp_files=1, verbose=0,
                               ants_registration_params={'rigid': '', 'affine': '', 'compositeaffine': '', 'similarity': '', 'translation': '','bspline': ',10', 'gaussiandisplacementfield': ',3,0',
@@ -227,15 +271,11 @@ def register_slicereg2d_affine(src, dest, window_length=31, paramreg=Paramreg(st
     register_images(src, dest, mask=fname_mask, paramreg=paramreg, remove_tmp_folder=remove_temp_files, ants_registration_params=ants_registration_params)
 
     print'\nRegularizing warping fields along z axis...'
-    print'\n\tSplitting warping fields ...'
-    sct.run('isct_c3d -mcs ' + name_warp_syn + '.nii.gz -oo ' + name_warp_syn + '_x.nii.gz ' + name_warp_syn + '_y.nii.gz')
-    sct.run('isct_c3d -mcs ' + name_warp_syn + '_inverse.nii.gz -oo ' + name_warp_syn + '_x_inverse.nii.gz ' + name_warp_syn + '_y_inverse.nii.gz')
-    data_warp_x = load(name_warp_syn + '_x.nii.gz').get_data()
-    data_warp_y = load(name_warp_syn + '_y.nii.gz').get_data()
-    hdr_warp = load(name_warp_syn + '_x.nii.gz').get_header()
-    data_warp_x_inverse = load(name_warp_syn + '_x_inverse.nii.gz').get_data()
-    data_warp_y_inverse = load(name_warp_syn + '_y_inverse.nii.gz').get_data()
-    hdr_warp_inverse = load(name_warp_syn + '_x_inverse.nii.gz').get_header()
+    warp, warp_inverse = load(name_warp_syn + '.nii.gz'), load(name_warp_syn + '_inverse.nii.gz')
+    data_warp_x, data_warp_y = warp.get_data()[:, :, :, 0, 0], warp.get_data()[:, :, :, 0, 1]
+    hdr_warp = warp.get_header()
+    data_warp_x_inverse, data_warp_y_inverse = warp_inverse.get_data()[:, :, :, 0, 0], warp_inverse.get_data()[:, :, :, 0, 1]
+    hdr_warp_inverse = warp_inverse.get_header()
     #Outliers deletion
     print'\n\tDeleting outliers...'
     mask_x_a = apply_along_axis(lambda m: outliers_detection(m, type='median', factor=factor, return_filtered_signal='no', verbose=0), axis=-1, arr=data_warp_x)
@@ -314,15 +354,11 @@ def register_slicereg2d_syn(src, dest, window_length=31, paramreg=Paramreg(step=
     # Registrating images
     register_images(src, dest, mask=fname_mask, paramreg=paramreg, remove_tmp_folder=remove_temp_files, ants_registration_params=ants_registration_params)
     print'\nRegularizing warping fields along z axis...'
-    print'\n\tSplitting warping fields ...'
-    sct.run('isct_c3d -mcs ' + name_warp_syn + '.nii.gz -oo ' + name_warp_syn + '_x.nii.gz ' + name_warp_syn + '_y.nii.gz')
-    sct.run('isct_c3d -mcs ' + name_warp_syn + '_inverse.nii.gz -oo ' + name_warp_syn + '_x_inverse.nii.gz ' + name_warp_syn + '_y_inverse.nii.gz')
-    data_warp_x = load(name_warp_syn + '_x.nii.gz').get_data()
-    data_warp_y = load(name_warp_syn + '_y.nii.gz').get_data()
-    hdr_warp = load(name_warp_syn + '_x.nii.gz').get_header()
-    data_warp_x_inverse = load(name_warp_syn + '_x_inverse.nii.gz').get_data()
-    data_warp_y_inverse = load(name_warp_syn + '_y_inverse.nii.gz').get_data()
-    hdr_warp_inverse = load(name_warp_syn + '_x_inverse.nii.gz').get_header()
+    warp, warp_inverse = load(name_warp_syn + '.nii.gz'), load(name_warp_syn + '_inverse.nii.gz')
+    data_warp_x, data_warp_y = warp.get_data()[:, :, :, 0, 0], warp.get_data()[:, :, :, 0, 1]
+    hdr_warp = warp.get_header()
+    data_warp_x_inverse, data_warp_y_inverse = warp_inverse.get_data()[:, :, :, 0, 0], warp_inverse.get_data()[:, :, :, 0, 1]
+    hdr_warp_inverse = warp_inverse.get_header()
     #Outliers deletion
     print'\n\tDeleting outliers...'
     mask_x_a = apply_along_axis(lambda m: outliers_detection(m, type='median', factor=factor, return_filtered_signal='no', verbose=0), axis=-1, arr=data_warp_x)
@@ -402,15 +438,11 @@ def register_slicereg2d_bsplinesyn(src, dest, window_length=31, paramreg=Paramre
     # Registrating images
     register_images(src, dest, mask=fname_mask, paramreg=paramreg, remove_tmp_folder=remove_temp_files, ants_registration_params=ants_registration_params)
     print'\nRegularizing warping fields along z axis...'
-    print'\n\tSplitting warping fields ...'
-    sct.run('isct_c3d -mcs ' + name_warp_syn + '.nii.gz -oo ' + name_warp_syn + '_x.nii.gz ' + name_warp_syn + '_y.nii.gz')
-    sct.run('isct_c3d -mcs ' + name_warp_syn + '_inverse.nii.gz -oo ' + name_warp_syn + '_x_inverse.nii.gz ' + name_warp_syn + '_y_inverse.nii.gz')
-    data_warp_x = load(name_warp_syn + '_x.nii.gz').get_data()
-    data_warp_y = load(name_warp_syn + '_y.nii.gz').get_data()
-    hdr_warp = load(name_warp_syn + '_x.nii.gz').get_header()
-    data_warp_x_inverse = load(name_warp_syn + '_x_inverse.nii.gz').get_data()
-    data_warp_y_inverse = load(name_warp_syn + '_y_inverse.nii.gz').get_data()
-    hdr_warp_inverse = load(name_warp_syn + '_x_inverse.nii.gz').get_header()
+    warp, warp_inverse = load(name_warp_syn + '.nii.gz'), load(name_warp_syn + '_inverse.nii.gz')
+    data_warp_x, data_warp_y = warp.get_data()[:, :, :, 0, 0], warp.get_data()[:, :, :, 0, 1]
+    hdr_warp = warp.get_header()
+    data_warp_x_inverse, data_warp_y_inverse = warp_inverse.get_data()[:, :, :, 0, 0], warp_inverse.get_data()[:, :, :, 0, 1]
+    hdr_warp_inverse = warp_inverse.get_header()
     #Outliers deletion
     print'\n\tDeleting outliers...'
     mask_x_a = apply_along_axis(lambda m: outliers_detection(m, type='median', factor=factor, return_filtered_signal='no', verbose=0), axis=-1, arr=data_warp_x)
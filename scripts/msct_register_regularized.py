@@ -80,13 +80,15 @@ def register_seg(seg_input, seg_dest):
 
 def register_images(im_input, im_dest, mask='', paramreg=Paramreg(step='0', type='im', algo='Translation', metric='MI', iter='5', shrink='1', smooth='0', gradStep='0.5'),
                     ants_registration_params={'rigid': '', 'affine': '', 'compositeaffine': '', 'similarity': '', 'translation': '','bspline': ',10', 'gaussiandisplacementfield': ',3,0',
-                                              'bsplinedisplacementfield': ',5,10', 'syn': ',3,0', 'bsplinesyn': ',1,3'}, remove_tmp_folder = 1):
+                                              'bsplinedisplacementfield': ',5,10', 'syn': ',3,0', 'bsplinesyn': ',1,3'}, remove_tmp_folder = 1, nb_workers=None):
     """Slice-by-slice registration of two images.
 
     We first split the 3D images into 2D images (and the mask if inputted). Then we register slices of the two images
     that physically correspond to one another looking at the physical origin of each image. The images can be of
     different sizes but the destination image must be smaller thant the input image. We do that using antsRegistration
     in 2D. Once this has been done for each slices, we gather the results and return them.
+    Slices are registered concurrently (see sct_utils.run_many). If the registration of a slice fails, the
+    transformation of the nearest previous slice that succeeded is used (nearest next slice for the first slices).
     Algorithms implemented: translation, rigid, affine, syn and BsplineSyn.
     N.B.: If the mask is inputted, it must also be 3D and it must be in the same space as the destination image.
 
@@ -96,6 +98,7 @@ def register_images(im_input, im_dest, mask='', paramreg=Paramreg(step='0', type
         mask[optional]: name of mask file (type: string) (parameter -x of antsRegistration)
         paramreg[optional]: parameters of antsRegistration (type: Paramreg class from sct_register_multimodal)
         ants_registration_params[optional]: specific algorithm's parameters for antsRegistration (type: dictionary)
+        nb_workers[optional]: number of slices registered concurrently. Default: see sct_utils.get_nb_workers (type: int)
 
     output:
         if algo==translation:
@@ -165,13 +168,12 @@ def register_images(im_input, im_dest, mask='', paramreg=Paramreg(step='0', type
     [x_o, y_o, z_o] = [coord_diff_origin[0] * 1.0/px, coord_diff_origin[1] * 1.0/py, coord_diff_origin[2] * 1.0/pz]
 
     if paramreg.algo == 'BSplineSyN' or paramreg.algo == 'SyN' or paramreg.algo == 'Affine':
-        list_warp_x = []
-        list_warp_x_inv = []
-        list_warp_y = []
-        list_warp_y_inv = []
         name_warp_final = 'Warp_total' #if modified, name should also be modified in msct_register (algo slicereg2d_bsplinesyn and slicereg2d_syn)
 
-    # loop across slices
+    # register all slices (slices are independent, so registrations run concurrently)
+    # memory of one 2D registration (in GB): process overhead, and about 20 images/fields of the size of a slice
+    ram_per_job = 0.1 + 20 * nx * ny * 8 / 1024.**3
+    list_cmd = []
     for i in range(nz):
         # set masking
         num = numerotation(i)
@@ -193,99 +195,60 @@ def register_images(im_input, im_dest, mask='', paramreg=Paramreg(step='0', type
                '--output [transform_' + num + ','+root_i+'_z'+ num_2 +'reg.nii] '    #--> file.mat (contains Tx,Ty, theta)
                '--interpolation BSpline[3] '
                +masking)
-
-        try:
-            sct.run(cmd)
-
-            if paramreg.algo == 'Rigid' or paramreg.algo == 'Translation':
-                f = 'transform_' +num+ '0GenericAffine.mat'
-                matfile = loadmat(f, struct_as_record=True)
-                array_transfo = matfile['AffineTransform_double_2_2']
-                x_displacement[i] = array_transfo[4][0]  # Tx in ITK'S coordinate system
-                y_displacement[i] = array_transfo[5][0]  # Ty  in ITK'S and fslview's coordinate systems
-                theta_rotation[i] = asin(array_transfo[2]) # angle of rotation theta in ITK'S coordinate system (minus theta for fslview)
-
-            if paramreg.algo == 'Affine':
-                # New process added for generating total nifti warping field from mat warp
-                name_dest = root_d+'_z'+ num +'.nii'
-                name_reg = root_i+'_z'+ num +'reg.nii'
-                name_output_warp = 'warp_from_mat_' + num_2 + '.nii.gz'
-                name_output_warp_inverse = 'warp_from_mat_' + num + '_inverse.nii.gz'
-                name_warp_null = 'warp_null_' + num + '.nii.gz'
-                name_warp_null_dest = 'warp_null_dest' + num + '.nii.gz'
-                name_warp_mat = 'transform_' + num + '0GenericAffine.mat'
-                # Generating null nifti warping fields
-                nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension(name_reg)
-                nx_d, ny_d, nz_d, nt_d, px_d, py_d, pz_d, pt_d = sct.get_dimension(name_dest)
-                x_trans = [0 for i in range(nz)]
-                x_trans_d = [0 for i in range(nz_d)]
-                y_trans= [0 for i in range(nz)]
-                y_trans_d = [0 for i in range(nz_d)]
-                generate_warping_field(name_reg, x_trans=x_trans, y_trans=y_trans, fname=name_warp_null, verbose=0)
-                generate_warping_field(name_dest, x_trans=x_trans_d, y_trans=y_trans_d, fname=name_warp_null_dest, verbose=0)
-                # Concatenating mat wrp and null nifti warp to obtain equivalent nifti warp to mat warp
-                sct.run('isct_ComposeMultiTransform 2 ' + name_output_warp + ' -R ' + name_reg + ' ' + name_warp_null + ' ' + name_warp_mat)
-                sct.run('isct_ComposeMultiTransform 2 ' + name_output_warp_inverse + ' -R ' + name_dest + ' ' + name_warp_null_dest + ' -i ' + name_warp_mat)
-                # Split the warping fields into two for displacement along x and y before merge
-                sct.run('isct_c3d -mcs ' + name_output_warp + ' -oo transform_'+num+'0Warp_x.nii.gz transform_'+num+'0Warp_y.nii.gz')
-                sct.run('isct_c3d -mcs ' + name_output_warp_inverse + ' -oo transform_'+num+'0InverseWarp_x.nii.gz transform_'+num+'0InverseWarp_y.nii.gz')
-                # List names of warping fields for futur merge
-                list_warp_x.append('transform_'+num+'0Warp_x.nii.gz')
-                list_warp_x_inv.append('transform_'+num+'0InverseWarp_x.nii.gz')
-                list_warp_y.append('transform_'+num+'0Warp_y.nii.gz')
-                list_warp_y_inv.append('transform_'+num+'0InverseWarp_y.nii.gz')
-
-            if paramreg.algo == 'BSplineSyN' or paramreg.algo == 'SyN':
-                # Split the warping fields into two for displacement along x and y before merge
-                # Need to separate the merge for x and y displacement as merge of 3d warping fields does not work properly
-                sct.run('isct_c3d -mcs transform_'+num+'0Warp.nii.gz -oo transform_'+num+'0Warp_x.nii.gz transform_'+num+'0Warp_y.nii.gz')
-                sct.run('isct_c3d -mcs transform_'+num+'0InverseWarp.nii.gz -oo transform_'+num+'0InverseWarp_x.nii.gz transform_'+num+'0InverseWarp_y.nii.gz')
-                # List names of warping fields for futur merge
-                list_warp_x.append('transform_'+num+'0Warp_x.nii.gz')
-                list_warp_x_inv.append('transform_'+num+'0InverseWarp_x.nii.gz')
-                list_warp_y.append('transform_'+num+'0Warp_y.nii.gz')
-                list_warp_y_inv.append('transform_'+num+'0InverseWarp_y.nii.gz')
-        # if an exception occurs with ants, take the last value for the transformation
-        except:
-                if paramreg.algo == 'Rigid' or paramreg.algo == 'Translation':
-                    x_displacement[i] = x_displacement[i-1]
-                    y_displacement[i] = y_displacement[i-1]
-                    theta_rotation[i] = theta_rotation[i-1]
-
-
-                if paramreg.algo == 'BSplineSyN' or paramreg.algo == 'SyN' or paramreg.algo == 'Affine':
-                    print'Problem with ants for slice '+str(i)+'. Copy of the last warping field.'
-                    sct.run('cp transform_' + numerotation(i-1) + '0Warp.nii.gz transform_' + num + '0Warp.nii.gz')
-                    sct.run('cp transform_' + numerotation(i-1) + '0InverseWarp.nii.gz transform_' + num + '0InverseWarp.nii.gz')
-                    # Split the warping fields into two for displacement along x and y before merge
-                    sct.run('isct_c3d -mcs transform_'+num+'0Warp.nii.gz -oo transform_'+num+'0Warp_x.nii.gz transform_'+num+'0Warp_y.nii.gz')
-                    sct.run('isct_c3d -mcs transform_'+num+'0InverseWarp.nii.gz -oo transform_'+num+'0InverseWarp_x.nii.gz transform_'+num+'0InverseWarp_y.nii.gz')
-                    # List names of warping fields for futur merge
-                    list_warp_x.append('transform_'+num+'0Warp_x.nii.gz')
-                    list_warp_x_inv.append('transform_'+num+'0InverseWarp_x.nii.gz')
-                    list_warp_y.append('transform_'+num+'0Warp_y.nii.gz')
-                    list_warp_y_inv.append('transform_'+num+'0InverseWarp_y.nii.gz')
+        list_cmd.append(cmd)
+    success = [status == 0 for status, output in sct.run_many(list_cmd, nb_workers=nb_workers, ram_per_job=ram_per_job, error_exit=False)]
+
+    if paramreg.algo == 'Rigid' or paramreg.algo == 'Translation':
+        for i in [i for i in range(nz) if success[i]]:
+            try:
+                matfile = loadmat('transform_' +numerotation(i)+ '0GenericAffine.mat', struct_as_record=True)
+            except Exception:
+                success[i] = False
+                continue
+            array_transfo = matfile['AffineTransform_double_2_2']
+            x_displacement[i] = array_transfo[4][0]  # Tx in ITK'S coordinate system
+            y_displacement[i] = array_transfo[5][0]  # Ty  in ITK'S and fslview's coordinate systems
+            theta_rotation[i] = asin(array_transfo[2]) # angle of rotation theta in ITK'S coordinate system (minus theta for fslview)
+
+    if paramreg.algo == 'Affine':
+        # New process added for generating total nifti warping field from mat warp
+        list_cmd, list_slices = [], []
+        for i in [i for i in range(nz) if success[i]]:
+            num = numerotation(i)
+            num_2 = numerotation(int(num) + int(z_o))
+            name_dest = root_d+'_z'+ num +'.nii'
+            name_reg = root_i+'_z'+ num_2 +'reg.nii'
+            name_warp_null = 'warp_null_' + num + '.nii.gz'
+            name_warp_null_dest = 'warp_null_dest' + num + '.nii.gz'
+            name_warp_mat = 'transform_' + num + '0GenericAffine.mat'
+            # Generating null nifti warping fields
+            nz_reg = sct.get_dimension(name_reg)[2]
+            nz_d = sct.get_dimension(name_dest)[2]
+            generate_warping_field(name_reg, x_trans=[0]*nz_reg, y_trans=[0]*nz_reg, fname=name_warp_null, verbose=0)
+            generate_warping_field(name_dest, x_trans=[0]*nz_d, y_trans=[0]*nz_d, fname=name_warp_null_dest, verbose=0)
+            # Concatenating mat wrp and null nifti warp to obtain equivalent nifti warp to mat warp
+            list_cmd.append('isct_ComposeMultiTransform 2 transform_' + num + '0Warp.nii.gz -R ' + name_reg + ' ' + name_warp_null + ' ' + name_warp_mat)
+            list_cmd.append('isct_ComposeMultiTransform 2 transform_' + num + '0InverseWarp.nii.gz -R ' + name_dest + ' ' + name_warp_null_dest + ' -i ' + name_warp_mat)
+            list_slices += [i, i]
+        for i, (status, output) in zip(list_slices, sct.run_many(list_cmd, nb_workers=nb_workers, ram_per_job=ram_per_job, error_exit=False)):
+            success[i] = success[i] and status == 0
+
+    # replace the transformation of slices where ants failed with the one of the nearest previous slice that succeeded
+    # (nearest next slice for the first slices). This is done once all slices are registered, so that the result does
+    # not depend on the order in which registrations finished.
+    slice_source = get_slice_source(success)
+    for i in range(nz):
+        if slice_source[i] != i:
+            print 'Problem with ants for slice '+str(i)+'. Use transformation of slice '+str(slice_source[i])+'.'
+            x_displacement[i] = x_displacement[slice_source[i]]
+            y_displacement[i] = y_displacement[slice_source[i]]
+            theta_rotation[i] = theta_rotation[slice_source[i]]
 
     if paramreg.algo == 'BSplineSyN' or paramreg.algo == 'SyN' or paramreg.algo == 'Affine':
         print'\nMerge along z of the warping fields...'
-        sct.run('fslmerge -z ' + name_warp_final + '_x ' + " ".join(list_warp_x))
-        sct.run('fslmerge -z ' + name_warp_final + '_x_inverse ' + " ".join(list_warp_x_inv))
-        sct.run('fslmerge -z ' + name_warp_final + '_y ' + " ".join(list_warp_y))
-        sct.run('fslmerge -z ' + name_warp_final + '_y_inverse ' + " ".join(list_warp_y_inv))
-        print'\nChange resolution of warping fields to match the resolution of the destination image...'
-        sct.run('fslcpgeom ' + im_dest + ' ' + name_warp_final + '_x.nii.gz')
-        sct.run('fslcpgeom ' + im_input + ' ' + name_warp_final + '_x_inverse.nii.gz')
-        sct.run('fslcpgeom ' + im_dest + ' ' + name_warp_final + '_y.nii.gz')
-        sct.run('fslcpgeom ' + im_input + ' ' + name_warp_final + '_y_inverse.nii.gz')
-        print'\nMerge translation fields along x and y into one global warping field '
-        sct.run('isct_c3d ' + name_warp_final + '_x.nii.gz ' + name_warp_final + '_y.nii.gz -omc 2 ' + name_warp_final + '.nii.gz')
-        sct.run('isct_c3d ' + name_warp_final + '_x_inverse.nii.gz ' + name_warp_final + '_y_inverse.nii.gz -omc 2 ' + name_warp_final + '_inverse.nii.gz')
-        print'\nCopy to parent folder...'
-        sct.run('cp ' + name_warp_final + '.nii.gz ../')
-        sct.run('cp ' + name_warp_final + '_inverse.nii.gz ../')
-
-
-
+        # fields are written in the parent folder, with the geometry of the destination (forward) and input (inverse) images
+        merge_warping_fields(['transform_'+numerotation(j)+'0Warp.nii.gz' for j in slice_source], root_d+ext_d, '../'+name_warp_final+'.nii.gz')
+        merge_warping_fields(['transform_'+numerotation(j)+'0InverseWarp.nii.gz' for j in slice_source], root_i+ext_i, '../'+name_warp_final+'_inverse.nii.gz')
 
     #Delete tmp folder
     os.chdir('../')
@@ -299,6 +262,94 @@ def register_images(im_input, im_dest, mask='', paramreg=Paramreg(step='0', type
 
 
 
+def register_images_fft(im_input, im_dest, mask='', verbose=1):
+    """Slice-by-slice registration by translation of two images, using phase correlation.
+
+    For each slice, the translation is the position of the peak of the normalized cross-power spectrum of the two
+    slices (windowed with a 2D hanning window, and weighted by the mask if inputted), refined to subpixel precision with
+    a parabola fitted around the peak. All slices are processed at once with 2D FFTs, without external programs. If a
+    slice is empty in one of the images, the translation of the nearest previous valid slice is used (nearest next
+    slice for the first slices).
+    The two images (and the mask) must have the same dimensions (e.g. source image put into the destination space).
+
+    input:
+        im_input: name of moving image (type: string)
+        im_dest: name of fixed image (type: string)
+        mask[optional]: name of mask file, in the same space as the destination image (type: string)
+        verbose[optional]: display parameter (type: int)
+
+    output:
+        x_displacement: array of translations along x axis in mm (in ITK's coordinate system) for each slice
+        y_displacement: array of translations along y axis in mm (in ITK's coordinate system) for each slice
+    """
+    from numpy import abs, arange, argmax, fft, hanning, outer, unravel_index, where
+
+    sct.printv('\nEstimate translations of all slices by phase correlation...', verbose)
+    nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension(im_dest)
+    data_dest = asarray(nibabel.load(im_dest).get_data(), dtype=float).reshape(nx, ny, nz)
+    data_input = asarray(nibabel.load(im_input).get_data(), dtype=float)
+    if data_input.size != data_dest.size:
+        sct.printv('ERROR: images must have the same dimensions for phase correlation.', 1, 'error')
+    data_input = data_input.reshape(nx, ny, nz)
+
+    # window (and mask) applied to both images, to reduce edge effects of the periodic FFT
+    weights = outer(hanning(nx), hanning(ny)).reshape(nx, ny, 1)
+    if mask:
+        weights = weights * asarray(nibabel.load(mask).get_data(), dtype=float).reshape(nx, ny, nz)
+    data_dest *= weights
+    data_input *= weights
+    success = [(data_dest[:, :, k] != 0).any() and (data_input[:, :, k] != 0).any() for k in range(nz)]
+
+    # normalized cross-power spectrum of all slices: its inverse transform peaks at the shift of input vs destination
+    cross_power = fft.fft2(data_input, axes=(0, 1)) * fft.fft2(data_dest, axes=(0, 1)).conj()
+    cross_power /= abs(cross_power) + 1e-12
+    correlation = fft.ifft2(cross_power, axes=(0, 1)).real
+    index_x, index_y = unravel_index(argmax(correlation.reshape(nx * ny, nz), axis=0), (nx, ny))
+
+    # subpixel refinement: parabola through the peak and its two neighbours (with periodic boundaries)
+    slices = arange(nz)
+    shifts = []
+    for index, n, axis in [(index_x, nx, 0), (index_y, ny, 1)]:
+        index_neighbour = [(index - 1) % n, (index + 1) % n]
+        if axis == 0:
+            peak, before, after = [correlation[i, index_y, slices] for i in [index] + index_neighbour]
+        else:
+            peak, before, after = [correlation[index_x, i, slices] for i in [index] + index_neighbour]
+        denominator = before - 2 * peak + after
+        shift = index + where(denominator < 0, 0.5 * (before - after) / where(denominator < 0, denominator, -1), 0)
+        # shifts larger than half the field of view are negative shifts
+        shifts.append(where(shift > n / 2.0, shift - n, shift))
+
+    # voxel shift of the input image --> displacement in ITK's coordinate system (LPS, hence the sign along y)
+    x_displacement = shifts[0] * px
+    y_displacement = - shifts[1] * py
+    slice_source = get_slice_source(success)
+    for i in range(nz):
+        if slice_source[i] != i:
+            sct.printv('WARNING: slice '+str(i)+' is empty. Use translation of slice '+str(slice_source[i])+'.', verbose, 'warning')
+    return x_displacement[slice_source], y_displacement[slice_source]
+
+
+def get_slice_source(success):
+    """Slice whose transformation is used for each slice: the slice itself if its registration succeeded, otherwise
+    the nearest previous slice that succeeded (nearest next slice for the first slices).
+
+    input:
+        success: registration status of each slice (type: list of bool)
+
+    output:
+        slice_source: index of the slice to use for each slice (type: list)
+    """
+    slices_success = [i for i in range(len(success)) if success[i]]
+    if not slices_success:
+        sct.printv('ERROR: registration failed on all slices.', 1, 'error')
+    slice_source = []
+    for i in range(len(success)):
+        previous = [j for j in slices_success if j <= i]
+        slice_source.append(previous[-1] if previous else slices_success[0])
+    return slice_source
+
+
 def numerotation(nb):
     """Indexation of number for matching fslsplit's index.
 
@@ -348,7 +399,7 @@ def generate_warping_field(im_dest, x_trans, y_trans, theta_rot=None, center_rot
         creation of a warping field of name 'fname' with an header similar to the destination image.
     """
     from nibabel import load
-    from math import cos, sin
+    from numpy import arange, cos, sin
     from sct_orientation import get_orientation
 
     #Make sure image is in rpi format
@@ -378,38 +429,22 @@ def generate_warping_field(im_dest, x_trans, y_trans, theta_rot=None, center_rot
         x_a = center_rotation[0]
         y_a = center_rotation[1]
 
-    # Calculate displacement for each voxel
-    data_warp = zeros(((((nx, ny, nz, 1, 3)))))
+    # Calculate displacement for each voxel (transformations are broadcast over the plane xOy of each slice)
+    data_warp = zeros((nx, ny, nz, 1, 3))
+    x_trans = asarray(x_trans, dtype=float).reshape(1, 1, nz)
+    y_trans = asarray(y_trans, dtype=float).reshape(1, 1, nz)
     # For translations
-    if theta_rot == None:
-        for i in range(nx):
-            for j in range(ny):
-                for k in range(nz):
-                    data_warp[i, j, k, 0, 0] = x_trans[k]
-                    data_warp[i, j, k, 0, 1] = y_trans[k]
-                    data_warp[i, j, k, 0, 2] = 0
-    # # For rigid transforms (not optimized)
-    # if theta_rot != None:
-    #     for k in range(nz):
-    #         for i in range(nx):
-    #             for j in range(ny):
-    #                 # data_warp[i, j, k, 0, 0] = (cos(theta_rot[k])-1) * (i - x_a) - sin(theta_rot[k]) * (j - y_a) - x_trans[k]
-    #                 # data_warp[i, j, k, 0, 1] = -(sin(theta_rot[k]) * (i - x_a) + (cos(theta_rot[k])-1) * (j - y_a)) + y_trans[k]
-    #
-    #                 data_warp[i, j, k, 0, 0] = (cos(theta_rot[k]) - 1) * (i - x_a) - sin(theta_rot[k]) * (j - y_a) + x_trans[k] #+ sin(theta_rot[k]) * (int(round(nx/2))-x_a)
-    #                 data_warp[i, j, k, 0, 1] = - sin(theta_rot[k]) * (i - x_a) - (cos(theta_rot[k]) - 1) * (j - y_a) + y_trans[k] #- sin(theta_rot[k]) * (int(round(nx/2))-x_a)
-    #                 data_warp[i, j, k, 0, 2] = 0
-
-    # For rigid transforms with array (time optimization)
-    if theta_rot != None:
-        vector_i = [[[i-x_a],[j-y_a]] for i in range(nx) for j in range(ny)]
-        for k in range(nz):
-            matrix_rot_a = asarray([[cos(theta_rot[k]), - sin(theta_rot[k])],[-sin(theta_rot[k]), -cos(theta_rot[k])]])
-            tmp = matrix_rot_a + array(((-1,0),(0,1)))
-            result = dot(tmp, array(vector_i).T[0]) + array([[x_trans[k]], [y_trans[k]]])
-            for i in range(nx):
-                data_warp[i, :, k, 0, 0] = result[0][i*nx:i*nx+ny]
-                data_warp[i, :, k, 0, 1] = result[1][i*nx:i*nx+ny]
+    if theta_rot is None:
+        data_warp[:, :, :, 0, 0] = x_trans
+        data_warp[:, :, :, 0, 1] = y_trans
+    # For rigid transforms: (R(theta) - I) applied to the position relative to the center of rotation, in ITK's
+    # coordinate system, plus the translation
+    else:
+        theta_rot = asarray(theta_rot, dtype=float).reshape(1, 1, nz)
+        x = (arange(nx, dtype=float) - x_a).reshape(nx, 1, 1)
+        y = (arange(ny, dtype=float) - y_a).reshape(1, ny, 1)
+        data_warp[:, :, :, 0, 0] = (cos(theta_rot) - 1) * x - sin(theta_rot) * y + x_trans
+        data_warp[:, :, :, 0, 1] = - sin(theta_rot) * x - (cos(theta_rot) - 1) * y + y_trans
 
     # Generate warp file as a warping field
     hdr_warp.set_intent('vector', (), '')
@@ -418,3 +453,30 @@ def generate_warping_field(im_dest, x_trans, y_trans, theta_rot=None, center_rot
     nibabel.save(img, fname)
     sct.printv('\nDONE ! Warping field generated: '+fname, verbose)
 
+
+def merge_warping_fields(list_fname_slice, im_ref, fname='warping_field.nii.gz'):
+    """Merge 2D warping fields (one per slice) into a 3D warping field.
+
+    Displacements of each 2D field (as written by antsRegistration or isct_ComposeMultiTransform) are stacked along z in
+    one array, and the 3D field is written once with the geometry of the reference image (the displacement along z is
+    null).
+
+    inputs:
+        list_fname_slice: names of the 2D warping fields, in the order of slices (type: list, length: height of im_ref)
+        im_ref: name of reference image (type: string)
+        fname[optional]: name of output warp (type: string)
+
+    output:
+        creation of a warping field of name 'fname' with an header similar to the reference image.
+    """
+    from nibabel import load
+
+    nx, ny = load(list_fname_slice[0]).shape[0:2]
+    data_warp = zeros((nx, ny, len(list_fname_slice), 1, 3), dtype='float32')
+    for k, fname_slice in enumerate(list_fname_slice):
+        data_warp[:, :, k, 0, 0:2] = asarray(load(fname_slice).get_data()).reshape(nx, ny, -1)[:, :, 0:2]
+
+    hdr_warp = load(im_ref).get_header().copy()
+    hdr_warp.set_intent('vector', (), '')
+    hdr_warp.set_data_dtype('float32')
+    nibabel.save(nibabel.Nifti1Image(data_warp, None, hdr_warp), fname)
@@ -352,19 +352,10 @@ def b_spline_nurbs_itk(fname_centerline, numberOfLevels=10):
 # get size
 #=======================================================================================================================
 def getSize(x, y, z, file_name=None):
-    from commands import getstatusoutput
     from math import sqrt
     # get pixdim
     if file_name is not None:
-        cmd1 = 'fslval '+file_name+' pixdim1'
-        status, output = getstatusoutput(cmd1)
-        p1 = float(output)
-        cmd2 = 'fslval '+file_name+' pixdim2'
-        status, output = getstatusoutput(cmd2)
-        p2 = float(output)
-        cmd3 = 'fslval '+file_name+' pixdim3'
-        status, output = getstatusoutput(cmd3)
-        p3 = float(output)
+        p1, p2, p3 = getPxDimensions(file_name)
     else:
         p1, p2, p3 = 1.0, 1.0, 1.0
 
@@ -381,16 +372,7 @@ def getSize(x, y, z, file_name=None):
 # functions to get centerline size
 #=======================================================================================================================
 def getPxDimensions(file_name):
-    from commands import getstatusoutput
-    cmd1 = 'fslval '+file_name+' pixdim1'
-    status, output = getstatusoutput(cmd1)
-    p1 = float(output)
-    cmd2 = 'fslval '+file_name+' pixdim2'
-    status, output = getstatusoutput(cmd2)
-    p2 = float(output)
-    cmd3 = 'fslval '+file_name+' pixdim3'
-    status, output = getstatusoutput(cmd3)
-    p3 = float(output)
+    nx, ny, nz, nt, p1, p2, p3, pt = sct.get_dimension(file_name)
     return p1, p2, p3
 
 
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# msct_vertebral_levels
+# Index of a vertebral labeling (e.g. MNI-Poly-AMU_level.nii.gz warped by sct_warp_template): first slice, last slice
+# and number of voxels of each vertebral level, in RPI orientation.
+#
+# The index is computed in one pass (ndimage.find_objects) and stored next to the vertebral labeling (file
+# <labeling>_index.json). It is reused as long as the vertebral labeling is not modified.
+#
+# USAGE
+# vertebral_levels = VertebralLevels('label/template/MNI-Poly-AMU_level.nii.gz')
+# slices, actual_levels, warning = vertebral_levels.get_slices('2:4')
+# for level in vertebral_levels.levels: vertebral_levels.zmin[level], vertebral_levels.zmax[level], ...
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2015 Polytechnique Montreal <www.neuro.polymtl.ca>
+# Created: 2015-08-20
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import json
+import numpy as np
+import sct_utils as sct
+
+
+class VertebralLevels(object):
+    def __init__(self, fname, verbose=1):
+        """
+        Load the index of a vertebral labeling (it is computed first if needed).
+        :param fname: vertebral labeling (voxel value = vertebral level, 0 outside of the vertebral levels)
+        """
+        self.fname = os.path.abspath(fname)
+        self.verbose = verbose
+        self.shape = None  # dimensions of the vertebral labeling in RPI orientation
+        self.levels = []  # vertebral levels available, in ascending order
+        self.zmin, self.zmax, self.nb_voxels = dict(), dict(), dict()  # level -> first slice, last slice, number of voxels
+
+        path, file, ext = sct.extract_fname(self.fname)
+        fname_index = path+file+'_index.json'
+        key = [file+ext, os.path.getmtime(self.fname), os.path.getsize(self.fname)]
+        if os.path.isfile(fname_index) and self.load(fname_index, key):
+            return
+        self.compute()
+        try:
+            self.save(fname_index, key)
+        except (IOError, OSError):
+            pass
+
+    def compute(self):
+        from scipy import ndimage
+        from msct_image import Image
+
+        sct.printv('.. Index vertebral levels: '+self.fname, self.verbose)
+        image = Image(self.fname, verbose=0)
+        image.change_orientation('RPI')
+        data = np.round(image.data).astype(int)
+        data[data < 0] = 0
+        self.shape = data.shape[0:3]
+        nb_voxels = np.bincount(data.ravel())
+        for i, bounding_box in enumerate(ndimage.find_objects(data)):
+            if bounding_box is not None:
+                level = i + 1
+                self.levels.append(level)
+                self.zmin[level], self.zmax[level] = bounding_box[2].start, bounding_box[2].stop - 1
+                self.nb_voxels[level] = int(nb_voxels[level])
+
+    def load(self, fname_index, key):
+        """Load an index. Return False if it does not match the current vertebral labeling."""
+        try:
+            with open(fname_index) as f:
+                index = json.load(f)
+            if index['key'] != key:
+                return False
+            self.shape = tuple(index['shape'])
+            self.levels = [int(level) for level, zmin, zmax, nb_voxels in index['levels']]
+            for level, zmin, zmax, nb_voxels in index['levels']:
+                self.zmin[level], self.zmax[level], self.nb_voxels[level] = zmin, zmax, nb_voxels
+        except (IOError, KeyError, ValueError):
+            return False
+        return True
+
+    def save(self, fname_index, key):
+        index = {'key': key, 'shape': self.shape,
+                 'levels': [[level, self.zmin[level], self.zmax[level], self.nb_voxels[level]] for level in self.levels]}
+
+        def write_index(fname_tmp):
+            with open(fname_tmp, 'w') as f:
+                json.dump(index, f)
+        sct.write_atomic(fname_index, write_index)
+
+    def get_slices(self, vertebral_levels):
+        """
+        Return the slices (RPI orientation) corresponding to a range of vertebral levels. Levels that are not available
+        are replaced with the nearest available ones.
+        :param vertebral_levels: string, e.g. '2:4' (or '3' for one level)
+        :return: slices, vert_levels_list, warning: slices as a string 'zmin:zmax', selected levels [start, end] and
+        list of warnings (strings) if the selected levels are different from the asked ones
+        """
+        # Convert the selected vertebral levels chosen into a 2-element list [start_level end_level]
+        vert_levels_list = [int(x) for x in vertebral_levels.split(':')]
+
+        # If only one vertebral level was selected (n), consider as n:n
+        if len(vert_levels_list) == 1:
+            vert_levels_list = [vert_levels_list[0], vert_levels_list[0]]
+
+        # Check if there are only two values [start_level, end_level] and if the end level is higher than the start level
+        if (len(vert_levels_list) > 2) or (vert_levels_list[0] > vert_levels_list[1]):
+            sct.printv('\nERROR:  "' + vertebral_levels + '" is not correct. Enter format "1:4". Exit program.\n', 1, 'error')
+
+        # Check if the vertebral levels selected are available
+        vertebral_levels_available = np.array(self.levels)
+        warning = []  # list of strings gathering the potential warning(s) to be written in the output .txt file
+        if vert_levels_list[0] < vertebral_levels_available.min():
+            vert_levels_list[0] = vertebral_levels_available.min()
+            warning.append('WARNING: the bottom vertebral level you selected is lower to the lowest level available --> '
+                           'Selected the lowest vertebral level available: ' + str(int(vert_levels_list[0])))
+
+        if vert_levels_list[1] > vertebral_levels_available.max():
+            vert_levels_list[1] = vertebral_levels_available.max()
+            warning.append('WARNING: the top vertebral level you selected is higher to the highest level available --> '
+                           'Selected the highest vertebral level available: ' + str(int(vert_levels_list[1])))
+
+        if vert_levels_list[0] not in vertebral_levels_available:
+            # nearest inferior level available
+            vert_levels_list[0] = vertebral_levels_available[vertebral_levels_available < vert_levels_list[0]].max()
+            warning.append('WARNING: the bottom vertebral level you selected is not available --> Selected the nearest '
+                           'inferior level available: ' + str(int(vert_levels_list[0])))
+
+        if vert_levels_list[1] not in vertebral_levels_available:
+            # nearest superior level available
+            vert_levels_list[1] = vertebral_levels_available[vertebral_levels_available > vert_levels_list[1]].min()
+            warning.append('WARNING: the top vertebral level you selected is not available --> Selected the nearest '
+                           'superior level available: ' + str(int(vert_levels_list[1])))
+
+        for w in warning:
+            sct.printv(w, self.verbose, 'warning')
+
+        # Take into account the case where the ordering of the slice is reversed compared to the ordering of the
+        # vertebral levels (usually the case) and if several slices include two different vertebral levels
+        level_bottom, level_top = vert_levels_list
+        if self.zmin[level_bottom] >= self.zmin[level_top] or self.zmax[level_bottom] >= self.zmax[level_top]:
+            slice_min, slice_max = self.zmin[level_top], self.zmax[level_bottom]
+        else:
+            slice_min, slice_max = self.zmin[level_bottom], self.zmax[level_top]
+        sct.printv('  Vertebral levels '+str(level_bottom)+' to '+str(level_top)+': slices '+str(slice_min)+':'+str(slice_max), self.verbose)
+
+        return str(slice_min)+':'+str(slice_max), vert_levels_list, warning
+
+    def get_all_levels(self):
+        """Return the selection of each available level (e.g. ['2:2', '3:3', ...]), to be used with get_slices()."""
+        return [str(level)+':'+str(level) for level in self.levels]
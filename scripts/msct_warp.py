@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# msct_warp
+# Apply a chain of transformations (ANTs/ITK displacement fields and affine transformations) without calling
+# isct_antsApplyTransforms.
+#
+# The chain is given as for isct_antsApplyTransforms (-t): the last transformation is applied first to the points of
+# the destination space. It is composed once into a sampling grid (physical position in the source space of each voxel
+# of the destination image), which is reused for all the volumes of a 4D image and for all the images sharing the same
+# chain and destination. Volumes are then resampled one by one with scipy.ndimage.map_coordinates (nn, linear or
+# spline) and written into the output 4D array.
+# Supported transformations: displacement fields (NIfTI, 5D vector image) and affine transformations (.txt and .mat,
+# AffineTransform or MatrixOffsetTransformBase, optionally inverted with "-i "). See is_supported().
+#
+# USAGE
+# warping_chain = WarpingChain(['warp_template2anat.nii.gz', '-i affine.mat'], 'dest.nii.gz')
+# warping_chain.apply('src.nii.gz', 'src_reg.nii.gz', interp='spline')
+# warping_chain.apply_many(['a.nii.gz', 'b.nii.gz'], ['a_reg.nii.gz', 'b_reg.nii.gz'], ['nn', 'linear'])
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2015 Polytechnique Montreal <www.neuro.polymtl.ca>
+# Created: 2015-08-24
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import numpy as np
+import sct_utils as sct
+
+# spline order used by map_coordinates for each interpolation method of sct_apply_transfo
+order_interp = {'nn': 0, 'linear': 1, 'spline': 3}
+# ITK affine transformations defined by a 3x3 matrix, a translation and a center (12 parameters + 3 fixed parameters)
+itk_affine_types = ['AffineTransform', 'MatrixOffsetTransformBase']
+# nibabel affines are in RAS, ITK physical coordinates are in LPS
+ras2lps = np.diag([-1., -1., 1., 1.])
+
+
+class WarpingChain(object):
+    def __init__(self, list_transfo, fname_dest, verbose=1):
+        """
+        :param list_transfo: transformations, as given to isct_antsApplyTransforms (-t). Prefix "-i " inverts an affine
+        transformation.
+        :param fname_dest: destination image (defines the output space)
+        """
+        from nibabel import load
+
+        self.list_transfo = list(list_transfo)
+        self.fname_dest = fname_dest
+        self.verbose = verbose
+        image_dest = load(fname_dest)
+        self.header_dest = image_dest.get_header()
+        self.shape = image_dest.shape[0:3]
+        self.affine_dest = ras2lps.dot(image_dest.get_affine())
+        self.points = None  # physical position (LPS) in the source space of each voxel of destination: array [3 x nb_voxels]
+        self.coordinates = dict()  # voxel coordinates in the source space, by source affine
+
+    def get_points(self):
+        """Compose all transformations into the sampling grid (computed once)."""
+        if self.points is None:
+            sct.printv('.. Compose '+str(len(self.list_transfo))+' transformation(s) on the destination space '+str(self.shape), self.verbose)
+            voxels = np.indices(self.shape, dtype=float).reshape(3, -1)
+            points = self.affine_dest[0:3, 0:3].dot(voxels) + self.affine_dest[0:3, 3:4]
+            del voxels
+            for transfo in reversed(self.list_transfo):
+                inverse, fname = parse_transfo(transfo)
+                if sct.extract_fname(fname)[2] in ['.txt', '.mat']:
+                    matrix, translation, center = read_itk_affine(fname)
+                    if inverse:
+                        points = np.linalg.inv(matrix).dot(points - (center + translation)[:, np.newaxis]) + center[:, np.newaxis]
+                    else:
+                        points = matrix.dot(points - center[:, np.newaxis]) + (center + translation)[:, np.newaxis]
+                else:
+                    if inverse:
+                        sct.printv('ERROR: displacement fields cannot be inverted: '+fname, 1, 'error')
+                    points += sample_displacement_field(fname, points)
+            self.points = points
+        return self.points
+
+    def get_coordinates(self, affine_src, shape_src):
+        """Voxel coordinates in the source image of each voxel of the destination image (see voxels_in_grid)."""
+        key = (affine_src.tostring(), tuple(shape_src[0:3]))
+        if key not in self.coordinates:
+            self.coordinates[key] = voxels_in_grid(affine_src, shape_src, self.get_points())
+        return self.coordinates[key]
+
+    def apply(self, fname_src, fname_out, interp='spline'):
+        """
+        Resample a 3D or 4D image in the destination space (volume by volume). Outside of the source image, values are 0.
+        :param interp: 'nn', 'linear' or 'spline'
+        """
+        from nibabel import save
+        save(self.resample(fname_src, interp), fname_out)
+
+    def apply_many(self, list_fname_src, list_fname_out, list_interp, nb_workers=None):
+        """
+        Resample several images through the same sampling grid (see apply). While an image is resampled, the previous
+        ones are written (and compressed) by concurrent threads.
+        :param nb_workers: number of writing threads. Default: see sct_utils.get_nb_workers
+        """
+        import threading
+        import Queue
+        from nibabel import save
+
+        if nb_workers is None:
+            nb_workers = sct.get_nb_workers()
+        nb_workers = max(1, min(int(nb_workers), len(list_fname_src)))
+        # bounded queue: at most nb_workers resampled images wait to be written
+        queue = Queue.Queue(maxsize=nb_workers)
+        errors = []
+
+        def writer():
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                try:
+                    save(*item)
+                except Exception, e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=writer) for i in range(nb_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for fname_src, fname_out, interp in zip(list_fname_src, list_fname_out, list_interp):
+                queue.put((self.resample(fname_src, interp), fname_out))
+        finally:
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+    def resample(self, fname_src, interp='spline'):
+        """Resample a 3D or 4D image in the destination space (see apply). Return a nibabel image."""
+        from nibabel import load, Nifti1Image
+        from scipy.ndimage import map_coordinates
+
+        image_src = load(fname_src)
+        coordinates = self.get_coordinates(image_src.get_affine(), image_src.shape)
+        is_4d = len(image_src.shape) > 3
+        nt = image_src.shape[3] if is_4d else 1
+        data_out = np.zeros(self.shape+(nt,), dtype=np.float32)
+        sct.printv('.. Resample '+fname_src+' ('+str(nt)+' volume(s), interpolation: '+interp+')', self.verbose)
+        for it in range(nt):
+            data_src = np.asarray(image_src.dataobj[..., it] if is_4d else image_src.dataobj[...]).astype(np.float64)
+            data_out[..., it] = map_coordinates(data_src, coordinates, order=order_interp[interp], mode='constant', cval=0.).reshape(self.shape)
+        if not is_4d:
+            data_out = data_out[..., 0]
+
+        header_out = self.header_dest.copy()
+        header_out.set_data_dtype(np.float32)
+        image_out = Nifti1Image(data_out, None, header_out)
+        if is_4d:
+            image_out.get_header().set_zooms(self.header_dest.get_zooms()[0:3]+image_src.get_header().get_zooms()[3:4])
+        return image_out
+
+
+def parse_transfo(transfo):
+    """Return (inverse, file name) of a transformation given as for isct_antsApplyTransforms (e.g. '-i affine.mat')."""
+    transfo = transfo.strip()
+    if transfo.startswith('-i '):
+        return True, transfo[3:].strip()
+    return False, transfo
+
+
+def is_supported(list_transfo):
+    """Return True if all transformations can be applied by WarpingChain (otherwise, use isct_antsApplyTransforms)."""
+    from nibabel import load
+
+    for transfo in list_transfo:
+        inverse, fname = parse_transfo(transfo)
+        try:
+            if sct.extract_fname(fname)[2] in ['.txt', '.mat']:
+                read_itk_affine(fname)
+            else:
+                shape = load(fname).shape
+                if inverse or len(shape) != 5 or shape[3] != 1 or shape[4] != 3:
+                    return False
+        except Exception:
+            return False
+    return True
+
+
+def read_itk_affine(fname):
+    """
+    Read a 3D affine transformation written by ITK/ANTs (text or Matlab format).
+    :return: matrix [3 x 3], translation [3], center [3]: T(x) = matrix.(x - center) + center + translation
+    """
+    if sct.extract_fname(fname)[2] == '.mat':
+        from scipy.io import loadmat
+        content = loadmat(fname)
+        names = [name for name in content if name.split('_')[0] in itk_affine_types and name.endswith('_3_3')]
+        if not names or 'fixed' not in content:
+            raise ValueError('Unsupported transformation: '+fname)
+        parameters, fixed_parameters = np.ravel(content[names[0]]), np.ravel(content['fixed'])
+    else:
+        fields = dict()
+        for line in open(fname):
+            if ':' in line:
+                name, value = line.split(':', 1)
+                fields[name.strip()] = value.strip()
+        if fields.get('Transform', '').split('_')[0] not in itk_affine_types or not fields['Transform'].endswith('_3_3'):
+            raise ValueError('Unsupported transformation: '+fname)
+        parameters = np.array([float(v) for v in fields['Parameters'].split()])
+        fixed_parameters = np.array([float(v) for v in fields.get('FixedParameters', '0 0 0').split()])
+    if len(parameters) != 12 or len(fixed_parameters) != 3:
+        raise ValueError('Unsupported transformation: '+fname)
+    return parameters[0:9].reshape(3, 3).astype(float), parameters[9:12].astype(float), fixed_parameters.astype(float)
+
+
+def sample_displacement_field(fname, points):
+    """
+    Linear interpolation of a displacement field at physical points (LPS). Outside of the field, the displacement is null.
+    :return: displacements: array [3 x nb_points]
+    """
+    from nibabel import load
+    from scipy.ndimage import map_coordinates
+
+    image_field = load(fname)
+    voxels = voxels_in_grid(image_field.get_affine(), image_field.shape, points)
+    data_field = np.asarray(image_field.dataobj)
+    displacements = np.empty(points.shape)
+    for i in range(3):
+        displacements[i] = map_coordinates(np.asarray(data_field[:, :, :, 0, i], dtype=np.float64), voxels, order=1, mode='constant', cval=0.)
+    return displacements
+
+
+def voxels_in_grid(affine, shape, points):
+    """
+    Voxel coordinates of physical points (LPS) in an image. As in ITK, points less than half a voxel away from the grid
+    are inside the image: they are moved to the border of the grid.
+    :param affine: affine of the image (nibabel, RAS)
+    :return: voxels: array [3 x nb_points]
+    """
+    affine_lps_inv = np.linalg.inv(ras2lps.dot(affine))
+    voxels = affine_lps_inv[0:3, 0:3].dot(points) + affine_lps_inv[0:3, 3:4]
+    for i, n in enumerate(shape[0:3]):
+        voxels[i][(voxels[i] < 0) & (voxels[i] >= -0.5)] = 0
+        voxels[i][(voxels[i] > n - 1) & (voxels[i] <= n - 0.5)] = n - 1
+    return voxels
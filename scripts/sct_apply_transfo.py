@@ -22,10 +22,11 @@ import time
 from msct_parser import Parser
 import sct_utils as sct
 from sct_crop_image import ImageCropper
+from msct_warp import WarpingChain, is_supported
 
 
 class Transform:
-    def __init__(self,input_filename, warp, output_filename, source_reg='', verbose=0, crop=0, interp='spline', remove_temp_files=1, debug=0):
+    def __init__(self,input_filename, warp, output_filename, source_reg='', verbose=0, crop=0, interp='spline', remove_temp_files=1, debug=0, engine='auto'):
         self.input_filename = input_filename
         if isinstance(warp, str):
             self.warp_input = list([warp])
@@ -38,6 +39,7 @@ class Transform:
         self.verbose = verbose
         self.remove_temp_files = remove_temp_files
         self.debug = debug
+        self.engine = engine  # 'native' (msct_warp), 'ants' (isct_antsApplyTransforms) or 'auto' (native for 4D data)
 
     def apply(self):
         # Initialization
@@ -116,8 +118,18 @@ class Transform:
         nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension(fname_src)
         sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz)+ ' x ' + str(nt), verbose)
 
+        # choose the engine: for 4D data, the native engine composes the transformations once for all volumes
+        use_native = self.engine == 'native' or (self.engine == 'auto' and nt > 1)
+        if use_native and not is_supported(fname_warp_list_invert):
+            sct.printv('WARNING: transformations not supported by the native engine. Use isct_antsApplyTransforms.', verbose, 'warning')
+            use_native = False
+
+        if use_native:
+            sct.printv('\nApply transformation (native engine)...', verbose)
+            WarpingChain(fname_warp_list_invert, fname_dest, verbose).apply(fname_src, fname_out, self.interp)
+
         # if 3d
-        if nt == 1:
+        elif nt == 1:
             # Apply transformation
             sct.printv('\nApply transformation...', verbose)
             sct.run('isct_antsApplyTransforms -d 3 -i '+fname_src+' -o '+fname_out+' -t '+' '.join(fname_warp_list_invert)+' -r '+fname_dest+interp, verbose)
@@ -126,7 +138,7 @@ class Transform:
         else:
             # create temporary folder
             sct.printv('\nCreate temporary folder...', verbose)
-            path_tmp = sct.slash_at_the_end('tmp.'+time.strftime("%y%m%d%H%M%S"), 1)
+            path_tmp = sct.slash_at_the_end('tmp.'+time.strftime("%y%m%d%H%M%S")+'_'+str(os.getpid()), 1)  # pid: concurrent calls may start in the same second
             # sct.run('mkdir '+path_tmp, verbose)
             sct.run('mkdir '+path_tmp, verbose)
 
@@ -148,10 +160,13 @@ class Transform:
                 sct.run(fsloutput+'fslsplit data data_T', verbose)
                 # apply transfo
                 sct.printv('\nApply transformation to each 3D volume...', verbose)
+                list_cmd = []
                 for it in range(nt):
                     file_data_split = 'data_T'+str(it).zfill(4)+'.nii'
                     file_data_split_reg = 'data_reg_T'+str(it).zfill(4)+'.nii'
-                    sct.run('isct_antsApplyTransforms -d 3 -i '+file_data_split+' -o '+file_data_split_reg+' -t '+' '.join(fname_warp_list_invert)+' -r dest'+ext_dest+interp, verbose)
+                    list_cmd.append('isct_antsApplyTransforms -d 3 -i '+file_data_split+' -o '+file_data_split_reg+' -t '+' '.join(fname_warp_list_invert)+' -r dest'+ext_dest+interp)
+                # volumes are independent: run them concurrently
+                sct.run_many(list_cmd, verbose, ram_per_job=get_ram_per_job('dest'+ext_dest, fname_warp_list))
 
                 # Merge files back
                 sct.printv('\nMerge file back...', verbose)
@@ -192,6 +207,23 @@ class Transform:
         sct.printv('fslview '+fname_dest+' '+fname_out+' &\n', verbose, 'info')
 
 
+#=======================================================================================================================
+# get_ram_per_job: memory used by one isct_antsApplyTransforms command
+#=======================================================================================================================
+def get_ram_per_job(fname_dest, fname_warp_list):
+    """
+    Memory (in GB) of the destination and output volumes, and of the displacement fields (3 components), in double.
+    Affine transformations (.txt, .mat) are negligible.
+    """
+    nx, ny, nz = sct.get_dimension(fname_dest)[0:3]
+    nb_voxels = 2 * nx * ny * nz
+    for warp in fname_warp_list:
+        if sct.extract_fname(warp)[2] in ['.nii', '.nii.gz']:
+            nx_w, ny_w, nz_w = sct.get_dimension(warp)[0:3]
+            nb_voxels += 3 * nx_w * ny_w * nz_w
+    return nb_voxels * 8 / 1024.**3
+
+
 if __name__ == "__main__":
 
     # Initialize parser
@@ -232,6 +264,12 @@ if __name__ == "__main__":
                       mandatory=False,
                       default_value='spline',
                       example=['nn','linear','spline'])
+    parser.add_option(name="-e",
+                      type_value="multiple_choice",
+                      description="""Engine. native: transformations are composed once and all volumes are resampled in-process (scipy). ants: isct_antsApplyTransforms (one call per volume). auto: native for 4D data, ants for 3D data.""",
+                      mandatory=False,
+                      default_value='auto',
+                      example=['auto', 'native', 'ants'])
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -259,6 +297,8 @@ if __name__ == "__main__":
         transform.source_reg = arguments["-o"]
     if "-x" in arguments:
         transform.interp = arguments["-x"]
+    if "-e" in arguments:
+        transform.engine = arguments["-e"]
     if "-r" in arguments:
         transform.remove_temp_files = arguments["-r"]
     if "-v" in arguments:
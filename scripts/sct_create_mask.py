@@ -22,7 +22,7 @@ import sct_utils as sct
 import time
 import numpy
 import nibabel
-from scipy import ndimage
+from msct_centerline import Centerline
 from sct_orientation import get_orientation, set_orientation
 
 
@@ -196,14 +196,10 @@ def create_mask():
     centerline = nibabel.load(fname_centerline)  # open centerline
     hdr = centerline.get_header()  # get header
     hdr.set_data_dtype('uint8')  # set imagetype to uint8
-    data_centerline = centerline.get_data()  # get centerline
-    z_centerline = [iz for iz in range(0, nz, 1) if data_centerline[:, :, iz].any()]
-    nz = len(z_centerline)
     # get center of mass of the centerline
-    cx = [0] * nz
-    cy = [0] * nz
-    for iz in range(0, nz, 1):
-        cx[iz], cy[iz] = ndimage.measurements.center_of_mass(numpy.array(data_centerline[:, :, z_centerline[iz]]))
+    centerline = Centerline(fname_centerline)
+    cx, cy = centerline.x, centerline.y
+    nz = len(centerline.z)
     # create 2d masks
     file_mask = 'data_mask'
     for iz in range(nz):
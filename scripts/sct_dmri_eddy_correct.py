@@ -25,6 +25,7 @@ status, path_sct = commands.getstatusoutput('echo $SCT_DIR')
 # append path that contains scripts, to be able to load modules
 sys.path.append(path_sct + '/scripts')
 import sct_utils as sct
+import msct_moco as moco
 
 
 fsloutput = 'export FSLOUTPUTTYPE=NIFTI; '  # for faster processing, all outputs are in NIFTI
@@ -45,6 +46,7 @@ class Param:
         self.merge_back                = 1
         self.verbose                   = 0
         self.plot_graph                = 0
+        self.nb_workers                = None                     # number of FLIRT jobs run concurrently (None: see sct_utils.get_nb_workers)
 
 
 #=======================================================================================================================
@@ -55,7 +57,7 @@ def main():
 
     # Check input parameters
     try:
-        opts, args = getopt.getopt(sys.argv[1:],'hi:c:b:g:m:o:p:r:s:v:')
+        opts, args = getopt.getopt(sys.argv[1:],'hi:c:b:g:m:n:o:p:r:s:v:')
     except getopt.GetoptError:
         usage()
     if not opts:
@@ -73,6 +75,8 @@ def main():
             param.plot_graph = int(arg)
         elif opt in ('-m'):
             param.mat_eddy = arg
+        elif opt in ('-n'):
+            param.nb_workers = int(arg)
         elif opt in ('-o'):
             param.output_path = arg
         elif opt in ('-p'):
@@ -151,16 +155,19 @@ def eddy_correct(param):
     else:
         fname_data_new = fname_data
 
-    # Get size of data
-    sct.printv('\nGet dimensions data...',verbose)
-    nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension(fname_data)
+    # Load data (volumes and slices are extracted in memory)
+    sct.printv('\nLoad data...',verbose)
+    from nibabel import load
+    # FSL-style file names may have no extension
+    fname_data_nifti = sct.find_nifti_file(fname_data_new)
+    if fname_data_nifti == '':
+        sct.printv('ERROR: '+fname_data_new+' does not exist.', 1, 'error')
+    image = load(fname_data_nifti)
+    data = np.asarray(image.dataobj)
+    header, affine = image.get_header(), image.get_affine()
+    nx, ny, nz, nt = data.shape[0:4]
     sct.printv('.. '+str(nx)+' x '+str(ny)+' x '+str(nz)+' x '+str(nt),verbose)
 
-    # split along T dimension
-    sct.printv('\nSplit along T dimension...',verbose)
-    cmd = fsloutput + 'fslsplit ' + fname_data_new + ' ' + file_data + '_T'
-    status, output = sct.run(cmd,verbose)
-
     #Slice-wise or Volume based method
     if param.slicewise:
         nb_loops = nz
@@ -214,61 +221,47 @@ def eddy_correct(param):
     # =========================================================================
     #	Find transformation
     # =========================================================================
+    # pairs (and slices) are independent: FLIRT jobs are run concurrently
+    sct.printv('\nFind transformation for each pair of opposite gradient directions...',verbose)
+    list_cmd, list_omat = [], []
     for iN in range(nb_oppositeGradients):
         i_plus = opposite_gradients_iT[iN]
         i_minus = opposite_gradients_jT[iN]
-
-        sct.printv(('\nFinding affine transformation between volumes #'+str(i_plus)+' and #'+str(i_minus)+' (' + str(iN)+'/'+str(nb_oppositeGradients)+')'),verbose)
-        sct.printv('------------------------------------------------------------------------------------\n',verbose)
-        
-        #Slicewise correction
-        if param.slicewise:
-            sct.printv('\nSplit volumes across Z...',verbose)
-            fname_plus = file_data + '_T' + str(i_plus).zfill(4)
-            fname_plus_Z = file_data + '_T' + str(i_plus).zfill(4) + '_Z'
-            cmd = fsloutput + 'fslsplit ' + fname_plus + ' ' + fname_plus_Z + ' -z'
-            status, output = sct.run(cmd,verbose)
-
-            fname_minus = file_data + '_T' + str(i_minus).zfill(4)
-            fname_minus_Z = file_data + '_T' + str(i_minus).zfill(4) + '_Z'
-            cmd = fsloutput + 'fslsplit ' + fname_minus + ' ' + fname_minus_Z + ' -z'
-            status, output = sct.run(cmd,verbose)
-
-        #loop across Z
         for iZ in range(nb_loops):
             fname_plus = file_data + '_T' + str(i_plus).zfill(4) + file_suffix[iZ]
-
             fname_minus = file_data + '_T' + str(i_minus).zfill(4) + file_suffix[iZ]
-            #Find transformation on opposite gradient directions
-            sct.printv('\nFind transformation for each pair of opposite gradient directions...',verbose)
-            fname_plus_corr = file_data + '_T' + str(i_plus).zfill(4) + file_suffix[iZ] + '_corr_'
-            omat = 'mat_' + file_data + '_T' + str(i_plus).zfill(4) + file_suffix[iZ] + '.txt'
-            cmd = fsloutput+'flirt -in '+fname_plus+' -ref '+fname_minus+' -paddingsize 3 -schedule '+schedule_file+' -verbose 2 -omat '+omat+' -cost '+cost_function+' -forcescaling'
-            status, output = sct.run(cmd,verbose)
-
-            file =  open(omat)
-            Matrix = np.loadtxt(file)
-            file.close()
-            M = Matrix[0:4,0:4]
-            sct.printv(('.. Transformation matrix:\n'+str(M)),verbose)
-            sct.printv(('.. Output matrix file: '+omat),verbose)
-
-            # Divide affine transformation by two
-            sct.printv('\nDivide affine transformation by two...',verbose)
-            A = (M - np.identity(4))/2
-            Mplus = np.identity(4)+A
-            omat_plus = mat_eddy + 'mat.T' + str(i_plus) + '_Z' + str(iZ) + '.txt'
-            file =  open(omat_plus,'w')
-            np.savetxt(omat_plus, Mplus, fmt='%.6e', delimiter='  ', newline='\n', header='', footer='', comments='#')
-            file.close()
-            sct.printv(('.. Output matrix file (plus): '+omat_plus),verbose)
-
-            Mminus = np.identity(4)-A
-            omat_minus = mat_eddy + 'mat.T' + str(i_minus) + '_Z' + str(iZ) + '.txt'
-            file =  open(omat_minus,'w')
-            np.savetxt(omat_minus, Mminus, fmt='%.6e', delimiter='  ', newline='\n', header='', footer='', comments='#')
-            file.close()
-            sct.printv(('.. Output matrix file (minus): '+omat_minus),verbose)
+            for it, fname in [(i_plus, fname_plus), (i_minus, fname_minus)]:
+                if param.slicewise:
+                    # origin of the slice
+                    affine_slice = affine.copy()
+                    affine_slice[:, 3] = affine.dot([0, 0, iZ, 1])
+                    moco.save_volumes(data[:, :, iZ:iZ+1, it], header, fname+'.nii', affine_slice)
+                else:
+                    moco.save_volumes(data[:, :, :, it], header, fname+'.nii')
+            omat = 'mat_' + fname_plus + '.txt'
+            list_cmd.append(fsloutput+'flirt -in '+fname_plus+' -ref '+fname_minus+' -paddingsize 3 -schedule '+schedule_file+' -verbose 2 -omat '+omat+' -cost '+cost_function+' -forcescaling')
+            list_omat.append((i_plus, i_minus, iZ, omat))
+    sct.printv('.. '+str(len(list_cmd))+' jobs ('+str(nb_oppositeGradients)+' pairs x '+str(nb_loops)+' slice(s))',verbose)
+    # memory of one FLIRT job (in GB): process overhead, and about 6 images (input, reference, resampled images of the
+    # schedule) of the size of a job (one slice or one volume), in float
+    ram_per_job = 0.1 + 6 * nx * ny * (nz // nb_loops) * 4 / 1024.**3
+    sct.run_many(list_cmd, verbose, nb_workers=param.nb_workers, ram_per_job=ram_per_job)
+
+    # Divide affine transformations by two. Matrices of all volumes and slices are stored in one array (see
+    # msct_moco.save_mat), volumes without opposite gradient are flagged as failed.
+    sct.printv('\nDivide affine transformations by two...',verbose)
+    matrices = np.tile(np.identity(4), (nt, nb_loops, 1, 1))
+    failed = np.ones((nt, nb_loops), dtype=bool)
+    for i_plus, i_minus, iZ, omat in list_omat:
+        M = np.loadtxt(omat)[0:4,0:4]
+        sct.printv(('.. Transformation matrix (#'+str(i_plus)+', #'+str(i_minus)+', Z'+str(iZ)+'):\n'+str(M)),verbose)
+        A = (M - np.identity(4))/2
+        matrices[i_plus, iZ] = np.identity(4)+A
+        matrices[i_minus, iZ] = np.identity(4)-A
+        failed[i_plus, iZ] = failed[i_minus, iZ] = False
+    moco.save_mat(mat_eddy, matrices, failed)
+    # FLIRT needs text files to apply the transformations
+    moco.export_mat(mat_eddy, verbose)
 
     # =========================================================================
     #	Apply affine transformation
@@ -277,64 +270,34 @@ def eddy_correct(param):
     sct.printv('\nApply affine transformation matrix',verbose)
     sct.printv('------------------------------------------------------------------------------------\n',verbose)
 
+    list_cmd, list_corr = [], []
     for iN in range(nb_oppositeGradients):
-        for iFile in range(2):
-            if iFile==0:
-                i_file = opposite_gradients_iT[iN]
-            else:
-                i_file = opposite_gradients_jT[iN]
-
+        for i_file in [opposite_gradients_iT[iN], opposite_gradients_jT[iN]]:
             for iZ in range(nb_loops):
                 fname = file_data + '_T' + str(i_file).zfill(4) + file_suffix[iZ]
                 fname_corr = fname + '_corr_' + '__div2'
                 omat = mat_eddy + 'mat.T' + str(i_file) + '_Z' + str(iZ) + '.txt'
-                cmd = fsloutput + 'flirt -in ' + fname + ' -ref ' + fname + ' -out ' + fname_corr + ' -init ' + omat + ' -applyxfm -paddingsize 3 -interp ' + param.interp
-                status, output = sct.run(cmd,verbose)
+                list_cmd.append(fsloutput + 'flirt -in ' + fname + ' -ref ' + fname + ' -out ' + fname_corr + ' -init ' + omat + ' -applyxfm -paddingsize 3 -interp ' + param.interp)
+                list_corr.append((i_file, iZ, fname_corr))
+    sct.run_many(list_cmd, verbose, nb_workers=param.nb_workers, ram_per_job=ram_per_job)
 
-    
     # =========================================================================
-    #	Merge back across Z
+    #	Merge corrected volumes (and slices)
     # =========================================================================
-
-    sct.printv('\nMerge across Z',verbose)
+    sct.printv('\nMerge corrected volumes...',verbose)
     sct.printv('------------------------------------------------------------------------------------\n',verbose)
 
-    for iN in range(nb_oppositeGradients):
-        i_plus = opposite_gradients_iT[iN]
-        fname_plus_corr = file_data + '_T' + str(i_plus).zfill(4) + '_corr_' + '__div2'
-        cmd = fsloutput + 'fslmerge -z ' + fname_plus_corr
-
-        for iZ in range(nz):
-            fname_plus_Z_corr = file_data + '_T' + str(i_plus).zfill(4) + file_suffix[iZ] + '_corr_' + '__div2'
-            cmd = cmd + ' ' + fname_plus_Z_corr
-        status, output = sct.run(cmd,verbose)
-
-        i_minus = opposite_gradients_jT[iN]
-        fname_minus_corr = file_data + '_T' + str(i_minus).zfill(4) + '_corr_' + '__div2'
-        cmd = fsloutput + 'fslmerge -z ' + fname_minus_corr
-
-        for iZ in range(nz):
-            fname_minus_Z_corr = file_data + '_T' + str(i_minus).zfill(4) + file_suffix[iZ] + '_corr_' + '__div2'
-            cmd = cmd + ' ' + fname_minus_Z_corr
-        status, output = sct.run(cmd,verbose)
-
-    # =========================================================================
-    #	Merge files back
-    # =========================================================================
-    sct.printv('\nMerge back across T...',verbose)
-    sct.printv('------------------------------------------------------------------------------------\n',verbose)
-    
+    # volumes without opposite gradient (e.g. b=0) are not corrected
+    data_corr = data.astype(np.float32)
+    for i_file, iZ, fname_corr in list_corr:
+        data_file = np.asarray(load(fname_corr+'.nii').dataobj)
+        if param.slicewise:
+            data_corr[:, :, iZ, i_file] = data_file.reshape(nx, ny)
+        else:
+            data_corr[:, :, :, i_file] = data_file.reshape(nx, ny, nz)
     fname_data_corr = param.output_path + file_data + '_eddy'
-    cmd = fsloutput + 'fslmerge -t ' + fname_data_corr
-    path_tmp = os.getcwd()
-    for iT in range(nt):
-        if os.path.isfile((path_tmp + '/' + file_data + '_T' + str(iT).zfill(4) + '_corr_' + '__div2.nii')):
-            fname_data_corr_3d = file_data + '_T' + str(iT).zfill(4) + '_corr_' + '__div2'
-        elif iT in index_b0:
-            fname_data_corr_3d = file_data + '_T' + str(iT).zfill(4)
-        
-        cmd = cmd + ' ' + fname_data_corr_3d
-    status, output = sct.run(cmd,verbose)
+    moco.save_volumes(data_corr, header, fname_data_corr+'.nii')
+    del data, data_corr
 
     #Swap back X-Y dimensions
     if param.swapXY==1:
@@ -374,6 +337,7 @@ def usage():
         '  -o           Specify Output path.\n' \
         '  -s           Set value to 0 for volume based correction. Default value is 1 i.e slicewise correction\n' \
         '  -m           matrix folder \n' \
+        '  -n           number of FLIRT jobs run concurrently. Default: $SCT_NB_WORKERS or number of CPUs \n' \
         '  -c           Cost function FLIRT - mutualinfo | woods | corratio | normcorr | normmi | leastsquares. Default is <normcorr>..\n' \
         '  -p           Interpolation - Default is trilinear. Additional options: nearestneighbour,sinc,spline.\n' \
         '  -g {0,1}     Set value to 1 for plotting graphs. Default value is 0 \n' \
@@ -71,6 +71,7 @@ class Param:
         self.bval_min = 100  # in case user does not have min bvalues at 0, set threshold (where csf disapeared).
         self.otsu = 0  # use otsu algorithm to segment dwi data for better moco. Value coresponds to data threshold. For no segmentation set to 0.
         self.iterative_averaging = 1  # iteratively average target image for more robust moco
+        self.nb_workers = None  # number of volumes registered concurrently (None: see sct_utils.get_nb_workers)
 
 
 #=======================================================================================================================
@@ -105,7 +106,7 @@ def main():
     else:
         # Check input parameters
         try:
-            opts, args = getopt.getopt(sys.argv[1:], 'hi:a:b:e:f:g:m:o:p:r:t:v:x:')
+            opts, args = getopt.getopt(sys.argv[1:], 'hi:a:b:e:f:g:m:n:o:p:r:t:v:x:')
         except getopt.GetoptError:
             usage()
         if not opts:
@@ -127,6 +128,8 @@ def main():
                 param.fname_data = arg
             elif opt in ('-m'):
                 param.fname_mask = arg
+            elif opt in ('-n'):
+                param.nb_workers = int(arg)
             elif opt in ('-o'):
                 path_out = arg
             elif opt in ('-p'):
@@ -260,23 +263,7 @@ def dmri_moco(param):
 
     # Prepare NIFTI (mean/groups...)
     #===================================================================================================================
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', param.verbose)
-    status, output = sct.run(fsloutput+'fslsplit ' + file_data + ' ' + file_data + '_T', param.verbose)
-
-    # Merge b=0 images
-    sct.printv('\nMerge b=0...', param.verbose)
-    cmd = fsloutput + 'fslmerge -t ' + file_b0
-    for it in range(nb_b0):
-        cmd = cmd + ' ' + file_data + '_T' + str(index_b0[it]).zfill(4)
-    status, output = sct.run(cmd, param.verbose)
-    sct.printv(('  File created: ' + file_b0), param.verbose)
-
-    # Average b=0 images
-    sct.printv('\nAverage b=0...', param.verbose)
-    file_b0_mean = file_b0+'_mean'
-    cmd = fsloutput + 'fslmaths ' + file_b0 + ' -Tmean ' + file_b0_mean
-    status, output = sct.run(cmd, param.verbose)
+    sct.set_stage('prepare groups')
 
     # Number of DWI groups
     nb_groups = int(math.floor(nb_dwi/param.group_size))
@@ -292,41 +279,29 @@ def dmri_moco(param):
         nb_groups += 1
         group_indexes.append(index_dwi[len(index_dwi)-nb_remaining:len(index_dwi)])
 
-    # DWI groups
-    for iGroup in range(nb_groups):
-        sct.printv('\nDWI group: ' +str((iGroup+1))+'/'+str(nb_groups), param.verbose)
-
-        # get index
-        index_dwi_i = group_indexes[iGroup]
-        nb_dwi_i = len(index_dwi_i)
-
-        # Merge DW Images
-        sct.printv('Merge DW images...', param.verbose)
-        file_dwi_merge_i = file_dwi + '_' + str(iGroup)
-        cmd = fsloutput + 'fslmerge -t ' + file_dwi_merge_i
-        for it in range(nb_dwi_i):
-            cmd = cmd +' ' + file_data + '_T' + str(index_dwi_i[it]).zfill(4)
-        sct.run(cmd, param.verbose)
-
-        # Average DW Images
-        sct.printv('Average DW images...', param.verbose)
-        file_dwi_mean = file_dwi + '_mean_' + str(iGroup)
-        cmd = fsloutput + 'fslmaths ' + file_dwi_merge_i + ' -Tmean ' + file_dwi_mean
-        sct.run(cmd, param.verbose)
-
-    # Merge DWI groups means
-    sct.printv('\nMerging DW files...', param.verbose)
-    # file_dwi_groups_means_merge = 'dwi_averaged_groups'
-    cmd = fsloutput + 'fslmerge -t ' + file_dwi_group
-    for iGroup in range(nb_groups):
-        cmd = cmd + ' ' + file_dwi + '_mean_' + str(iGroup)
-    sct.run(cmd, param.verbose)
+    # b=0 images, mean of b=0 images and mean of each DWI group, read in one pass over the data
+    sct.printv('\nAverage b=0 and DWI groups...', param.verbose)
+    data_groups, header = moco.average_groups(file_data+'.nii', [[it] for it in index_b0] + [index_b0] + group_indexes, param.verbose)
 
-    # Average DW Images
-    # TODO: USEFULL ???
-    sct.printv('\nAveraging all DW images...', param.verbose)
-    fname_dwi_mean = 'dwi_mean'  
-    sct.run(fsloutput + 'fslmaths ' + file_dwi_group + ' -Tmean ' + file_dwi_group+'_mean', param.verbose)
+    # target of b=0 registration: b=0 before the first DWI (if any), otherwise first b=0
+    if index_dwi[0] != 0:
+        index_b0_target = index_b0[index_dwi[0]-1]
+    else:
+        index_b0_target = index_b0[0]
+    file_b0_target = file_data + '_T' + str(index_b0_target).zfill(4)
+    moco.save_volumes(data_groups[..., index_b0.index(index_b0_target)], header, file_b0_target+'.nii')
+
+    # b=0 images and their mean
+    moco.save_volumes(data_groups[..., 0:nb_b0], header, file_b0+'.nii')
+    sct.printv(('  File created: ' + file_b0), param.verbose)
+    file_b0_mean = file_b0+'_mean'
+    moco.save_volumes(data_groups[..., nb_b0], header, file_b0_mean+'.nii')
+
+    # DWI groups means (the first one is the reference for reslicing when applying moco)
+    data_dwi_groups = data_groups[..., nb_b0+1:]
+    moco.save_volumes(data_dwi_groups, header, file_dwi_group+'.nii')
+    moco.save_volumes(data_dwi_groups[..., 0], header, file_dwi+'_mean_'+str(0)+'.nii')
+    del data_groups
 
     # segment dwi images using otsu algorithm
     if param.otsu:
@@ -341,33 +316,34 @@ def dmri_moco(param):
         # run otsu
         otsu.otsu(param_otsu)
         file_dwi_group = file_dwi_group+'_seg'
+        from nibabel import load
+        data_dwi_groups = np.asarray(load(file_dwi_group+'.nii').dataobj[..., 0:1]).astype(np.float32)
 
-    # extract first DWI volume as target for registration
-    sct.run(fsloutput + 'fslroi ' + file_dwi_group + ' target_dwi.nii ' + str(index_dwi[0]) + ' 1', param.verbose)
+    # extract first DWI group as target for registration
+    moco.save_volumes(data_dwi_groups[..., 0], header, 'target_dwi.nii')
+    del data_dwi_groups
 
 
     # START MOCO
     #===================================================================================================================
 
     # Estimate moco on b0 groups
+    sct.set_stage('moco b0')
     sct.printv('\n-------------------------------------------------------------------------------', param.verbose)
     sct.printv('  Estimating motion on b=0 images...', param.verbose)
     sct.printv('-------------------------------------------------------------------------------', param.verbose)
     param_moco = param
     param_moco.file_data = 'b0'
-    if index_dwi[0] != 0:
-        # If first DWI is not the first volume (most common), then there is a least one b=0 image before. In that case
-        # select it as the target image for registration of all b=0
-        param_moco.file_target = file_data + '_T' + str(index_b0[index_dwi[0]-1]).zfill(4)
-    else:
-        # If first DWI is the first volume, then the target b=0 is the first b=0 from the index_b0.
-        param_moco.file_target = file_data + '_T' + str(index_b0[0]).zfill(4)
+    # If first DWI is not the first volume (most common), then there is a least one b=0 image before: it is the target
+    # image for registration of all b=0. Otherwise, the target b=0 is the first b=0 from the index_b0.
+    param_moco.file_target = file_b0_target
     param_moco.path_out = ''
     param_moco.todo = 'estimate'
     param_moco.mat_moco = 'mat_b0groups'
     moco.moco(param_moco)
 
     # Estimate moco on dwi groups
+    sct.set_stage('moco dwi')
     sct.printv('\n-------------------------------------------------------------------------------', param.verbose)
     sct.printv('  Estimating motion on DW images...', param.verbose)
     sct.printv('-------------------------------------------------------------------------------', param.verbose)
@@ -380,6 +356,7 @@ def dmri_moco(param):
     moco.moco(param_moco)
 
     # create final mat folder
+    sct.set_stage('regularize and combine matrices')
     sct.create_folder(mat_final)
 
     # Copy b=0 registration matrices
@@ -405,6 +382,7 @@ def dmri_moco(param):
         moco.combine_matrix(param)
 
     # Apply moco on all dmri data
+    sct.set_stage('apply moco')
     sct.printv('\n-------------------------------------------------------------------------------', param.verbose)
     sct.printv('  Apply moco', param.verbose)
     sct.printv('-------------------------------------------------------------------------------', param.verbose)
@@ -420,6 +398,7 @@ def dmri_moco(param):
     sct.run(fsloutput+'fslcpgeom dmri dmri_moco')
 
     # generate b0_moco_mean and dwi_moco_mean
+    sct.set_stage('separate b0 and dwi')
     cmd = 'sct_dmri_separate_b0_and_dwi -i dmri'+param.suffix+'.nii -b bvecs.txt -a 1'
     if not param.fname_bvals == '':
         cmd = cmd+' -m '+param.fname_bvals
@@ -464,6 +443,7 @@ OPTIONAL ARGUMENTS
   -t <int>         segment DW data using OTSU algorithm. Value corresponds to OTSU threshold. Default="""+str(param_default.otsu)+"""
                    For no segmentation set to 0.
   -o <path_out>    Output path.
+  -n <int>         number of volumes registered concurrently. Default: $SCT_NB_WORKERS or number of CPUs
   -x {nn,linear,spline}  Final Interpolation. Default="""+str(param_default.interp)+"""
   -v {0,1}         verbose. Default="""+str(param_default.verbose)+"""
   -r {0,1}         remove temporary files. Default="""+str(param_default.remove_tmp_files)+"""
@@ -27,9 +27,12 @@ import time
 
 import nibabel as nib
 import numpy as np
+from scipy.sparse import csr_matrix, vstack
 
 import sct_utils as sct
-from sct_orientation import get_orientation, set_orientation
+from sct_orientation import get_orientation
+from msct_atlas import Atlas, labels_to_sparse, load_rpi, read_label_file
+from msct_vertebral_levels import VertebralLevels
 
 
 
@@ -153,10 +156,12 @@ def main():
 
     # Check existence of data file
     sct.printv('\ncheck existence of input files...', verbose)
-    sct.check_file_exist(fname_data)
+    list_fname_data = fname_data.split(',')  # several metrics can be extracted at once
+    for fname in list_fname_data:
+        sct.check_file_exist(fname)
     sct.check_folder_exist(path_label)
     if fname_normalizing_label:
-        sct.check_folder_exist(fname_normalizing_label)
+        sct.check_file_exist(fname_normalizing_label)
 
     # add slash at the end
     path_label = sct.slash_at_the_end(path_label, 1)
@@ -186,8 +191,10 @@ def main():
         del adv_param_user  # clean variable
         # TODO: check integrity of input
 
-    # Extract label info
-    label_id, label_name, label_file = read_label_file(path_label, param.file_info_label)
+    # Load labels (they are compiled into a sparse matrix of weights the first time the label folder is used)
+    sct.printv('\nLoad labels...', verbose)
+    atlas = Atlas(path_label, param.file_info_label, verbose)
+    label_id, label_name = atlas.label_id, atlas.label_name
     nb_labels_total = len(label_id)
 
     # check consistency of label input parameter.
@@ -205,321 +212,152 @@ def main():
     print '  vertebral labeling file.... '+fname_vertebral_labeling
     print '  advanced parameters ....... '+str(adv_param)
 
-    # Check if the orientation of the data is RPI
-    orientation_data = get_orientation(fname_data)
-
-    # If orientation is not RPI, change to RPI
-    if orientation_data != 'RPI':
-        sct.printv('\nCreate temporary folder to change the orientation of the NIFTI files into RPI...', verbose)
-        path_tmp = sct.slash_at_the_end('tmp.'+time.strftime("%y%m%d%H%M%S"), 1)
-        sct.create_folder(path_tmp)
-        # change orientation and load data
-        sct.printv('\nChange image orientation and load it...', verbose)
-        data = nib.load(set_orientation(fname_data, 'RPI', path_tmp+'orient_data.nii')).get_data()
-        # Do the same for labels
-        sct.printv('\nChange labels orientation and load them...', verbose)
-        labels = np.empty([nb_labels_total], dtype=object)  # labels(nb_labels_total, x, y, z)
-        for i_label in range(0, nb_labels_total):
-            labels[i_label] = nib.load(set_orientation(path_label+label_file[i_label], 'RPI', path_tmp+'orient_'+label_file[i_label])).get_data()
-        if fname_normalizing_label:  # if the "normalization" option is wanted,
-            normalizing_label = np.empty([1], dtype=object)  # choose this kind of structure so as to keep easily the
-            # compatibility with the rest of the code (dimensions: (1, x, y, z))
-            normalizing_label[0] = nib.load(set_orientation(fname_normalizing_label, 'RPI', path_tmp+'orient_normalizing_volume.nii')).get_data()
-        if vertebral_levels:  # if vertebral levels were selected,
-            data_vertebral_labeling = nib.load(set_orientation(fname_vertebral_labeling, 'RPI', path_tmp+'orient_vertebral_labeling.nii.gz')).get_data()
-        # Remove the temporary folder used to change the NIFTI files orientation into RPI
-        sct.printv('\nRemove the temporary folder...', verbose)
-        status, output = commands.getstatusoutput('rm -rf ' + path_tmp)
-    else:
-        # Load image
-        sct.printv('\nLoad image...', verbose)
-        data = nib.load(fname_data).get_data()
-
-        # Load labels
-        sct.printv('\nLoad labels...', verbose)
-        labels = np.empty([nb_labels_total], dtype=object)  # labels(nb_labels_total, x, y, z)
-        for i_label in range(0, nb_labels_total):
-            labels[i_label] = nib.load(path_label+label_file[i_label]).get_data()
-        if fname_normalizing_label:  # if the "normalization" option is wanted,
-            normalizing_label = np.empty([1], dtype=object)  # choose this kind of structure so as to keep easily the
-            # compatibility with the rest of the code (dimensions: (1, x, y, z))
-            normalizing_label[0] = nib.load(fname_normalizing_label).get_data()  # load the data of the normalizing label
-        if vertebral_levels:  # if vertebral levels were selected,
-            data_vertebral_labeling = nib.load(fname_vertebral_labeling).get_data()
-
-    # Change metric data type into floats for future manipulations (normalization)
-    data = np.float64(data)
+    # Load metric data, normalizing label and vertebral labeling in RPI orientation (in memory)
+    sct.printv('\nLoad image...', verbose)
+    list_data = [np.float64(load_rpi_if_needed(fname)) for fname in list_fname_data]
+    if fname_normalizing_label:  # if the "normalization" option is wanted,
+        normalizing_voxels, normalizing_label = labels_to_sparse([load_rpi_if_needed(fname_normalizing_label)])
+    if vertebral_levels:  # if vertebral levels were selected, get the slices of each level
+        vertebral_index = VertebralLevels(fname_vertebral_labeling, verbose)
 
     # Get dimensions of data
     sct.printv('\nGet dimensions of data...', verbose)
-    nx, ny, nz = data.shape
+    nx, ny, nz = list_data[0].shape
     sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
 
     # Get dimensions of labels
     sct.printv('\nGet dimensions of label...', verbose)
-    nx_atlas, ny_atlas, nz_atlas = labels[0].shape
+    nx_atlas, ny_atlas, nz_atlas = atlas.shape
     sct.printv('.. '+str(nx_atlas)+' x '+str(ny_atlas)+' x '+str(nz_atlas)+' x '+str(nb_labels_total), verbose)
 
     # Check dimensions consistency between atlas and data
-    if (nx, ny, nz) != (nx_atlas, ny_atlas, nz_atlas):
-        print '\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS.'
-        sys.exit(2)
-
-    # Update the flag "slices_of_interest" according to the vertebral levels selected by user (if it's the case)
-    if vertebral_levels:
-        slices_of_interest, actual_vert_levels, warning_vert_levels = \
-            get_slices_matching_with_vertebral_levels(data, vertebral_levels, data_vertebral_labeling)
-
-    # select slice of interest by cropping data and labels
-    if slices_of_interest:
-        data = remove_slices(data, slices_of_interest)
-        for i_label in range(0, nb_labels_total):
-            labels[i_label] = remove_slices(labels[i_label], slices_of_interest)
-        if fname_normalizing_label:  # if the "normalization" option was selected,
-            normalizing_label[0] = remove_slices(normalizing_label[0], slices_of_interest)
+    for data in list_data:
+        if data.shape != (nx_atlas, ny_atlas, nz_atlas):
+            print '\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS.'
+            sys.exit(2)
 
     # if user wants to get unique value across labels, then combine all labels together
+    labels_all = atlas.weights
     if average_all_labels == 1:
-        sum_labels_user = np.sum(labels[label_id_user])  # sum the labels selected by user
+        sum_labels_user = csr_matrix(labels_all[label_id_user].sum(axis=0))  # sum the labels selected by user
         if method == 'ml' or method == 'map':  # in case the maximum likelihood and the average across different labels are wanted
-            labels_tmp = np.empty([nb_labels_total - len(label_id_user) + 1], dtype=object)
-            labels = np.delete(labels, label_id_user)  # remove the labels selected by user
-            labels_tmp[0] = sum_labels_user  # put the sum of the labels selected by user in first position of the tmp
-            # variable
-            for i_label in range(1, len(labels_tmp)):
-                labels_tmp[i_label] = labels[i_label-1]  # fill the temporary array with the values of the non-selected labels
-            labels = labels_tmp  # replace the initial labels value by the updated ones (with the summed labels)
-            del labels_tmp  # delete the temporary labels
+            # put the sum of the labels selected by user in first position, followed by the non-selected labels
+            labels_all = vstack([sum_labels_user, labels_all[np.setdiff1d(range(0, nb_labels_total), label_id_user)]], format='csr')
         else:  # in other cases than the maximum likelihood, we can remove other labels (not needed for estimation)
-            labels = np.empty(1, dtype=object)
-            labels[0] = sum_labels_user  # we create a new label array that includes only the summed labels
-
-    if fname_normalizing_label:  # if the "normalization" option is wanted
-        sct.printv('\nExtract normalization values...', verbose)
-        if normalization_method == 'sbs':  # case: the user wants to normalize slice-by-slice
-            for z in range(0, data.shape[-1]):
-                normalizing_label_slice = np.empty([1], dtype=object)  # in order to keep compatibility with the function
-                # 'extract_metric_within_tract', define a new array for the slice z of the normalizing labels
-                normalizing_label_slice[0] = normalizing_label[0][..., z]
-                metric_normalizing_label = extract_metric_within_tract(data[..., z], normalizing_label_slice, method, 0)
-                # estimate the metric mean in the normalizing label for the slice z
-                if metric_normalizing_label[0][0] != 0:
-                    data[..., z] = data[..., z]/metric_normalizing_label[0][0]  # divide all the slice z by this value
-
-        elif normalization_method == 'whole':  # case: the user wants to normalize after estimations in the whole labels
-            metric_mean_norm_label, metric_std_norm_label = extract_metric_within_tract(data, normalizing_label, method, param.verbose)  # mean and std are lists
-
-    # identify cluster for each tract (for use with robust ML)
-    ml_clusters_array = get_clusters(ml_clusters, labels)
-
-    # extract metrics within labels
-    sct.printv('\nExtract metric within labels...', verbose)
-    metric_mean, metric_std = extract_metric_within_tract(data, labels, method, verbose, ml_clusters_array, adv_param)  # mean and std are lists
-
-    if fname_normalizing_label and normalization_method == 'whole':  # case: user wants to normalize after estimations in the whole labels
-        metric_mean, metric_std = np.divide(metric_mean, metric_mean_norm_label), np.divide(metric_std, metric_std_norm_label)
-
-    # update label name if average
-    if average_all_labels == 1:
+            labels_all = sum_labels_user  # we create a new label array that includes only the summed labels
+        # update label name
         label_name[0] = 'AVERAGED'+' -'.join(label_name[i] for i in label_id_user)  # concatenate the names of the
         # labels selected by the user if the average tag was asked
         label_id_user = [0]  # update "label_id_user" to select the "averaged" label (which is in first position)
 
-    metric_mean = metric_mean[label_id_user]
-    metric_std = metric_std[label_id_user]
-
-    # display metrics
-    sct.printv('\nEstimation results:', 1)
-    for i in range(0, metric_mean.size):
-        sct.printv(str(label_id_user[i])+', '+str(label_name[label_id_user[i]])+':    '+str(metric_mean[i])+' +/- '+str(metric_std[i]), 1, 'info')
+    # identify cluster for each tract (for use with robust ML)
+    ml_clusters_array = get_clusters(ml_clusters, labels_all)
 
-    # save and display metrics
-    save_metrics(label_id_user, label_name, slices_of_interest, metric_mean, metric_std, fname_output, fname_data,
-                 method, fname_normalizing_label, actual_vert_levels, warning_vert_levels)
+    # list of slice selections (several vertebral levels or slice ranges can be given, separated with ";")
+    if vertebral_levels == 'all':
+        list_selection = [(levels, '') for levels in vertebral_index.get_all_levels()]
+    elif vertebral_levels:
+        list_selection = [(levels, '') for levels in vertebral_levels.split(';')]
+    else:
+        list_selection = [('', slices) for slices in slices_of_interest.split(';')]
+
+    results = []
+    for vertebral_levels, slices_of_interest in list_selection:
+        actual_vert_levels, warning_vert_levels = None, None
+        # Update the flag "slices_of_interest" according to the vertebral levels selected by user (if it's the case)
+        if vertebral_levels:
+            slices_of_interest, actual_vert_levels, warning_vert_levels = \
+                get_slices_matching_with_vertebral_levels(list_data[0], vertebral_levels, vertebral_index)
+
+        # select slice of interest by selecting the voxels of the labels within these slices
+        if slices_of_interest:
+            slices_list = get_slices_list(slices_of_interest)
+        else:
+            slices_list = range(0, nz)
+        voxels_in_slices = atlas.get_voxels_in_slices(slices_list)
+        labels = labels_all[:, voxels_in_slices]  # [nb_labels x nb_voxels]
+        data = np.array([np.take(d, atlas.voxels[voxels_in_slices]) for d in list_data]).T  # [nb_voxels x nb_metrics]
+
+        if fname_normalizing_label:  # if the "normalization" option is wanted
+            sct.printv('\nExtract normalization values...', verbose)
+            if normalization_method == 'sbs':  # case: the user wants to normalize slice-by-slice
+                normalization = np.ones([nz, len(list_data)])
+                for z in slices_list:
+                    # estimate the metric mean in the normalizing label for the slice z
+                    ind_z = np.flatnonzero(normalizing_voxels % nz == z)
+                    data_z = np.array([np.take(d, normalizing_voxels[ind_z]) for d in list_data]).T
+                    metric_normalizing_label = extract_metric_within_tract(data_z, normalizing_label[:, ind_z], method, 0)
+                    normalization[z, metric_normalizing_label[0][0] != 0] = metric_normalizing_label[0][0][metric_normalizing_label[0][0] != 0]
+                # divide all the slice z by this value
+                data = data / normalization[atlas.voxels[voxels_in_slices] % nz]
+
+            elif normalization_method == 'whole':  # case: the user wants to normalize after estimations in the whole labels
+                ind_slices = np.flatnonzero(np.in1d(normalizing_voxels % nz, slices_list))
+                data_norm = np.array([np.take(d, normalizing_voxels[ind_slices]) for d in list_data]).T
+                metric_mean_norm_label, metric_std_norm_label = extract_metric_within_tract(data_norm, normalizing_label[:, ind_slices], method, param.verbose)  # mean and std are lists
+
+        # extract metrics within labels (all metrics at once)
+        sct.printv('\nExtract metric within labels...', verbose)
+        metric_mean, metric_std = extract_metric_within_tract(data, labels, method, verbose, ml_clusters_array, adv_param)  # [nb_labels x nb_metrics]
+
+        if fname_normalizing_label and normalization_method == 'whole':  # case: user wants to normalize after estimations in the whole labels
+            metric_mean, metric_std = np.divide(metric_mean, metric_mean_norm_label), np.divide(metric_std, metric_std_norm_label)
+
+        metric_mean = metric_mean[label_id_user]
+        metric_std = metric_std[label_id_user]
+        results.append((slices_of_interest, actual_vert_levels, warning_vert_levels, metric_mean, metric_std))
+
+    if len(list_fname_data) == 1 and len(list_selection) == 1:
+        slices_of_interest, actual_vert_levels, warning_vert_levels, metric_mean, metric_std = results[0]
+        metric_mean, metric_std = metric_mean[:, 0], metric_std[:, 0]
+
+        # display metrics
+        sct.printv('\nEstimation results:', 1)
+        for i in range(0, metric_mean.size):
+            sct.printv(str(label_id_user[i])+', '+str(label_name[label_id_user[i]])+':    '+str(metric_mean[i])+' +/- '+str(metric_std[i]), 1, 'info')
+
+        # save and display metrics
+        save_metrics(label_id_user, label_name, slices_of_interest, metric_mean, metric_std, fname_output, fname_data,
+                     method, fname_normalizing_label, actual_vert_levels, warning_vert_levels)
+    else:
+        # save all metrics and slice selections in one table
+        save_metrics_batch(label_id_user, label_name, list_fname_data, results, fname_output, method,
+                           fname_normalizing_label)
 
 
 
 #=======================================================================================================================
-# Read label.txt file which is located inside label folder
+# Load data in RPI orientation, if it is not already the case (reorientation is done in memory)
 #=======================================================================================================================
-def read_label_file(path_info_label, file_info_label):
-
-    # file name of info_label.txt
-    fname_label = path_info_label+file_info_label
-
-    # Check info_label.txt existence
-    sct.check_file_exist(fname_label)
-
-    # Read file
-    f = open(fname_label)
-
-    # Extract all lines in file.txt
-    lines = [lines for lines in f.readlines() if lines.strip()]
-
-    # separate header from (every line starting with "#")
-    lines = [lines[i] for i in range(0, len(lines)) if lines[i][0] != '#']
-
-    # read each line
-    label_id = []
-    label_name = []
-    label_file = []
-    for i in range(0, len(lines)-1):
-        line = lines[i].split(',')
-        label_id.append(int(line[0]))
-        label_name.append(line[1].strip())
-        label_file.append(line[2][:-1].strip())
-    # An error could occur at the last line (deletion of the last character of the .txt file), the 5 following code
-    # lines enable to avoid this error:
-    line = lines[-1].split(',')
-    label_id.append(int(line[0]))
-    label_name.append(line[1].strip())
-    line[2]=line[2]+' '
-    label_file.append(line[2].strip())
-
-    # check if all files listed are present in folder. If not, WARNING.
-    # print '\nCheck existence of all files listed in '+file_info_label+' ...'
-    for fname in label_file:
-        sct.check_file_exist(path_info_label+fname)
-        # if os.path.isfile(path_info_label+fname) or os.path.isfile(path_info_label+fname + '.nii') or \
-        #         os.path.isfile(path_info_label+fname + '.nii.gz'):
-        #     sct.printv('  OK: '+path_info_label+fname, param.verbose)
-        #     pass
-        # else:
-        #     sct.printv('  ERROR: ' + path_info_label+fname + ' does not exist\n', 1, 'error')
-
-    # Close file.txt
-    f.close()
-
-    return [label_id, label_name, label_file]
+def load_rpi_if_needed(fname):
+    if get_orientation(fname) != 'RPI':
+        return load_rpi(fname)
+    else:
+        return nib.load(fname).get_data()
 
 
 #=======================================================================================================================
 # Return the slices of the input image corresponding to the vertebral levels given as argument
 #=======================================================================================================================
-def get_slices_matching_with_vertebral_levels(metric_data, vertebral_levels, data_vertebral_labeling):
+def get_slices_matching_with_vertebral_levels(metric_data, vertebral_levels, vertebral_index):
+    """
+    :metric_data: metric (RPI orientation)
+    :vertebral_levels: string, e.g. '2:4'
+    :vertebral_index: msct_vertebral_levels.VertebralLevels of the vertebral labeling
+    """
 
     sct.printv('\nFind slices corresponding to vertebral levels...', param.verbose)
 
-    # Convert the selected vertebral levels chosen into a 2-element list [start_level end_level]
-    vert_levels_list = [int(x) for x in vertebral_levels.split(':')]
-
-    # If only one vertebral level was selected (n), consider as n:n
-    if len(vert_levels_list) == 1:
-        vert_levels_list = [vert_levels_list[0], vert_levels_list[0]]
-
-    # Check if there are only two values [start_level, end_level] and if the end level is higher than the start level
-    if (len(vert_levels_list) > 2) or (vert_levels_list[0] > vert_levels_list[1]):
-        print '\nERROR:  "' + vertebral_levels + '" is not correct. Enter format "1:4". Exit program.\n'
-        sys.exit(2)
-
-    # Extract the vertebral levels available in the metric image
-    vertebral_levels_available = np.array(list(set(data_vertebral_labeling[data_vertebral_labeling > 0])))
-
-    # Check if the vertebral levels selected are available
-    warning=[]  # list of strings gathering the potential following warning(s) to be written in the output .txt file
-    min_vert_level_available = min(vertebral_levels_available)  # lowest vertebral level available
-    max_vert_level_available = max(vertebral_levels_available)  # highest vertebral level available
-    if vert_levels_list[0] < min_vert_level_available:
-        vert_levels_list[0] = min_vert_level_available
-        warning.append('WARNING: the bottom vertebral level you selected is lower to the lowest level available --> '
-                       'Selected the lowest vertebral level available: ' + str(int(vert_levels_list[0])))  # record the
-                       # warning to write it later in the .txt output file
-        print color.yellow + 'WARNING: the bottom vertebral level you selected is lower to the lowest ' \
-                                          'level available \n--> Selected the lowest vertebral level available: '+\
-              str(int(vert_levels_list[0])) + color.end
-
-    if vert_levels_list[0] > max_vert_level_available:
-        vert_levels_list[1] = max_vert_level_available
-        warning.append('WARNING: the top vertebral level you selected is higher to the highest level available --> '
-                       'Selected the highest vertebral level available: ' + str(int(vert_levels_list[1])))  # record the
-        # warning to write it later in the .txt output file
-
-        print color.yellow + 'WARNING: the top vertebral level you selected is higher to the highest ' \
-                                          'level available --> Selected the highest vertebral level available: ' + \
-              str(int(vert_levels_list[1])) + color.end
-
-    if vert_levels_list[0] not in vertebral_levels_available:
-        distance = vertebral_levels_available - vert_levels_list[0]  # relative distance
-        distance_min_among_negative_value = min(abs(distance[distance < 0]))  # minimal distance among the negative
-        # relative distances
-        vert_levels_list[0] = vertebral_levels_available[distance == distance_min_among_negative_value]  # element
-        # of the initial list corresponding to this minimal distance
-        warning.append('WARNING: the bottom vertebral level you selected is not available --> Selected the nearest '
-                       'inferior level available: ' + str(int(vert_levels_list[0])))
-        print color.yellow + 'WARNING: the bottom vertebral level you selected is not available \n--> Selected the ' \
-                             'nearest inferior level available: '+str(int(vert_levels_list[0]))  # record the
-        # warning to write it later in the .txt output file
-
-    if vert_levels_list[1] not in vertebral_levels_available:
-        distance = vertebral_levels_available - vert_levels_list[1]  # relative distance
-        distance_min_among_positive_value = min(abs(distance[distance > 0]))  # minimal distance among the negative
-        # relative distances
-        vert_levels_list[1] = vertebral_levels_available[distance == distance_min_among_positive_value]  # element
-        # of the initial list corresponding to this minimal distance
-        warning.append('WARNING: the top vertebral level you selected is not available --> Selected the nearest superior'
-                       ' level available: ' + str(int(vert_levels_list[1])))  # record the warning to write it later in the .txt output file
-
-        print color.yellow + 'WARNING: the top vertebral level you selected is not available \n--> Selected the ' \
-                             'nearest superior level available: ' + str(int(vert_levels_list[1]))
-
-    # Extract metric data size X, Y, Z
-    [mx, my, mz] = metric_data.shape
-    # Extract vertebral labeling data size X, Y, Z
-    [vx, vy, vz] = data_vertebral_labeling.shape
-
     sct.printv('  Check consistency of data size...', param.verbose)
-
-    # Initialisation of check error flag
-    exit_program = 0
-
-    # Check if sizes along X are the same
-    if mx != vx:
-        print '\tERROR: Size of vertebral_labeling.nii.gz along X is not the same as the metric data.'
-        exit_program = 1
-    # Check if sizes along Y are the same
-    if my != vy:
-        print '\tERROR: Size of vertebral_labeling.nii.gz along Y is not the same as the metric data.'
-        exit_program = 1
-    # Check if sizes along Z are the same
-    if mz != vz:
-        print '\tERROR: Size of vertebral_labeling.nii.gz along Z is not the same as the metric data.'
-        exit_program = 1
-
-    # Exit program if an error was detected
-    if exit_program == 1:
+    if metric_data.shape[0:3] != vertebral_index.shape:
+        print '\tERROR: Size of vertebral_labeling.nii.gz is not the same as the metric data.'
         print '\nExit program.\n'
         sys.exit(2)
     else:
         print '    OK!'
 
-    sct.printv('  Find slices corresponding to vertebral levels...', param.verbose)
-    # Extract the X, Y, Z positions of voxels belonging to the first vertebral level
-    X_bottom_level, Y_bottom_level, Z_bottom_level = (data_vertebral_labeling == vert_levels_list[0]).nonzero()
-    # Record the bottom and top slices of this level
-    slice_min_bottom = min(Z_bottom_level)
-    slice_max_bottom = max(Z_bottom_level)
-
-    # Extract the X, Y, Z positions of voxels belonging to the last vertebral level
-    X_top_level, Y_top_level, Z_top_level = (data_vertebral_labeling == vert_levels_list[1]).nonzero()
-    # Record the bottom and top slices of this level
-    slice_min_top = min(Z_top_level)
-    slice_max_top = max(Z_top_level)
-
-    # Take into account the case where the ordering of the slice is reversed compared to the ordering of the vertebral
-    # levels (usually the case) and if several slices include two different vertebral levels
-    if slice_min_bottom >= slice_min_top or slice_max_bottom >= slice_max_top:
-        slice_min = slice_min_top
-        slice_max = slice_max_bottom
-    else:
-        slice_min = slice_min_bottom
-        slice_max = slice_max_top
-
-    # display info
-    sct.printv('    '+str(slice_min)+':'+str(slice_max), param.verbose)
-
-    # Return the slice numbers in the right format ("-1" because the function "remove_slices", which runs next, add 1
-    # to the top slice
-    return str(slice_min)+':'+str(slice_max), vert_levels_list, warning
+    # Return the slice numbers in the right format, the vertebral levels actually used and the warnings
+    return vertebral_index.get_slices(vertebral_levels)
 
 
 #=======================================================================================================================
@@ -527,6 +365,17 @@ def get_slices_matching_with_vertebral_levels(metric_data, vertebral_levels, dat
 #=======================================================================================================================
 def remove_slices(data_to_crop, slices_of_interest):
 
+    # Remove slices that are not wanted
+    data_cropped = data_to_crop[..., get_slices_list(slices_of_interest)]
+
+    return data_cropped
+
+
+#=======================================================================================================================
+# Convert the slices asked by user (e.g. "5:8" or "0,2,3") into a list of slices
+#=======================================================================================================================
+def get_slices_list(slices_of_interest):
+
     # check if user selected specific slices using delimitor ','
     if not slices_of_interest.find(',') == -1:
         slices_list = [int(x) for x in slices_of_interest.split(',')]  # n-element list
@@ -537,10 +386,7 @@ def remove_slices(data_to_crop, slices_of_interest):
             slices_range = [slices_range[0], slices_range[0]]
         slices_list = [i for i in range(slices_range[0], slices_range[1]+1)]
 
-    # Remove slices that are not wanted (+1 is to include the last selected slice as Python "includes -1"
-    data_cropped = data_to_crop[..., slices_list]
-
-    return data_cropped
+    return slices_list
 
 
 #=======================================================================================================================
@@ -598,6 +444,43 @@ def save_metrics(ind_labels, label_name, slices_of_interest, metric_mean, metric
 
 
 
+#=======================================================================================================================
+# Save results of several metrics and slice selections in one txt file
+#=======================================================================================================================
+def save_metrics_batch(ind_labels, label_name, list_fname_data, results, fname_output, method, fname_normalizing_label):
+    """
+    :results: list of (slices_of_interest, actual_vert, warning_vert_levels, metric_mean, metric_std) for each slice
+    selection, where metric_mean and metric_std are [nb_labels x nb_metrics]
+    """
+    # CSV format, header lines start with "#"
+    print '\nWrite results in ' + fname_output + '...'
+    fid_metric = open(fname_output, 'w')
+
+    # WRITE HEADER:
+    fid_metric.write('# Date - Time: '+ time.strftime('%Y/%m/%d - %H:%M:%S'))
+    for fname_data in list_fname_data:
+        fid_metric.write('\n'+'# Metric file: '+ os.path.abspath(fname_data))
+    if fname_normalizing_label:
+        fid_metric.write('\n' + '# Label used to normalize the metric estimation slice-by-slice: ' +
+                         fname_normalizing_label)
+    fid_metric.write('\n'+'# Extraction method: '+method)
+    for slices_of_interest, actual_vert, warning_vert_levels, metric_mean, metric_std in results:
+        if warning_vert_levels:
+            for warning in warning_vert_levels:
+                fid_metric.write('\n# '+str(warning))
+    fid_metric.write('%s' % ('\n'+'# metric file, vertebral levels, slices (z), ID, label name, mean, std\n\n'))
+
+    # WRITE RESULTS
+    for slices_of_interest, actual_vert, warning_vert_levels, metric_mean, metric_std in results:
+        vert = '%s to %s' % (int(actual_vert[0]), int(actual_vert[1])) if actual_vert else 'ALL'
+        slices = slices_of_interest.replace(',', ' ') if slices_of_interest else 'ALL'
+        for i_data, fname_data in enumerate(list_fname_data):
+            for i in range(0, len(ind_labels)):
+                fid_metric.write('%s, %s, %s, %i, %s, %f, %f\n' % (os.path.basename(fname_data), vert, slices, ind_labels[i], label_name[ind_labels[i]], metric_mean[i, i_data], metric_std[i, i_data]))
+
+    fid_metric.close()
+
+
 #=======================================================================================================================
 # Check the consistency of the methods asked by the user
 #=======================================================================================================================
@@ -692,100 +575,83 @@ def check_labels(labels_of_interest, nb_labels, average_labels, method):
 #=======================================================================================================================
 def extract_metric_within_tract(data, labels, method, verbose, ml_clusters='', adv_param=[]):
     """
-    :data: (nx,ny,nz) numpy array
-    :labels: nlabel tuple of (nx,ny,nz) array
+    :data: (nb_voxels) numpy array: metric in the voxels of the labels, or (nb_voxels x nb_metrics) to estimate several
+    metrics at once (the design matrix is factorized only once)
+    :labels: (nb_labels x nb_voxels) scipy.sparse matrix: weight of each label in each voxel
+    :return: metric_mean, metric_std: (nb_labels) arrays, or (nb_labels x nb_metrics) if several metrics were given
     """
 
-
-    nb_labels = len(labels)  # number of labels
+    nb_labels = labels.shape[0]  # number of labels
+    labels = csr_matrix(labels, dtype=np.float64, copy=True)
+    data = np.asarray(data, dtype=np.float64)
+    shape_output = (nb_labels,) + data.shape[1:]
+    data = data.reshape(data.shape[0], -1)
 
     # if user asks for binary regions, binarize atlas
     if method == 'bin':
-        for i in range(0, nb_labels):
-            labels[i][labels[i] < 0.5] = 0
-            labels[i][labels[i] >= 0.5] = 1
+        labels.data[labels.data < 0.5] = 0
+        labels.data[labels.data >= 0.5] = 1
 
     # if user asks for thresholded weighted-average, threshold atlas
     if method == 'wath':
-        for i in range(0, nb_labels):
-            labels[i][labels[i] < 0.5] = 0
+        labels.data[labels.data < 0.5] = 0
 
     #  Select non-zero values in the union of all labels
-    labels_sum = np.sum(labels)
-    ind_positive_labels = labels_sum > ALMOST_ZERO  # labels_sum > ALMOST_ZERO
-    # ind_positive_data = data > -9999999999  # data > 0
-    ind_positive = ind_positive_labels  # & ind_positive_data
-    data1d = data[ind_positive]
-    labels2d = np.empty([nb_labels, len(data1d)], dtype=float)
-    for i in range(0, nb_labels):
-        labels2d[i] = labels[i][ind_positive]
-
-    # # display labels
-    # import matplotlib.pyplot as plt
-    # plt.imshow(labels_sum[:,:,3])
-    # plt.show()
-    # plt.imshow(data[:,:,3])
-    # plt.show()
+    labels_sum = np.asarray(labels.sum(axis=0)).ravel()
+    ind_positive = np.flatnonzero(labels_sum > ALMOST_ZERO)
+    data2d = data[ind_positive]  # [nb_vox x nb_metrics]
+    labels2d = labels[:, ind_positive]
+    labels2d.eliminate_zeros()
 
     # clear memory
     del data, labels
 
     # Display number of non-zero values
-    sct.printv('  Number of non-null voxels: '+str(len(data1d)), verbose=verbose)
+    sct.printv('  Number of non-null voxels: '+str(data2d.shape[0]), verbose=verbose)
 
     # initialization
-    metric_mean = np.empty([nb_labels], dtype=object)
-    metric_std = np.empty([nb_labels], dtype=object)
-    nb_vox = len(data1d)
+    metric_mean = np.zeros([nb_labels, data2d.shape[1]])
+    metric_std = np.zeros([nb_labels, data2d.shape[1]])
 
     # Estimation with 3-class maximum likelihood
+    if method == 'ml' or method == 'map':
+        # normal equations: x = labels2d.T [nb_vox x nb_labels], y = data2d [nb_vox x nb_metrics]
+        xtx = labels2d.dot(labels2d.T).toarray()  # Xt . X [nb_labels x nb_labels]
+        xty = labels2d.dot(data2d)  # Xt . y [nb_labels x nb_metrics]
+
     if method == 'map':
         sct.printv('Estimation maximum likelihood within clustered labels...', verbose=verbose)
-        y = data1d  # [nb_vox x 1]
-        x = labels2d.T  # [nb_vox x nb_labels]
         # construct matrix with clusters of tracts
         ml_clusters_unique = np.unique(np.sort(ml_clusters))
         nb_clusters = len(ml_clusters_unique)
         sct.printv('  Number of clusters: '+str(nb_clusters), verbose=verbose)
-        # initialize cluster matrix
-        x_cluster = np.zeros([nb_vox, nb_clusters])
-        # loop across clusters
-        for i_cluster in ml_clusters_unique:
-            # find tracts belonging to cluster
-            index_tracts_in_cluster = np.where(ml_clusters == i_cluster)[0]
-            # sum tracts and append to matrix
-            x_cluster[:, i_cluster] = x[:, index_tracts_in_cluster].sum(axis=1)
-        x = x_cluster
+        # matrix of tracts belonging to each cluster [nb_labels x nb_clusters]: x_cluster = x . clusters
+        clusters = np.zeros([nb_labels, nb_clusters])
+        clusters[np.arange(nb_labels), ml_clusters.astype(int)] = 1
         # estimate values using ML
-        beta = np.dot( np.linalg.pinv(np.dot(x.T, x)), np.dot(x.T, y) )  # beta = (Xt . X)-1 . Xt . y
+        beta = solve_normal_equations(np.dot(clusters.T, np.dot(xtx, clusters)), np.dot(clusters.T, xty))  # beta = (Xt . X)-1 . Xt . y
         # display results
-        sct.printv('  Estimated beta per cluster: '+str(beta), verbose=verbose)
+        sct.printv('  Estimated beta per cluster: '+str(beta.T), verbose=verbose)
 
     # Estimation with weighted average (also works for binary)
     if method == 'wa' or method == 'bin' or method == 'wath':
-        for i_label in range(0, nb_labels):
-            # check if all labels are equal to zero
-            if sum(labels2d[i_label, :]) == 0:
-                print 'WARNING: labels #'+str(i_label)+' contains only null voxels. Mean and std are set to 0.'
-                metric_mean[i_label] = 0
-                metric_std[i_label] = 0
-            else:
-                # estimate the weighted average
-                metric_mean[i_label] = sum(data1d * labels2d[i_label, :]) / sum(labels2d[i_label, :])
-                # estimate the biased weighted standard deviation
-                metric_std[i_label] = np.sqrt(sum(labels2d[i_label, :] * (data1d - metric_mean[i_label])**2 ) / sum(labels2d[i_label, :]))
+        sum_labels = np.asarray(labels2d.sum(axis=1)).ravel()
+        # check if all labels are equal to zero
+        for i_label in np.flatnonzero(sum_labels == 0):
+            print 'WARNING: labels #'+str(i_label)+' contains only null voxels. Mean and std are set to 0.'
+        ind_labels = np.flatnonzero(sum_labels != 0)
+        # estimate the weighted average
+        metric_mean[ind_labels] = labels2d.dot(data2d)[ind_labels] / sum_labels[ind_labels, np.newaxis]
+        # estimate the biased weighted standard deviation
+        labels2d = labels2d.tocoo()
+        for i_metric in range(data2d.shape[1]):
+            residuals = np.bincount(labels2d.row, weights=labels2d.data * (data2d[labels2d.col, i_metric] - metric_mean[labels2d.row, i_metric])**2, minlength=nb_labels)
+            metric_std[ind_labels, i_metric] = np.sqrt(residuals[ind_labels] / sum_labels[ind_labels])
 
     # Estimation with maximum likelihood
     if method == 'ml':
-        y = data1d  # [nb_vox x 1]
-        x = labels2d.T  # [nb_vox x nb_labels]
-        beta = np.dot( np.linalg.pinv(np.dot(x.T, x)), np.dot(x.T, y) )  # beta = (Xt . X)-1 . Xt . y
-        #beta, residuals, rank, singular_value = np.linalg.lstsq(np.dot(x.T, x), np.dot(x.T, y), rcond=-1)
-        #beta, residuals, rank, singular_value = np.linalg.lstsq(x, y)
-        #print beta, residuals, rank, singular_value
-        for i_label in range(0, nb_labels):
-            metric_mean[i_label] = beta[i_label]
-            metric_std[i_label] = 0  # need to assign a value for writing output file
+        metric_mean[:] = solve_normal_equations(xtx, xty)  # beta = (Xt . X)-1 . Xt . y
+        # metric_std is set to 0: need to assign a value for writing output file
 
     # Estimation with maximum a posteriori (map)
     if method == 'map':
@@ -793,30 +659,36 @@ def extract_metric_within_tract(data, labels, method, verbose, ml_clusters='', a
         var_label = int(adv_param[0])^2  # variance within label
         var_noise = int(adv_param[1])^2  # variance of the noise (assumed Gaussian)
 
-        y = data1d  # [nb_vox x 1]
-        x = labels2d.T  # [nb_vox x nb_labels]
         # construct beta0
-        beta0 = np.zeros(nb_labels)
-        for i_cluster in range(nb_clusters):
-            beta0[np.where(ml_clusters == i_cluster)[0]] = beta[i_cluster]
+        beta0 = np.dot(clusters, beta)
         # construct covariance matrix (variance between tracts). For simplicity, we set it to be the identity.
         Rlabel = np.diag(np.ones(nb_labels))
-        # Vlabel =  np.diag(np.ones(nb_labels) * var_label)
-        # Vlabel =  np.diag(beta0 * perc_var_label * 0.01)  # [nb_labels x nb_labels]
-        # construct noise matrix
-        # Vnoise = np.diag(np.ones(nb_labels) * var_noise)
         # beta = beta0 + (Xt . X + var_noise/Var_label * Rlabel^-1)^-1 . Xt . ( y - X . beta0 )
-        # beta = beta0 +                      A                        . B  .         C
-        # A = np.linalg.pinv(np.dot(x.T, x) + np.dot(Vnoise, np.linalg.pinv(Vlabel)))
-        A = np.linalg.pinv(np.dot(x.T, x) + np.linalg.pinv(Rlabel) * var_noise/var_label)
-        B = x.T
-        C = y - np.dot(x, beta0)
-        beta = beta0 + np.dot(A, np.dot(B, C))
-        for i_label in range(0, nb_labels):
-            metric_mean[i_label] = beta[i_label]
-            metric_std[i_label] = 0  # need to assign a value for writing output file
+        # beta = beta0 +                      A^-1                     .        B
+        A = xtx + np.linalg.pinv(Rlabel) * var_noise/var_label
+        B = xty - np.dot(xtx, beta0)
+        metric_mean[:] = beta0 + solve_normal_equations(A, B)
+        # metric_std is set to 0: need to assign a value for writing output file
+
+    return metric_mean.reshape(shape_output), metric_std.reshape(shape_output)
+
 
-    return metric_mean, metric_std
+#=======================================================================================================================
+def solve_normal_equations(xtx, xty):
+    """
+    Solve (Xt . X) . beta = Xt . y for all columns of Xt . y, with one Cholesky factorization of Xt . X. If Xt . X is
+    singular (e.g. a label has no voxel in the selected slices), the minimum norm solution is computed with the
+    pseudo-inverse.
+    """
+    from scipy.linalg import cho_factor, cho_solve, LinAlgError
+    try:
+        factor = cho_factor(xtx)
+        diagonal = np.abs(np.diag(factor[0]))
+        if diagonal.min() > 1e-6 * diagonal.max():
+            return cho_solve(factor, xty)
+    except LinAlgError:
+        pass
+    return np.dot(np.linalg.pinv(xtx), xty)
 
 
 #=======================================================================================================================
@@ -824,11 +696,11 @@ def get_clusters(ml_clusters, labels):
     """
     identify cluster for each tract (for use with robust ML)
     :ml_clusters: clusters in form: 0:29,30,31
-    :labels: effective labels (can be less than nb_labels if user asked to group some labels)
+    :labels: effective labels [nb_labels x nb_voxels] (can be less than nb_labels if user asked to group some labels)
     :return: ml_clusters_array: tracts in form [0, 0, 0, ... 1, 2]
     """
     all_clusters = ml_clusters.split(',')
-    nb_labels = len(labels)
+    nb_labels = labels.shape[0]
     ml_clusters_array = np.zeros(nb_labels)
     nb_clusters = len(all_clusters)
     index_label = 0
@@ -864,12 +736,16 @@ DESCRIPTION
   This program extracts metrics (e.g., DTI or MTR) within labels. The labels are generated with
   'sct_warp_template'. The label folder contains a file (info_label.txt) that describes all labels.
   The labels should be in the same space coordinates as the input image.
+  The first time a label folder is used, its labels are compiled into a sparse matrix (file
+  info_label.npz in the label folder), which is reused by the following calls.
 
 USAGE
   """+os.path.basename(__file__)+""" -i <data> -f <folder_label>
 
 MANDATORY ARGUMENTS
-  -i <data>             file to extract metrics from
+  -i <data>             file to extract metrics from. Several files can be separated with commas
+                        (e.g. dti_FA.nii.gz,dti_MD.nii.gz): all metrics are estimated at once and
+                        written in one table.
   -f <folder_label>     folder including labels to extract the metric from.
 
 OPTIONAL ARGUMENTS
@@ -899,8 +775,11 @@ OPTIONAL ARGUMENTS
   -o <output>           File containing the results of metrics extraction.
                         Default = """+param_default.fname_output+"""
   -v <vmin:vmax>        Vertebral levels to estimate the metric across. Example: 2:9 for C2 to T2.
+                        Several ranges can be separated with ";" (results are written in one table).
+                        Example: "2:2;3:3;4:4". Use "all" for each vertebral level available.
   -z <zmin:zmax>        Slice range to estimate the metric from. First slice is 0. Example: 5:23
                         You can also select specific slices using commas. Example: 0,2,3,5,12
+                        Several selections can be separated with ";". Example: "0:4;5:9"
   -h                    help. Show this message
 
 EXAMPLE
@@ -911,7 +790,10 @@ EXAMPLE
     """+os.path.basename(__file__)+""" -f $SCT_DIR/data/atlas
 
   To compute FA within labels 0, 2 and 3 within vertebral levels C2 to C7 using binary method:
-    """+os.path.basename(__file__)+""" -i dti_FA.nii.gz -f label/atlas -l 0,2,3 -v 2:7 -m bin"""
+    """+os.path.basename(__file__)+""" -i dti_FA.nii.gz -f label/atlas -l 0,2,3 -v 2:7 -m bin
+
+  To compute FA and MD within all labels at each vertebral level from C2 to C4 using maximum a posteriori:
+    """+os.path.basename(__file__)+""" -i dti_FA.nii.gz,dti_MD.nii.gz -f label/atlas -v \"2:2;3:3;4:4\" -m map"""
 
     # display list of labels
     if label_references != '':
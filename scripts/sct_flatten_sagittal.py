@@ -34,6 +34,7 @@ import numpy
 
 import sct_utils as sct
 from msct_nurbs import NURBS
+from msct_centerline import Centerline
 from sct_utils import fsloutput
 from sct_orientation import get_orientation, set_orientation
 
@@ -140,12 +141,10 @@ def main():
     if (len(X) > 0): # Scenario 1
         for iz in range(min_z_index, max_z_index+1, 1):
             x_centerline[iz-min_z_index], y_centerline[iz-min_z_index] = numpy.unravel_index(data[:,:,iz].argmax(), data[:,:,iz].shape)
-    else: # Scenario 2
-        for iz in range(min_z_index, max_z_index+1, 1):
-            x_seg, y_seg = (data[:,:,iz]>0).nonzero()
-            if len(x_seg) > 0:
-                x_centerline[iz-min_z_index] = numpy.mean(x_seg)
-                y_centerline[iz-min_z_index] = numpy.mean(y_seg)
+    else: # Scenario 2: mean position of the voxels of each slice (not weighted by their value)
+        centerline = Centerline('tmp.centerline_orient.nii', data=data>0)
+        for iz, x, y in zip(centerline.z, centerline.x, centerline.y):
+            x_centerline[iz-min_z_index], y_centerline[iz-min_z_index] = x, y
 
     # TODO: find a way to do the previous loop with this, which is more neat:
     # [numpy.unravel_index(data[:,:,iz].argmax(), data[:,:,iz].shape) for iz in range(0,nz,1)]
@@ -164,10 +163,17 @@ def main():
         x_centerline_fit, y_centerline_fit = polynome_centerline(x_centerline,y_centerline,z_centerline)
 
     #==========================================================================================
-    # Split input volume
+    # Split input volume (slices are read one at a time from the file)
     print '\nSplit input volume...'
-    sct.run(sct.fsloutput + 'fslsplit tmp.anat_orient.nii tmp.anat_z -z')
+    from msct_image import Image
+    image_anat = Image('tmp.anat_orient.nii', verbose=0, lazy=True)
+    affine_anat = nibabel.load('tmp.anat_orient.nii').get_affine()
     file_anat_split = ['tmp.anat_z'+str(z).zfill(4) for z in range(0,nz,1)]
+    for iz, data_slice in enumerate(image_anat.iter_slices()):
+        affine_slice = affine_anat.copy()
+        affine_slice[:, 3] = affine_anat.dot([0, 0, iz, 1])
+        nibabel.save(nibabel.Nifti1Image(data_slice[:, :, numpy.newaxis], affine_slice, image_anat.hdr), file_anat_split[iz]+'.nii')
+    del image_anat
 
     # initialize variables
     file_mat_inv_cumul = ['tmp.mat_inv_cumul_z'+str(z).zfill(4) for z in range(0,nz,1)]
@@ -209,9 +215,12 @@ def main():
     # apply transformations to data
     print '\nApply fitted transformation matrices...'
     file_anat_split_fit = ['tmp.anat_orient_fit_z'+str(z).zfill(4) for z in range(0,nz,1)]
+    list_cmd = []
     for iz in range(0, nz, 1):
         # forward cumulative transformation to data
-        sct.run(fsloutput+'flirt -in '+file_anat_split[iz]+' -ref '+file_anat_split[iz]+' -applyxfm -init '+file_mat_inv_cumul_fit[iz]+' -out '+file_anat_split_fit[iz]+' -interp '+interp)
+        list_cmd.append(fsloutput+'flirt -in '+file_anat_split[iz]+' -ref '+file_anat_split[iz]+' -applyxfm -init '+file_mat_inv_cumul_fit[iz]+' -out '+file_anat_split_fit[iz]+' -interp '+interp)
+    # memory of one FLIRT job (in GB): process overhead, and about 4 images of the size of a slice, in float
+    sct.run_many(list_cmd, ram_per_job=0.1 + 4 * nx * ny * 4 / 1024.**3)
 
     # Merge into 4D volume
     print '\nMerge into 4D volume...'
@@ -18,6 +18,7 @@ import commands
 import getopt
 import time
 import math
+import numpy as np
 import sct_utils as sct
 import msct_moco as moco
 
@@ -42,6 +43,9 @@ class Param:
         self.interp = 'spline'  # nn, linear, spline
         self.min_norm = 0.001
         self.iterative_averaging = 1  # iteratively average target image for more robust moco
+        self.nb_workers = None  # number of volumes registered concurrently (None: see sct_utils.get_nb_workers)
+        self.stream = ''  # streaming mode: folder where volumes land, or '-' for file names on stdin
+        self.timeout = 60  # streaming mode: stop when no volume lands during this time (in s)
 
 
 #=======================================================================================================================
@@ -72,7 +76,7 @@ def main():
     else:
         # Check input parameters
         try:
-            opts, args = getopt.getopt(sys.argv[1:], 'hi:g:m:o:p:r:v:x:')
+            opts, args = getopt.getopt(sys.argv[1:], 'hi:g:m:n:o:p:r:s:t:v:x:')
         except getopt.GetoptError:
             usage()
         if not opts:
@@ -86,24 +90,31 @@ def main():
                 param.fname_data = arg
             elif opt in ('-m'):
                 param.fname_mask = arg
+            elif opt in ('-n'):
+                param.nb_workers = int(arg)
             elif opt in ('-o'):
                 path_out = arg
             elif opt in ('-p'):
                 param_user = arg
             elif opt in ('-r'):
                 param.remove_tmp_files = int(arg)
+            elif opt in ('-s'):
+                param.stream = arg
+            elif opt in ('-t'):
+                param.timeout = float(arg)
             elif opt in ('-v'):
                 param.verbose = int(arg)
             elif opt in ('-x'):
                 param.interp = arg
 
     # display usage if a mandatory argument is not provided
-    if param.fname_data == '':
+    if param.fname_data == '' and param.stream == '':
         sct.printv('ERROR: All mandatory arguments are not provided. See usage.', 1, 'error')
 
     # check existence of input files
     sct.printv('\nCheck file existence...', param.verbose)
-    sct.check_file_exist(param.fname_data, param.verbose)
+    if not param.fname_data == '':
+        sct.check_file_exist(param.fname_data, param.verbose)
     if not param.fname_mask == '':
         sct.check_file_exist(param.fname_mask, param.verbose)
 
@@ -118,41 +129,58 @@ def main():
     sct.printv('  input file ............'+param.fname_data, param.verbose)
 
     # Get full path
-    param.fname_data = os.path.abspath(param.fname_data)
+    path_input = os.getcwd()
+    if param.fname_data != '':
+        param.fname_data = os.path.abspath(param.fname_data)
     if param.fname_mask != '':
         param.fname_mask = os.path.abspath(param.fname_mask)
+    if param.stream not in ['', '-']:
+        param.stream = os.path.abspath(param.stream)
 
     # Extract path, file and extension
-    path_data, file_data, ext_data = sct.extract_fname(param.fname_data)
+    if param.fname_data != '':
+        path_data, file_data, ext_data = sct.extract_fname(param.fname_data)
+    else:
+        path_data, file_data, ext_data = '', 'fmri', '.nii'
 
     # create temporary folder
     sct.printv('\nCreate temporary folder...', param.verbose)
     path_tmp = sct.slash_at_the_end('tmp.'+time.strftime("%y%m%d%H%M%S"), 1)
     sct.run('mkdir '+path_tmp, param.verbose)
 
-    # Copying input data to tmp folder and convert to nii
-    # NB: cannot use c3d here because c3d cannot convert 4D data.
-    sct.printv('\nCopying input data to tmp folder and convert to nii...', param.verbose)
-    sct.run('cp '+param.fname_data+' '+path_tmp+'fmri'+ext_data, param.verbose)
+    if param.stream == '':
+        # Copying input data to tmp folder and convert to nii
+        # NB: cannot use c3d here because c3d cannot convert 4D data.
+        sct.printv('\nCopying input data to tmp folder and convert to nii...', param.verbose)
+        sct.run('cp '+param.fname_data+' '+path_tmp+'fmri'+ext_data, param.verbose)
+    else:
+        # streaming mode: outputs are written directly in the output folder (uncompressed, to be appended)
+        path_out = sct.slash_at_the_end(os.path.abspath(path_out), 1)
+        sct.create_folder(path_out)
 
     # go to tmp folder
     os.chdir(path_tmp)
 
-    # convert fmri to nii format
-    sct.run('fslchfiletype NIFTI fmri', param.verbose)
+    if param.stream == '':
+        # convert fmri to nii format
+        sct.run('fslchfiletype NIFTI fmri', param.verbose)
 
-    # run moco
-    fmri_moco(param)
+        # run moco
+        fmri_moco(param)
+    else:
+        # run moco on volumes as soon as they land
+        fmri_moco_stream(param, path_out+file_data+param.suffix+'.nii', path_input)
 
     # come back to parent folder
     os.chdir('..')
 
     # Generate output files
-    path_out = sct.slash_at_the_end(path_out, 1)
-    sct.create_folder(path_out)
-    sct.printv('\nGenerate output files...', param.verbose)
-    sct.generate_output_file(path_tmp+'fmri'+param.suffix+'.nii', path_out+file_data+param.suffix+ext_data, param.verbose)
-    sct.generate_output_file(path_tmp+'fmri'+param.suffix+'_mean.nii', path_out+file_data+param.suffix+'_mean'+ext_data, param.verbose)
+    if param.stream == '':
+        path_out = sct.slash_at_the_end(path_out, 1)
+        sct.create_folder(path_out)
+        sct.printv('\nGenerate output files...', param.verbose)
+        sct.generate_output_file(path_tmp+'fmri'+param.suffix+'.nii', path_out+file_data+param.suffix+ext_data, param.verbose)
+        sct.generate_output_file(path_tmp+'fmri'+param.suffix+'_mean.nii', path_out+file_data+param.suffix+'_mean'+ext_data, param.verbose)
 
     # Delete temporary files
     if param.remove_tmp_files == 1:
@@ -183,10 +211,6 @@ def fmri_moco(param):
     nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension(file_data+'.nii')
     sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), param.verbose)
 
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', param.verbose)
-    status, output = sct.run(fsloutput+'fslsplit ' + file_data + ' ' + file_data + '_T', param.verbose)
-
     # assign an index to each volume
     index_fmri = range(0, nt)
 
@@ -204,35 +228,15 @@ def fmri_moco(param):
         nb_groups += 1
         group_indexes.append(index_fmri[len(index_fmri)-nb_remaining:len(index_fmri)])
 
-    # groups
-    for iGroup in range(nb_groups):
-        sct.printv('\nGroup: ' +str((iGroup+1))+'/'+str(nb_groups), param.verbose)
-
-        # get index
-        index_fmri_i = group_indexes[iGroup]
-        nt_i = len(index_fmri_i)
-
-        # Merge Images
-        sct.printv('Merge consecutive volumes...', param.verbose)
-        file_data_merge_i = file_data + '_' + str(iGroup)
-        cmd = fsloutput + 'fslmerge -t ' + file_data_merge_i
-        for it in range(nt_i):
-            cmd = cmd + ' ' + file_data + '_T' + str(index_fmri_i[it]).zfill(4)
-        sct.run(cmd, param.verbose)
-
-        # Average Images
-        sct.printv('Average volumes...', param.verbose)
-        file_data_mean = file_data + '_mean_' + str(iGroup)
-        cmd = fsloutput + 'fslmaths ' + file_data_merge_i + ' -Tmean ' + file_data_mean
-        sct.run(cmd, param.verbose)
-
-    # Merge groups means
-    sct.printv('\nMerging volumes...', param.verbose)
+    # Average groups (one pass over the data) and write the volumes needed for registration
+    sct.printv('\nAverage groups of consecutive volumes...', param.verbose)
+    data_groups, header = moco.average_groups(file_data+'.nii', group_indexes, param.verbose)
     file_data_groups_means_merge = 'fmri_averaged_groups'
-    cmd = fsloutput + 'fslmerge -t ' + file_data_groups_means_merge
-    for iGroup in range(nb_groups):
-        cmd = cmd + ' ' + file_data + '_mean_' + str(iGroup)
-    sct.run(cmd, param.verbose)
+    moco.save_volumes(data_groups, header, file_data_groups_means_merge+'.nii')
+    # target for registration, and reference for reslicing when applying moco
+    for iGroup in set([param.num_target, 0]):
+        moco.save_volumes(data_groups[..., iGroup], header, file_data+'_mean_'+str(iGroup)+'.nii')
+    del data_groups
 
     # Estimate moco on dwi groups
     sct.printv('\n-------------------------------------------------------------------------------', param.verbose)
@@ -280,6 +284,149 @@ def fmri_moco(param):
     status, output = sct.run(cmd, param.verbose)
 
 
+#=======================================================================================================================
+# fmri_moco_stream: motion correction of fmri volumes as soon as they land
+#=======================================================================================================================
+def fmri_moco_stream(param, fname_out, path_input):
+    """
+    Motion correction of volumes as they land (see stream_volumes). Each group of param.group_size volumes is averaged
+    and registered to the target (first group, averaged with the next registered groups, as in moco), then the
+    transformation is applied to each volume of the group. Only the current group and the target are kept in memory, so
+    that the time to correct a volume does not depend on the length of the run.
+    Outputs (written as soon as a volume is corrected):
+    - fname_out: corrected volumes (4D, uncompressed NIfTI, see msct_moco.StreamWriter)
+    - <fname_out>_params.txt: for each volume, index, failed registration (1/0) and translations (x and y, in mm) of each
+      slice. A failed registration reuses the last good transformation.
+    - <fname_out>_mean.nii: mean of the corrected volumes (at the end of the stream)
+    """
+    from glob import glob
+    from nibabel import load
+    from msct_warp import WarpingChain
+
+    path_out, file_out, ext_out = sct.extract_fname(fname_out)
+    param.todo = 'estimate_and_apply'
+    file_mat = 'mat.T'
+    writer = None
+    file_params = open(path_out+file_out+'_params.txt', 'w')
+    header, shape, data_target, data_sum = None, None, None, None
+    nb_averaged = 0  # number of groups averaged with the target (iterative averaging)
+    warping_chain, translations = None, None  # last good transformation
+    nb_volumes = 0
+    group = []
+    volumes = stream_volumes(param.stream, param.timeout, path_input, param.verbose)
+    while True:
+        fname = next(volumes, None)
+        if fname is not None:
+            group.append(fname)
+            if len(group) < param.group_size:
+                continue
+        if not group:
+            break
+
+        # average the group
+        if header is None:
+            header = load(group[0]).get_header()
+            shape = header.get_data_shape()[0:3]
+            data_sum = np.zeros(shape)
+            writer = moco.StreamWriter(fname_out, header)
+            file_params.write('# volume failed '+' '.join(['x_Z'+str(iz)+' y_Z'+str(iz) for iz in range(shape[2])])+'\n')
+        data_group = np.mean([np.asarray(load(fname_volume).dataobj).astype(float).reshape(shape) for fname_volume in group], axis=0)
+        moco.save_volumes(data_group.astype(np.float32), header, 'group.nii')
+        if data_target is None:
+            # the first group is the target
+            data_target = data_group
+            moco.save_volumes(data_target.astype(np.float32), header, 'target.nii')
+
+        # register the group to the target. Outputs of the previous group are removed first, so that a registration
+        # that writes no output is detected as failed.
+        for fname_previous in ['group_moco.nii'] + glob(file_mat+'*Warp.nii.gz'):
+            if os.path.isfile(fname_previous):
+                os.remove(fname_previous)
+        failed = moco.register(param, 'group', 'target', file_mat, 'group_moco')
+        if not failed and not os.path.isfile(file_mat+'Warp.nii.gz'):
+            failed = 1
+        if not failed:
+            warping_chain = WarpingChain([file_mat+'Warp.nii.gz'], 'target.nii', verbose=0)
+            warping_chain.get_points()  # the transformation is composed before its file is overwritten
+            translations = get_translations(file_mat+'Warp.nii.gz')
+            # average registered group with target image
+            if param.iterative_averaging and nb_averaged < 10:
+                nb_averaged += 1
+                data_target = (data_target * nb_averaged + np.asarray(load('group_moco.nii').dataobj).reshape(shape)) / (nb_averaged + 1)
+                moco.save_volumes(data_target.astype(np.float32), header, 'target.nii')
+        elif warping_chain is None:
+            sct.printv('WARNING: no good transformation yet, volumes are not corrected.', param.verbose, 'warning')
+
+        # apply the transformation to each volume of the group, and write it
+        for fname_volume in group:
+            if warping_chain is not None:
+                data = np.asarray(warping_chain.resample(fname_volume, param.interp).dataobj).reshape(shape)
+            else:
+                data = np.asarray(load(fname_volume).dataobj).astype(float).reshape(shape)
+            writer.append(data)
+            data_sum += data
+            values = translations if translations is not None else np.zeros((shape[2], 2))
+            file_params.write(str(nb_volumes)+' '+str(int(failed))+' '+' '.join(['%.4f' % v for v in values.ravel()])+'\n')
+            file_params.flush()
+            sct.printv('Volume '+str(nb_volumes)+' ('+os.path.basename(fname_volume)+'): mean translation x='+('%.3f' % values[:, 0].mean())+' y='+('%.3f' % values[:, 1].mean())+' mm'+(' (failed)' if failed else ''), param.verbose)
+            nb_volumes += 1
+        group = []
+
+    file_params.close()
+    if writer is None:
+        sct.printv('ERROR: no volume received.', 1, 'error')
+    writer.close()
+    moco.save_volumes((data_sum / nb_volumes).astype(np.float32), header, path_out+file_out+'_mean.nii')
+    sct.printv('\n'+str(nb_volumes)+' volumes corrected: '+fname_out, param.verbose)
+
+
+#=======================================================================================================================
+# stream_volumes: file names of volumes, as soon as they land
+#=======================================================================================================================
+def stream_volumes(source, timeout, path_input, verbose):
+    """
+    Generate the file names of volumes (3D NIfTI) as they land.
+    :param source: '-': file names on stdin (one per line, relative to path_input), until the end of the input.
+    Otherwise, folder: .nii and .nii.gz files (in alphabetical order) once their size does not change between two checks.
+    The stream ends when no volume lands during timeout (in s).
+    """
+    if source == '-':
+        for line in iter(sys.stdin.readline, ''):
+            if line.strip():
+                yield os.path.join(path_input, line.strip())
+        return
+    folder = sct.slash_at_the_end(source, 1)
+    sct.printv('\nWait for volumes in '+folder+' (timeout: '+str(timeout)+' s)...', verbose)
+    done, size = set(), dict()
+    time_last = time.time()
+    while time.time() - time_last < timeout:
+        list_fname = sorted([f for f in os.listdir(folder) if f not in done and (f.endswith('.nii') or f.endswith('.nii.gz'))])
+        nb_done = len(done)
+        for fname in list_fname:
+            size_last, size[fname] = size.get(fname), os.path.getsize(folder+fname)
+            if size_last != size[fname]:
+                # just landed or still being written: wait for the next check (and keep the order of volumes)
+                break
+            done.add(fname)
+            del size[fname]
+            time_last = time.time()
+            yield folder+fname
+        if len(done) == nb_done:
+            time.sleep(0.5)
+
+
+#=======================================================================================================================
+# get_translations: translation of each slice in a warping field of isct_antsSliceRegularizedRegistration
+#=======================================================================================================================
+def get_translations(fname_warp):
+    """Return translations (x and y, in mm) of each slice: array [nz x 2]."""
+    from nibabel import load
+
+    data_warp = np.asarray(load(fname_warp).dataobj)
+    nx, ny, nz = data_warp.shape[0:3]
+    return np.median(data_warp[:, :, :, 0, 0:2].reshape(nx*ny, nz, 2), axis=0)
+
+
 #=======================================================================================================================
 # usage
 #=======================================================================================================================
@@ -315,13 +462,19 @@ OPTIONAL ARGUMENTS
                      4) metric: {MI,MeanSquares}.
                         If you find very large deformations, switching to MeanSquares can help.
   -o <path_out>    Output path.
+  -n <int>         number of volumes registered concurrently. Default: $SCT_NB_WORKERS or number of CPUs
+  -s <folder>      streaming mode: correct each volume (3D NIfTI) as soon as it lands in folder, or read the file
+                   names of volumes on stdin with "-s -". Corrected volumes are appended to <output>"""+param_default.suffix+""".nii
+                   and motion parameters are written in <output>"""+param_default.suffix+"""_params.txt. -i is then optional.
+  -t <seconds>     streaming mode: stop when no volume lands during this time. Default="""+str(param_default.timeout)+"""
   -x {nn,linear,spline}  Final Interpolation. Default="""+str(param_default.interp)+"""
   -v {0,1}         verbose. Default="""+str(param_default.verbose)+"""
   -r {0,1}         remove temporary files. Default="""+str(param_default.remove_tmp_files)+"""
   -h               help. Show this message
 
 EXAMPLE
-  """+os.path.basename(__file__)+""" -i fmri.nii.gz\n"""
+  """+os.path.basename(__file__)+""" -i fmri.nii.gz
+  """+os.path.basename(__file__)+""" -s incoming_volumes/ -o moco/\n"""
 
     #Exit Program
     sys.exit(2)
@@ -17,7 +17,6 @@ import os
 import getopt
 import commands
 import sct_utils as sct
-import time
 
 
 # DEFAULT PARAMETERS
@@ -82,8 +81,6 @@ def main():
 #=======================================================================================================================
 def get_or_set_orientation():
 
-    fsloutput = 'export FSLOUTPUTTYPE=NIFTI; '  # for faster processing, all outputs are in NIFTI
-
     # display usage if a mandatory argument is not provided
     if param.fname_data == '':
         sct.printv('ERROR: All mandatory arguments are not provided. See usage.', 1, 'error')
@@ -114,77 +111,19 @@ def get_or_set_orientation():
     else:
         fname_out = param.fname_out
 
-    # create temporary folder
-    sct.printv('\nCreate temporary folder...', param.verbose)
-    path_tmp = sct.slash_at_the_end('tmp.'+time.strftime("%y%m%d%H%M%S"), 1)
-    sct.run('mkdir '+path_tmp, param.verbose)
-
-    # Copying input data to tmp folder and convert to nii
-    # NB: cannot use c3d here because c3d cannot convert 4D data.
-    sct.printv('\nCopying input data to tmp folder and convert to nii...', param.verbose)
-    sct.run('cp '+param.fname_data+' '+path_tmp+'data'+ext_data, param.verbose)
-
-    # go to tmp folder
-    os.chdir(path_tmp)
-
-    # convert to nii format
-    sct.run('fslchfiletype NIFTI data', param.verbose)
-
-    # Get dimensions of data
-    sct.printv('\nGet dimensions of data...', param.verbose)
-    nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension('data.nii')
-    sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz)+ ' x ' + str(nt), param.verbose)
-
-    # if 4d, loop across the data
-    if nt == 1:
-        if todo == 'set_orientation':
-            # set orientation
-            sct.printv('\nChange orientation...', param.verbose)
-            if param.change_header is '':
-                set_orientation('data.nii', param.orientation, 'data_orient.nii')
-            else:
-                set_orientation('data.nii', param.change_header, 'data_orient.nii', True)
-        elif todo == 'get_orientation':
-            # get orientation
-            sct.printv('\nGet orientation...', param.verbose)
-            sct.printv(get_orientation('data.nii'), 1)
-
-    else:
-        # split along T dimension
-        sct.printv('\nSplit along T dimension...', param.verbose)
-        sct.run(fsloutput+'fslsplit data data_T', param.verbose)
-
-        if todo == 'set_orientation':
-            # set orientation
-            sct.printv('\nChange orientation...', param.verbose)
-            for it in range(nt):
-                file_data_split = 'data_T'+str(it).zfill(4)+'.nii'
-                file_data_split_orient = 'data_orient_T'+str(it).zfill(4)+'.nii'
-                set_orientation(file_data_split, param.orientation, file_data_split_orient)
-            # Merge files back
-            sct.printv('\nMerge file back...', param.verbose)
-            cmd = fsloutput+'fslmerge -t data_orient'
-            for it in range(nt):
-                file_data_split_orient = 'data_orient_T'+str(it).zfill(4)+'.nii'
-                cmd = cmd+' '+file_data_split_orient
-            sct.run(cmd, param.verbose)
-
-        elif todo == 'get_orientation':
-            sct.printv('\nGet orientation...', param.verbose)
-            sct.printv(get_orientation('data_T0000.nii'), 1)
-
-    # come back to parent folder
-    os.chdir('..')
-
-    # Generate output files
+    # 3D and 4D data are handled the same way (the 4th dimension is left untouched)
     if todo == 'set_orientation':
-        sct.printv('\nGenerate output files...', param.verbose)
-        sct.generate_output_file(path_tmp+'data_orient.nii', fname_out)
-
-    # Remove temporary files
-    if param.remove_tmp_files == 1:
-        sct.printv('\nRemove temporary files...', param.verbose)
-        sct.run('rm -rf '+path_tmp, param.verbose)
+        # set orientation
+        sct.printv('\nChange orientation...', param.verbose)
+        if param.change_header is '':
+            set_orientation(param.fname_data, param.orientation, fname_out)
+        else:
+            set_orientation(param.fname_data, param.change_header, fname_out, True)
+        sct.printv('  File created: '+fname_out, param.verbose)
+    elif todo == 'get_orientation':
+        # get orientation
+        sct.printv('\nGet orientation...', param.verbose)
+        sct.printv(get_orientation(param.fname_data), 1)
 
     # to view results
     if todo == 'set_orientation':
@@ -204,35 +143,121 @@ def check_orientation_input():
         return -1
 
 
-# get_orientation (uses FSL)
+# Orientation engine
+# ==========================================================================================
+# Orientations follow the FSL/SCT convention: each character is the side an axis comes FROM. E.g. RPI means that x goes
+# from Right to Left, y from Posterior to Anterior and z from Inferior to Superior (i.e. LAS for nibabel).
+opposite_character = {'L': 'R', 'R': 'L', 'A': 'P', 'P': 'A', 'I': 'S', 'S': 'I'}
+
+
+# get_orientation
 # ==========================================================================================
 def get_orientation(fname):
-    status, output = sct.run('fslhd '+fname, 0)
-    # status, output = sct.run('isct_orientation3d -i '+fname+' -get', 0)
-    # orientation = output[26:]
-    orientation = output[output.find('sform_xorient')+15:output.find('sform_xorient')+16]+ \
-                  output[output.find('sform_yorient')+15:output.find('sform_yorient')+16]+ \
-                  output[output.find('sform_zorient')+15:output.find('sform_zorient')+16]
+    """Get orientation of a nifti file from its sform (or qform if sform is not set). Voxel data are not loaded."""
+    from nibabel import load
+    return get_orientation_from_header(load(fname).get_header())
 
-    # check if orientation is specified in an other part of the header
-    if orientation == 'UUU':
-        orientation = output[output.find('qform_xorient')+15:output.find('qform_xorient')+16]+ \
-                      output[output.find('qform_yorient')+15:output.find('qform_yorient')+16]+ \
-                      output[output.find('qform_zorient')+15:output.find('qform_zorient')+16]
-    return orientation
+
+def get_orientation_from_header(hdr):
+    """Get orientation (e.g. 'RPI') from a nibabel header. Returns 'UUU' if it cannot be determined."""
+    from nibabel.orientations import aff2axcodes
+    try:
+        axcodes = aff2axcodes(hdr.get_best_affine())
+    except Exception:
+        return 'UUU'
+    # nibabel gives the side the axis goes TO
+    return ''.join([opposite_character[c] if c is not None else 'U' for c in axcodes])
+
+
+# get_orientation_transform
+# ==========================================================================================
+def get_orientation_transform(orientation_in, orientation_out):
+    """
+    Compute the axes permutation and flips to go from orientation_in to orientation_out.
+    :return: perm, flip: new axis i is old axis perm[i], reversed if flip[i] == -1
+    """
+    perm = [0, 1, 2]
+    flip = [1, 1, 1]
+    for i, character in enumerate(orientation_out):
+        if character in orientation_in:
+            perm[i] = orientation_in.index(character)
+        elif opposite_character.get(character, '') in orientation_in:
+            perm[i] = orientation_in.index(opposite_character[character])
+            flip[i] = -1
+        else:
+            raise ValueError('Cannot change orientation from '+orientation_in+' to '+orientation_out)
+    if sorted(perm) != [0, 1, 2]:
+        raise ValueError('Cannot change orientation from '+orientation_in+' to '+orientation_out)
+    return perm, flip
+
+
+# reorient_data
+# ==========================================================================================
+def reorient_data(data, orientation_in, orientation_out):
+    """
+    Reorient a 3D or 4D array by transposing and flipping its three first axes. Extra dimensions (e.g. time) are kept
+    untouched. The output is a view on the input array: no data are copied.
+    """
+    perm, flip = get_orientation_transform(orientation_in, orientation_out)
+    data = data.transpose(perm + range(3, data.ndim))
+    return data[tuple([slice(None, None, f) for f in flip])]
+
+
+# reorient_affine
+# ==========================================================================================
+def reorient_affine(affine, shape, orientation_in, orientation_out):
+    """Return the voxel-to-world affine of the data reoriented with reorient_data. shape is the input data shape."""
+    from numpy import zeros, dot
+    perm, flip = get_orientation_transform(orientation_in, orientation_out)
+    # matrix going from new voxel coordinates to old voxel coordinates
+    new2old = zeros((4, 4))
+    new2old[3, 3] = 1
+    for i in range(3):
+        new2old[perm[i], i] = flip[i]
+        if flip[i] == -1:
+            new2old[perm[i], 3] = shape[perm[i]] - 1
+    return dot(affine, new2old)
+
+
+# reorient_header
+# ==========================================================================================
+def reorient_header(hdr, shape, orientation_in, orientation_out):
+    """Return a copy of a nifti header matching the data reoriented with reorient_data. shape is the input data shape."""
+    perm, flip = get_orientation_transform(orientation_in, orientation_out)
+    hdr = hdr.copy()
+    shape = list(shape)
+    # get transforms before changing pixdim (the qform depends on it)
+    sform_code, qform_code = int(hdr['sform_code']), int(hdr['qform_code'])
+    sform, qform = hdr.get_sform(), hdr.get_qform()
+    zooms = list(hdr.get_zooms()) + [1.0] * (len(shape) - len(hdr.get_zooms()))
+    hdr.set_data_shape([shape[p] for p in perm] + shape[3:])
+    hdr.set_zooms([zooms[p] for p in perm] + zooms[3:len(shape)])
+    # update qform and sform, keeping their codes
+    if sform_code > 0:
+        hdr.set_sform(reorient_affine(sform, shape, orientation_in, orientation_out), sform_code)
+    if qform_code > 0:
+        hdr.set_qform(reorient_affine(qform, shape, orientation_in, orientation_out), qform_code)
+    return hdr
 
 
 # set_orientation
 # ==========================================================================================
 def set_orientation(fname_in, orientation, fname_out, inversion=False):
-    if not inversion:
-        sct.run('isct_orientation3d -i '+fname_in+' -orientation '+orientation+' -o '+fname_out, 0)
-    else:
-        from msct_image import Image
-        input_image = Image(fname_in)
-        input_image.change_orientation(orientation, True)
-        input_image.setFileName(fname_out)
-        input_image.save()
+    """
+    Change orientation of a 3D or 4D nifti file and save it as fname_out (.nii is added if there is no extension).
+    If inversion is True, orientation is the actual orientation of the data, and the data are changed to match the
+    orientation of the header (the header is left unchanged).
+    """
+    from msct_image import Image
+    if sct.extract_fname(fname_out)[2] == '':
+        fname_out += '.nii'
+    input_image = Image(fname_in)
+    if os.path.abspath(fname_in) == os.path.abspath(fname_out):
+        # data might be memory-mapped on the file we are about to overwrite
+        input_image.data = input_image.data.copy()
+    input_image.change_orientation(orientation, inversion)
+    input_image.setFileName(fname_out)
+    input_image.save()
     # return full path
     return os.path.abspath(fname_out)
 
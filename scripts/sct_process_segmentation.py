@@ -29,6 +29,8 @@ import sct_utils as sct
 from msct_nurbs import NURBS
 from sct_orientation import get_orientation, set_orientation
 from sct_straighten_spinalcord import smooth_centerline
+from msct_centerline import Centerline, get_tangents
+from msct_vertebral_levels import VertebralLevels
 
 
 # DEFAULT PARAMETERS
@@ -43,6 +45,7 @@ class Param:
         self.smoothing_param = 50  # window size (in mm) for smoothing CSA along z. 0 for no smoothing.
         self.figure_fit = 0
         self.fname_csa = 'csa.txt'  # output name for txt CSA
+        self.fname_shape = 'shape.txt'  # output name for txt shape (-p shape)
         self.name_output = 'csa_volume.nii.gz'  # output name for slice CSA
         self.name_method = 'counting_z_plane'  # for compute_CSA
         self.slices = ''
@@ -65,7 +68,7 @@ def main():
     status, path_sct = commands.getstatusoutput('echo $SCT_DIR')
     fname_segmentation = ''
     name_process = ''
-    processes = ['centerline', 'csa', 'length']
+    processes = ['centerline', 'csa', 'length', 'shape']
     method_CSA = ['counting_ortho_plane', 'counting_z_plane', 'ellipse_ortho_plane', 'ellipse_z_plane']
     name_method = param.name_method
     volume_output = param.volume_output
@@ -170,6 +173,11 @@ def main():
             sct.printv('Output CSA file (averaged): csa_mean.txt', param.verbose, 'info')
         sct.printv('Output CSA file (all slices): '+param.fname_csa+'\n', param.verbose, 'info')
 
+    if name_process == 'shape':
+        fname_shape = compute_shape(fname_segmentation, verbose=verbose)
+        sct.printv('\nDone!', param.verbose)
+        sct.printv('Output shape file (all slices): '+fname_shape+'\n', param.verbose, 'info')
+
     if name_process == 'length':
         result_length = compute_length(fname_segmentation, remove_temp_files, verbose=verbose)
         sct.printv('\nLength of the segmentation = '+str(round(result_length,2))+' mm\n', verbose, 'info')
@@ -261,19 +269,12 @@ def extract_centerline(fname_segmentation, remove_temp_files, name_output='', ve
     # Extract min and max index in Z direction
     X, Y, Z = (data>0).nonzero()
     min_z_index, max_z_index = min(Z), max(Z)
-    x_centerline = [0 for i in range(0,max_z_index-min_z_index+1)]
-    y_centerline = [0 for i in range(0,max_z_index-min_z_index+1)]
-    z_centerline = [iz for iz in range(min_z_index, max_z_index+1)]
-    # Extract segmentation points and average per slice
-    for iz in range(min_z_index, max_z_index+1):
-        x_seg, y_seg = (data[:,:,iz]>0).nonzero()
-        x_centerline[iz-min_z_index] = np.mean(x_seg)
-        y_centerline[iz-min_z_index] = np.mean(y_seg)
-    for k in range(len(X)):
-        data[X[k], Y[k], Z[k]] = 0
+    data[X, Y, Z] = 0
 
-    # extract centerline and smooth it
-    x_centerline_fit, y_centerline_fit, z_centerline_fit, x_centerline_deriv,y_centerline_deriv,z_centerline_deriv = smooth_centerline(fname_segmentation_orient, type_window = type_window, window_length = window_length, algo_fitting = algo_fitting, verbose = verbose)
+    # extract centerline (average of segmentation points per slice) and smooth it
+    centerline = Centerline(fname_segmentation_orient, verbose=verbose).fit(algo_fitting=algo_fitting, type_window=type_window, window_length=window_length)
+    x_centerline, y_centerline, z_centerline = centerline.x, centerline.y, centerline.z
+    x_centerline_fit, y_centerline_fit, z_centerline_fit = centerline.x_fit, centerline.y_fit, centerline.z_fit
 
     if verbose == 2:
             import matplotlib.pyplot as plt
@@ -362,7 +363,7 @@ def compute_csa(fname_segmentation, name_method, volume_output, verbose, remove_
 
     # Copying input data to tmp folder and convert to nii
     sct.printv('\nCopying input data to tmp folder and convert to nii...', verbose)
-    sct.run('isct_c3d '+fname_segmentation+' -o '+path_tmp+'segmentation.nii')
+    nibabel.save(nibabel.load(fname_segmentation), path_tmp+'segmentation.nii')
 
     # go to tmp folder
     os.chdir(path_tmp)
@@ -396,21 +397,21 @@ def compute_csa(fname_segmentation, name_method, volume_output, verbose, remove_
 
     # Empty arrays in which CSA for each z slice will be stored
     csa = np.zeros(max_z_index-min_z_index+1)
-    # csa = [0.0 for i in xrange(0, max_z_index-min_z_index+1)]
-
-    for iz in xrange(0, len(z_centerline)):
-
-        # compute the vector normal to the plane
-        normal = normalize(np.array([x_centerline_deriv[iz], y_centerline_deriv[iz], z_centerline_deriv[iz]]))
-
-        # compute the angle between the normal vector of the plane and the vector z
-        angle = np.arccos(np.dot(normal, [0, 0, 1]))
-
-        # compute the number of voxels, assuming the segmentation is coded for partial volume effect between 0 and 1.
-        number_voxels = sum(sum(data_seg[:, :, iz+min_z_index]))
+    z_centerline = np.round(z_centerline).astype(int)
 
+    if name_method == 'counting_ortho_plane':
+        # resample the segmentation on planes orthogonal to the centerline
+        sct.printv('.. Resample segmentation on planes orthogonal to the centerline (step='+str(step)+' mm)', verbose)
+        csa[z_centerline-min_z_index] = compute_csa_ortho_plane(data_seg, x_centerline_fit, y_centerline_fit, z_centerline, px, py, pz, step)
+    else:
+        # compute the number of voxels of all slices, assuming the segmentation is coded for partial volume effect
+        # between 0 and 1.
+        number_voxels = data_seg[:, :, z_centerline].sum(axis=(0, 1), dtype=np.float64)
+        # cosine of the angle between the vector normal to the plane and the vector z
+        deriv = np.array([x_centerline_deriv, y_centerline_deriv, z_centerline_deriv], dtype=np.float64)
+        cos_angle = deriv[2] / np.sqrt((deriv ** 2).sum(axis=0))
         # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
-        csa[iz] = number_voxels * px * py * np.cos(angle)
+        csa[z_centerline-min_z_index] = number_voxels * px * py * cos_angle
 
     if smoothing_param:
         from msct_smooth import smoothing_window
@@ -440,21 +441,17 @@ def compute_csa(fname_segmentation, name_method, volume_output, verbose, remove_
         sct.printv('z='+str(i-min_z_index)+': '+str(csa[i-min_z_index])+' mm^2', verbose, 'bold')
     file_results.close()
 
+    # weight of each slice to average CSA across slices (number of voxels of the segmentation)
+    weight_slices = data_seg.sum(axis=(0, 1), dtype=np.float64)
+
     # output volume of csa values
     if volume_output:
         sct.printv('\nCreate volume of CSA values...', verbose)
         # get orientation of the input data
         orientation = get_orientation('segmentation.nii')
         data_seg = data_seg.astype(np.float32, copy=False)
-        # loop across slices
-        for iz in range(min_z_index, max_z_index+1):
-            # retrieve seg pixels
-            x_seg, y_seg = (data_seg[:, :, iz] > 0).nonzero()
-            seg = [[x_seg[i],y_seg[i]] for i in range(0, len(x_seg))]
-            # loop across pixels in segmentation
-            for i in seg:
-                # replace value with csa value
-                data_seg[i[0], i[1], iz] = csa[iz-min_z_index]
+        # replace value of segmentation pixels with csa value of their slice
+        data_seg[X, Y, Z] = csa[Z-min_z_index]
         # create header
         hdr_seg.set_data_dtype('float32')  # set imagetype to uint8
         # save volume
@@ -481,34 +478,43 @@ def compute_csa(fname_segmentation, name_method, volume_output, verbose, remove_
         elif vert_levels and path_to_template:
             abs_path_to_template = os.path.abspath(path_to_template)
 
-        # go to tmp folder
-        os.chdir(path_tmp)
-
-        # create temporary folder
-        sct.printv('\nCreate temporary folder to average csa...', verbose)
-        path_tmp_extract_metric = sct.slash_at_the_end('label_temp', 1)
-        sct.run('mkdir '+path_tmp_extract_metric, verbose)
+        from sct_extract_metric import get_slices_list, save_metrics, save_metrics_batch
 
-        # Copying output CSA volume in the temporary folder
-        sct.printv('\nCopy data to tmp folder...', verbose)
-        sct.run('cp '+fname_segmentation+' '+path_tmp_extract_metric)
-
-        # create file info_label
-        path_fname_seg, file_fname_seg, ext_fname_seg = sct.extract_fname(fname_segmentation)
-        create_info_label('info_label.txt', path_tmp_extract_metric, file_fname_seg+ext_fname_seg)
-
-        # average CSA
-        if slices:
-            os.system("sct_extract_metric -i "+path_data+name_output+" -f "+path_tmp_extract_metric+" -m wa -o ../csa_mean.txt -z "+slices)
+        # slices of each selection (vertebral levels are found with the index of the vertebral labeling)
         if vert_levels:
-            sct.run('cp -R '+abs_path_to_template+' .')
-            os.system("sct_extract_metric -i "+path_data+name_output+" -f "+path_tmp_extract_metric+" -m wa -o ../csa_mean.txt -v "+vert_levels)
-
-        os.chdir('..')
-
-        # Remove temporary files
-        print('\nRemove temporary folder used to average CSA...')
-        sct.run('rm -rf '+path_tmp_extract_metric)
+            fname_vertebral_labeling = sct.find_file_within_folder('MNI-Poly-AMU_level.nii.gz', abs_path_to_template)
+            if not fname_vertebral_labeling:
+                sct.printv('\nERROR: No file named MNI-Poly-AMU_level.nii.gz was found in '+abs_path_to_template+'\n', 1, 'error')
+            vertebral_index = VertebralLevels(fname_vertebral_labeling[0], verbose)
+            if vertebral_index.shape != data_seg.shape[0:3]:
+                sct.printv('\nERROR: Size of the vertebral labeling is not the same as the segmentation.\n', 1, 'error')
+            list_vert_levels = vertebral_index.get_all_levels() if vert_levels == 'all' else vert_levels.split(';')
+            selections = [vertebral_index.get_slices(levels) for levels in list_vert_levels]
+        else:
+            selections = [(slices_of_interest, None, None) for slices_of_interest in slices.split(';')]
+
+        # average CSA across the slices of each selection, weighted by the number of voxels of the segmentation
+        sct.printv('\nAverage CSA...', verbose)
+        results = []
+        for slices_of_interest, actual_vert_levels, warning_vert_levels in selections:
+            z = np.array(get_slices_list(slices_of_interest))
+            z = z[(z >= min_z_index) & (z <= max_z_index)]
+            weight, csa_slices = weight_slices[z], csa[z-min_z_index]
+            if np.sum(weight) == 0:
+                sct.printv('WARNING: no voxel of the segmentation in slices '+slices_of_interest+'. Mean and std are set to 0.', 1, 'warning')
+                csa_mean, csa_std = 0.0, 0.0
+            else:
+                csa_mean = np.sum(weight * csa_slices) / np.sum(weight)
+                csa_std = np.sqrt(np.sum(weight * (csa_slices - csa_mean)**2) / np.sum(weight))
+            results.append((slices_of_interest, actual_vert_levels, warning_vert_levels, np.array([[csa_mean]]), np.array([[csa_std]])))
+            sct.printv('  '+(str(actual_vert_levels) if actual_vert_levels else slices_of_interest)+': '+str(csa_mean)+' +/- '+str(csa_std)+' mm^2', verbose, 'info')
+
+        if len(results) == 1:
+            slices_of_interest, actual_vert_levels, warning_vert_levels, csa_mean, csa_std = results[0]
+            save_metrics([0], ['mean CSA'], slices_of_interest, csa_mean[:, 0], csa_std[:, 0], 'csa_mean.txt',
+                         path_data+name_output, 'wa', '', actual_vert_levels, warning_vert_levels)
+        else:
+            save_metrics_batch([0], ['mean CSA'], [path_data+name_output], results, 'csa_mean.txt', 'wa', '')
 
     # Remove temporary files
     if remove_temp_files:
@@ -516,18 +522,194 @@ def compute_csa(fname_segmentation, name_method, volume_output, verbose, remove_
         sct.run('rm -rf '+path_tmp)
 
 
-#=======================================================================================================================
-# create text file info_label.txt
-#=======================================================================================================================
-def create_info_label(file_name, path_folder, fname_seg):
-
-    os.chdir(path_folder)
-    file_info_label = open(file_name, 'w')
-    file_info_label.write('# Spinal cord segmentation\n')
-    file_info_label.write('# ID, name, file\n')
-    file_info_label.write('0, mean CSA, '+fname_seg)
-    file_info_label.close()
-    os.chdir('..')
+# compute_csa_ortho_plane
+# ==========================================================================================
+def compute_csa_ortho_plane(data_seg, x_centerline, y_centerline, z_centerline, px, py, pz, step, nb_points_batch=1000000):
+    """
+    Compute the cross-sectional area on planes orthogonal to the centerline. The segmentation (in RPI orientation) is
+    linearly interpolated on a square grid of each plane, all planes being resampled at once (by batches of slices).
+    :param data_seg: segmentation, coded for partial volume effect between 0 and 1
+    :param x_centerline, y_centerline, z_centerline: centerline, in voxels
+    :param step: size of the grid of the planes, in mm
+    :return: csa (in mm^2) of each point of the centerline
+    """
+    from scipy.ndimage import map_coordinates
+
+    scale = np.array([px, py, pz], dtype=np.float64)
+    center = np.array([x_centerline, y_centerline, z_centerline], dtype=np.float64).T * scale
+    # tangent to the centerline (in mm)
+    tangent = get_tangents(center)
+    # in-plane axes: x axis of the image orthogonalized to the tangent, and cross product
+    u = np.array([1.0, 0.0, 0.0]) - tangent[:, 0:1] * tangent
+    u /= np.sqrt((u ** 2).sum(axis=1))[:, np.newaxis]
+    v = np.cross(tangent, u)
+
+    # half size of the planes: largest in-plane distance between the centerline and the segmentation, with a margin
+    # for the obliquity of the planes
+    X, Y, Z = (data_seg > 0).nonzero()
+    index_z = -np.ones(data_seg.shape[2], dtype=int)
+    index_z[z_centerline] = np.arange(len(z_centerline))
+    inside = index_z[Z] >= 0
+    dist = np.sqrt(((X[inside] * px - center[index_z[Z[inside]], 0]) ** 2 + (Y[inside] * py - center[index_z[Z[inside]], 1]) ** 2).max())
+    coord = np.arange(-int(np.ceil(1.5 * dist / step)) - 2, int(np.ceil(1.5 * dist / step)) + 3) * step
+    a, b = [g.ravel() for g in np.meshgrid(coord, coord, indexing='ij')]
+
+    csa = np.zeros(len(z_centerline))
+    nb_slices_batch = max(1, nb_points_batch / len(a))
+    for iz in xrange(0, len(z_centerline), nb_slices_batch):
+        batch = slice(iz, iz+nb_slices_batch)
+        # points of the planes, in voxels: (3, nb_slices, nb_points)
+        points = center[batch, :, np.newaxis] + u[batch, :, np.newaxis] * a + v[batch, :, np.newaxis] * b
+        points /= scale[:, np.newaxis]
+        values = map_coordinates(data_seg, points.transpose(1, 0, 2), output=np.float64, order=1, mode='constant', cval=0.0)
+        csa[batch] = values.sum(axis=1) * step ** 2
+    return csa
+
+
+# compute_shape
+# ==========================================================================================
+def compute_shape(fname_segmentation, verbose=1):
+    """
+    Fit an ellipse on the boundary of each axial slice of the segmentation and write a table of the shape of the cord
+    (diameters, eccentricity and orientation) for all slices in shape.txt.
+    :return: name of the output text file
+    """
+    from sct_orientation import get_orientation_from_header, reorient_data, reorient_header
+
+    # Open segmentation and change its orientation into RPI (in memory)
+    sct.printv('\nOpen segmentation volume...', verbose)
+    fname_segmentation = os.path.abspath(fname_segmentation)
+    path_data, file_data, ext_data = sct.extract_fname(fname_segmentation)
+    file_seg = nibabel.load(fname_segmentation)
+    hdr_seg = file_seg.get_header()
+    orientation = get_orientation_from_header(hdr_seg)
+    data_seg = reorient_data(np.asarray(file_seg.get_data()), orientation, 'RPI')
+    px, py = reorient_header(hdr_seg, file_seg.shape, orientation, 'RPI').get_zooms()[0:2]
+
+    sct.printv('\nExtract boundary of the segmentation...', verbose)
+    x, y, z = get_boundary_points(data_seg >= 0.5)
+    x, y = x * px, y * py
+
+    sct.printv('\nFit ellipses on all slices...', verbose)
+    z_slices, conics = fit_ellipses(x, y, z)
+    shape = ellipse_shape(conics)
+
+    # Create output text file
+    fname_shape = path_data+param.fname_shape
+    sct.printv('\nWrite text file...', verbose)
+    file_results = open(fname_shape, 'w')
+    file_results.write('# z, x_center (mm), y_center (mm), diameter_major (mm), diameter_minor (mm), diameter_RL (mm), diameter_AP (mm), eccentricity, orientation (deg)\n')
+    for iz in xrange(len(z_slices)):
+        file_results.write(str(int(z_slices[iz]))+','+','.join([str(shape[name][iz]) for name in ['x_center', 'y_center', 'diameter_major', 'diameter_minor', 'diameter_RL', 'diameter_AP', 'eccentricity', 'orientation']])+'\n')
+        sct.printv('z='+str(int(z_slices[iz]))+': AP='+str(round(shape['diameter_AP'][iz], 2))+' mm, RL='+str(round(shape['diameter_RL'][iz], 2))+' mm, eccentricity='+str(round(shape['eccentricity'][iz], 3)), verbose, 'bold')
+    file_results.close()
+
+    return fname_shape
+
+
+# get_boundary_points
+# ==========================================================================================
+def get_boundary_points(mask):
+    """
+    Get the boundary of a binary 3D volume in each axial slice, as the middle of the edges of the pixels that separate
+    the object from the background (the boundary of the pixelized object, without the half-pixel bias of boundary pixel
+    centers).
+    :return: x, y, z: coordinates of the boundary points (x and y in voxels, z is the slice index)
+    """
+    mask = np.pad(mask.astype(np.int8), ((1, 1), (1, 1), (0, 0)), mode='constant')
+    # edges between pixels i-1 and i along x, and between pixels j-1 and j along y (in input coordinates)
+    i, j, k = np.diff(mask, axis=0)[:, 1:-1, :].nonzero()
+    x, y, z = [i - 0.5], [j], [k]
+    i, j, k = np.diff(mask, axis=1)[1:-1, :, :].nonzero()
+    x.append(i)
+    y.append(j - 0.5)
+    z.append(k)
+    return np.concatenate(x).astype(np.float64), np.concatenate(y).astype(np.float64), np.concatenate(z)
+
+
+# fit_ellipses
+# ==========================================================================================
+def fit_ellipses(x, y, z):
+    """
+    Direct least-squares fit of an ellipse on the points of each slice [Fitzgibbon et al., 1999], with the numerically
+    stable formulation of [Halir and Flusser, 1998]. The 3x3 eigenproblems of all slices are solved at once.
+    :param x, y: coordinates of the points
+    :param z: slice of each point
+    :return: z_slices, conics: slices with a valid ellipse, and coefficients (a, b, c, d, e, f) of the conic
+    a*x^2 + b*x*y + c*y^2 + d*x + e*y + f = 0 of each slice
+    """
+    # sort points by slice
+    order = np.argsort(z, kind='mergesort')
+    x, y, z = x[order], y[order], z[order]
+    z_slices, start, inverse = np.unique(z, return_index=True, return_inverse=True)
+    count = np.bincount(inverse)
+    # center points of each slice, for conditioning
+    x_mean = np.add.reduceat(x, start) / count
+    y_mean = np.add.reduceat(y, start) / count
+    index = np.repeat(np.arange(len(z_slices)), count)
+    x, y = x - x_mean[index], y - y_mean[index]
+
+    # scatter matrices of all slices: quadratic (D1) and linear (D2) parts of the design matrix
+    D1 = np.array([x * x, x * y, y * y]).T
+    D2 = np.array([x, y, np.ones_like(x)]).T
+    S1 = np.add.reduceat(D1[:, :, np.newaxis] * D1[:, np.newaxis, :], start)
+    S2 = np.add.reduceat(D1[:, :, np.newaxis] * D2[:, np.newaxis, :], start)
+    S3 = np.add.reduceat(D2[:, :, np.newaxis] * D2[:, np.newaxis, :], start)
+
+    # at least 6 points, not all aligned, are needed to fit an ellipse
+    valid = (count >= 6) & (np.abs(np.linalg.det(S3)) > 1e-10 * np.maximum(1, S3[:, 0, 0] * S3[:, 1, 1] * S3[:, 2, 2]))
+    z_slices, x_mean, y_mean, S1, S2, S3 = z_slices[valid], x_mean[valid], y_mean[valid], S1[valid], S2[valid], S3[valid]
+
+    # linear part of the conic as a function of the quadratic part, and reduced eigenproblem
+    T = -np.linalg.solve(S3, S2.transpose(0, 2, 1))
+    M = S1 + np.einsum('nij,njk->nik', S2, T)
+    M = np.array([M[:, 2, :] / 2, -M[:, 1, :], M[:, 0, :] / 2]).transpose(1, 0, 2)
+    eigval, eigvec = np.linalg.eig(M)
+    eigvec = eigvec.real
+    # the ellipse is the eigenvector satisfying the constraint 4ac - b^2 > 0
+    constraint = 4 * eigvec[:, 0, :] * eigvec[:, 2, :] - eigvec[:, 1, :] ** 2
+    found = (constraint > 0).any(axis=1)
+    a1 = eigvec[np.arange(len(eigvec)), :, np.argmax(constraint, axis=1)]
+    conics = np.hstack((a1, np.einsum('nij,nj->ni', T, a1)))
+    z_slices, x_mean, y_mean, conics = z_slices[found], x_mean[found], y_mean[found], conics[found]
+
+    # translate conics back to the original coordinates
+    a, b, c, d, e, f = conics.T
+    d, e, f = (d - 2 * a * x_mean - b * y_mean,
+               e - 2 * c * y_mean - b * x_mean,
+               f + a * x_mean ** 2 + b * x_mean * y_mean + c * y_mean ** 2 - d * x_mean - e * y_mean)
+    return z_slices, np.array([a, b, c, d, e, f]).T
+
+
+# ellipse_shape
+# ==========================================================================================
+def ellipse_shape(conics):
+    """
+    Geometric parameters of ellipses given by their conic coefficients (see fit_ellipses).
+    :return: dict of arrays: x_center, y_center, diameter_major, diameter_minor, diameter_RL (along x), diameter_AP
+    (along y), eccentricity and orientation (angle of the major axis with the x axis, in degrees, in [-90, 90[)
+    """
+    a, b, c, d, e, f = conics.T
+    # center: the gradient of the conic is null
+    det = 4 * a * c - b ** 2
+    x_center = (b * e - 2 * c * d) / det
+    y_center = (b * d - 2 * a * e) / det
+    # centered conic: [x y] Q [x y]' = -f_center
+    f_center = f + (d * x_center + e * y_center) / 2
+    Q = np.array([[a, b / 2], [b / 2, c]]).transpose(2, 0, 1)
+    eigval, eigvec = np.linalg.eigh(Q / -f_center[:, np.newaxis, np.newaxis])
+    # eigenvalues in ascending order: the first one corresponds to the major axis
+    semi_major, semi_minor = 1 / np.sqrt(eigval[:, 0]), 1 / np.sqrt(eigval[:, 1])
+    theta = np.arctan2(eigvec[:, 1, 0], eigvec[:, 0, 0])
+    theta = (theta + np.pi / 2) % np.pi - np.pi / 2
+    return {'x_center': x_center,
+            'y_center': y_center,
+            'diameter_major': 2 * semi_major,
+            'diameter_minor': 2 * semi_minor,
+            'diameter_RL': 2 * np.sqrt((semi_major * np.cos(theta)) ** 2 + (semi_minor * np.sin(theta)) ** 2),
+            'diameter_AP': 2 * np.sqrt((semi_major * np.sin(theta)) ** 2 + (semi_minor * np.cos(theta)) ** 2),
+            'eccentricity': np.sqrt(1 - (semi_minor / semi_major) ** 2),
+            'orientation': np.degrees(theta)}
 
 
 #=======================================================================================================================
@@ -595,41 +777,23 @@ def ellipse_dim(a):
 def edge_detection(f):
 
     import Image
-    
+    from scipy import ndimage
+
     #sigma = 1.0
     img = Image.open(f) #grayscale
-    imgdata = np.array(img, dtype = float)
-    G = imgdata
+    G = np.array(img, dtype = float)
     #G = ndi.filters.gaussian_filter(imgdata, sigma)
-    gradx = np.array(G, dtype = float)
-    grady = np.array(G, dtype = float)
- 
-    mask_x = np.array([[-1,0,1],[-2,0,2],[-1,0,1]])
-          
-    mask_y = np.array([[1,2,1],[0,0,0],[-1,-2,-1]])
- 
-    width = img.size[1]
-    height = img.size[0]
- 
-    for i in range(1, width-1):
-        for j in range(1, height-1):
-        
-            px = np.sum(mask_x*G[(i-1):(i+1)+1,(j-1):(j+1)+1])
-            py = np.sum(mask_y*G[(i-1):(i+1)+1,(j-1):(j+1)+1])
-            gradx[i][j] = px
-            grady[i][j] = py
+
+    # Sobel filter along both axes (borders are kept unchanged)
+    gradx, grady = G.copy(), G.copy()
+    gradx[1:-1, 1:-1] = ndimage.sobel(G, axis=1)[1:-1, 1:-1]
+    grady[1:-1, 1:-1] = -ndimage.sobel(G, axis=0)[1:-1, 1:-1]
 
     mag = scipy.hypot(gradx,grady)
 
     treshold = np.max(mag)*0.9
+    mag = (mag > treshold).astype(float)
 
-    for i in range(width):
-        for j in range(height):
-            if mag[i][j]>treshold:
-                mag[i][j]=1
-            else:
-                mag[i][j] = 0
-   
     return mag
 
 
@@ -656,8 +820,17 @@ MANDATORY ARGUMENTS
                           slice and then geometrically adjusting using centerline orientation.
                           Output is a text file with z (1st column) and CSA in mm^2 (2nd column) and
                           a volume in which each slice\'s value is equal to the CSA (mm^2).
+                        - shape: fit an ellipse on the boundary of each slice. Output is a text file
+                          with z, center, diameters (major, minor, RL, AP) in mm, eccentricity and
+                          orientation of the major axis (deg).
 
 OPTIONAL ARGUMENTS
+  -m {counting_z_plane,counting_ortho_plane}  Method to compute CSA (requires \"-p csa\"):
+                          - counting_z_plane: count pixels in each axial slice and adjust using
+                            centerline orientation.
+                          - counting_ortho_plane: resample the segmentation on planes orthogonal to
+                            the centerline.
+                          Default="""+str(param_default.name_method)+"""
   -s <window_smooth>    Window size (in mm) for smoothing CSA. 0 for no smoothing. Default="""+str(param_default.smoothing_param)+"""
   -b {0,1}              Outputs a volume in which each slice\'s value is equal to the CSA in
                           mm^2. Default="""+str(param_default.volume_output)+"""
@@ -665,8 +838,10 @@ OPTIONAL ARGUMENTS
   -z <zmin:zmax>        Slice range to compute the CSA across (requires \"-p csa\").
                           Example: 5:23. First slice is 0.
                           You can also select specific slices using commas. Example: 0,2,3,5,12
+                          Several selections can be separated with \";\". Example: \"0:4;5:9\"
   -l <lmin:lmax>        Vertebral levels to compute the CSA across (requires \"-p csa\").
-                          Example: 2:9 for C2 to T2.
+                          Example: 2:9 for C2 to T2. Several ranges can be separated with \";\"
+                          (example: \"2:2;3:3\"), or use \"all\" for each vertebral level available.
   -t <path_template>    Path to warped template. Typically: ./label/template. Only use with flag -l
   -r {0,1}              Remove temporary files. Default="""+str(param_default.remove_temp_files)+"""
   -v {0,1}              Verbose. Default="""+str(param_default.verbose)+"""
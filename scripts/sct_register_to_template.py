@@ -201,6 +201,7 @@ def main():
     status, output = sct.run('mkdir '+path_tmp)
 
     # copy files to temporary folder
+    sct.set_stage('copy and resample')
     sct.printv('\nCopy files...', verbose)
     sct.run('isct_c3d '+fname_data+' -o '+path_tmp+'/data.nii')
     sct.run('isct_c3d '+fname_landmarks+' -o '+path_tmp+'/landmarks.nii.gz')
@@ -239,12 +240,14 @@ def main():
     sct.run('sct_crop_image -i segmentation_rpi.nii.gz -o segmentation_rpi_crop.nii.gz -dim 2 -bzmax')
 
     # straighten segmentation
+    sct.set_stage('straightening')
     sct.printv('\nStraighten the spinal cord using centerline/segmentation...', verbose)
     sct.run('sct_straighten_spinalcord -i segmentation_rpi_crop.nii.gz -c segmentation_rpi_crop.nii.gz -r 0 -v '+str(verbose), verbose)
     # re-define warping field using non-cropped space (to avoid issue #367)
     sct.run('sct_concat_transfo -w warp_straight2curve.nii.gz -d data_rpi.nii -o warp_straight2curve.nii.gz')
 
     # Label preparation:
+    sct.set_stage('labels')
     # --------------------------------------------------------------------------------
     # Remove unused label on template. Keep only label present in the input label image
     sct.printv('\nRemove unused label on template. Keep only label present in the input label image...', verbose)
@@ -275,6 +278,7 @@ def main():
     sct.run('sct_label_utils -t remove-symm -i landmarks_rpi_cross3x3_straight.nii.gz -o landmarks_rpi_cross3x3_straight.nii.gz,template_label_cross.nii.gz -r template_label_cross.nii.gz')
 
     # Estimate affine transfo: straight --> template (landmark-based)'
+    sct.set_stage('affine')
     sct.printv('\nEstimate affine transfo: straight anat --> template (landmark-based)...', verbose)
     sct.run('isct_ANTSUseLandmarkImagesToGetAffineTransform template_label_cross.nii.gz landmarks_rpi_cross3x3_straight.nii.gz affine straight2templateAffine.txt')
 
@@ -289,6 +293,7 @@ def main():
     zmin_template, zmax_template = find_zmin_zmax('segmentation_rpi_straight2templateAffine_th.nii.gz')
 
     # crop template in z-direction (for faster processing)
+    sct.set_stage('crop and resample')
     sct.printv('\nCrop data in template space (for faster processing)...', verbose)
     sct.run('sct_crop_image -i template.nii -o template_crop.nii -dim 2 -start '+str(zmin_template)+' -end '+str(zmax_template))
     sct.run('sct_crop_image -i template_seg.nii.gz -o template_seg_crop.nii.gz -dim 2 -start '+str(zmin_template)+' -end '+str(zmax_template))
@@ -308,6 +313,7 @@ def main():
     warp_forward = []
     warp_inverse = []
     for i_step in range(1, len(paramreg.steps)+1):
+        sct.set_stage('registration step '+str(i_step))
         sct.printv('\nEstimate transformation for step #'+str(i_step)+'...', verbose)
         # identify which is the src and dest
         if paramreg.steps[str(i_step)].type == 'im':
@@ -331,6 +337,7 @@ def main():
         warp_inverse.append(warp_inverse_out)
 
     # Concatenate transformations:
+    sct.set_stage('concatenate and apply transformations')
     sct.printv('\nConcatenate transformations: anat --> template...', verbose)
     sct.run('sct_concat_transfo -w warp_curve2straightAffine.nii.gz,'+','.join(warp_forward)+' -d template.nii -o warp_anat2template.nii.gz', verbose)
     # sct.run('sct_concat_transfo -w warp_curve2straight.nii.gz,straight2templateAffine.txt,'+','.join(warp_forward)+' -d template.nii -o warp_anat2template.nii.gz', verbose)
@@ -346,6 +353,7 @@ def main():
     os.chdir('..')
 
    # Generate output files
+    sct.set_stage('output')
     sct.printv('\nGenerate output files...', verbose)
     sct.generate_output_file(path_tmp+'/warp_template2anat.nii.gz', 'warp_template2anat.nii.gz', verbose)
     sct.generate_output_file(path_tmp+'/warp_anat2template.nii.gz', 'warp_anat2template.nii.gz', verbose)
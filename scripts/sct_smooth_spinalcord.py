@@ -24,7 +24,7 @@ import sct_utils as sct
 from sct_orientation import set_orientation
 from numpy import append, insert, nonzero, transpose, array
 from nibabel import load, Nifti1Image, save
-from scipy import ndimage
+from msct_centerline import Centerline
 from copy import copy
 
 class Param:
@@ -126,18 +126,16 @@ def main():
 
     ## Change seg to centerline if it is a segmentation
     sct.printv('\nChange segmentation to centerline if it is a centerline...\n')
-    z_centerline = [iz for iz in range(0, nz, 1) if data_c[:,:,iz].any() ]
+    centerline = Centerline('centerline_rpi.nii')
+    z_centerline = centerline.z
     nz_nonz = len(z_centerline)
     if nz_nonz==0 :
         print '\nERROR: Centerline is empty'
         sys.exit()
-    x_centerline = [0 for iz in range(0, nz_nonz, 1)]
-    y_centerline = [0 for iz in range(0, nz_nonz, 1)]
     #print("z_centerline", z_centerline,nz_nonz,len(x_centerline))
     print '\nGet center of mass of the centerline ...'
-    for iz in xrange(len(z_centerline)):
-        x_centerline[iz], y_centerline[iz] = ndimage.measurements.center_of_mass(array(data_c[:,:,z_centerline[iz]]))
-        data_temp[x_centerline[iz], y_centerline[iz], z_centerline[iz]] = 1
+    x_centerline, y_centerline = centerline.x, centerline.y
+    data_temp[x_centerline.astype(int), y_centerline.astype(int), z_centerline] = 1
 
     ## Complete centerline
     sct.printv('\nComplete the halls of the centerline if there are any...\n')
@@ -21,134 +21,22 @@ from msct_parser import Parser
 from sct_label_utils import ProcessLabels
 from sct_crop_image import ImageCropper
 from nibabel import load, Nifti1Image, save
-from numpy import array, asarray, append, insert, linalg, mean, sum, isnan
-from sympy.solvers import solve
-from sympy import Symbol
-from scipy import ndimage
+from numpy import array, asarray, append, insert, linalg, mean, sum, isnan, arange, in1d, where, cumsum, zeros, sqrt, column_stack, intersect1d, savetxt
 from sct_apply_transfo import Transform
 import sct_utils as sct
-from msct_smooth import smoothing_window, evaluate_derivative_3D
+from msct_centerline import Centerline, get_tangents
 from sct_orientation import set_orientation
-from msct_types import Coordinate
-
-import copy_reg
-import types
-
-def _pickle_method(method):
-    """
-    Author: Steven Bethard (author of argparse)
-    http://bytes.com/topic/python/answers/552476-why-cant-you-pickle-instancemethods
-    """
-    func_name = method.im_func.__name__
-    obj = method.im_self
-    cls = method.im_class
-    cls_name = ''
-    if func_name.startswith('__') and not func_name.endswith('__'):
-        cls_name = cls.__name__.lstrip('_')
-    if cls_name:
-        func_name = '_' + cls_name + func_name
-    return _unpickle_method, (func_name, obj, cls)
-
-
-def _unpickle_method(func_name, obj, cls):
-    """
-    Author: Steven Bethard
-    http://bytes.com/topic/python/answers/552476-why-cant-you-pickle-instancemethods
-    """
-    for cls in cls.mro():
-        try:
-            func = cls.__dict__[func_name]
-        except KeyError:
-            pass
-        else:
-            break
-    return func.__get__(obj, cls)
-
-copy_reg.pickle(types.MethodType, _pickle_method, _unpickle_method)
 
 
 def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='hanning', window_length=80, verbose=0):
     """
     :param fname_centerline: centerline in RPI orientation
-    :return: a bunch of useful stuff
+    :return: x_centerline_fit, y_centerline_fit, z_centerline_fit, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
     """
-    # window_length = param.window_length
-    # type_window = param.type_window
-    # algo_fitting = param.algo_fitting
-
     sct.printv('\nSmooth centerline/segmentation...', verbose)
+    centerline = Centerline(fname_centerline, verbose=verbose).fit(algo_fitting=algo_fitting, type_window=type_window, window_length=window_length)
 
-    # get dimensions (again!)
-    nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension(fname_centerline)
-
-    # open centerline
-    file = load(fname_centerline)
-    data = file.get_data()
-
-    # loop across z and associate x,y coordinate with the point having maximum intensity
-    # N.B. len(z_centerline) = nz_nonz can be smaller than nz in case the centerline is smaller than the input volume
-    z_centerline = [iz for iz in range(0, nz, 1) if data[:, :, iz].any()]
-    nz_nonz = len(z_centerline)
-    x_centerline = [0 for iz in range(0, nz_nonz, 1)]
-    y_centerline = [0 for iz in range(0, nz_nonz, 1)]
-    x_centerline_deriv = [0 for iz in range(0, nz_nonz, 1)]
-    y_centerline_deriv = [0 for iz in range(0, nz_nonz, 1)]
-    z_centerline_deriv = [0 for iz in range(0, nz_nonz, 1)]
-
-    # get center of mass of the centerline/segmentation
-    sct.printv('.. Get center of mass of the centerline/segmentation...', verbose)
-    for iz in range(0, nz_nonz, 1):
-        x_centerline[iz], y_centerline[iz] = ndimage.measurements.center_of_mass(array(data[:, :, z_centerline[iz]]))
-
-        # import matplotlib.pyplot as plt
-        # fig = plt.figure()
-        # ax = fig.add_subplot(111)
-        # data_tmp = data
-        # data_tmp[x_centerline[iz], y_centerline[iz], z_centerline[iz]] = 10
-        # implot = ax.imshow(data_tmp[:, :, z_centerline[iz]].T)
-        # implot.set_cmap('gray')
-        # plt.show()
-
-    sct.printv('.. Smoothing algo = '+algo_fitting, verbose)
-    if algo_fitting == 'hanning':
-        # 2D smoothing
-        sct.printv('.. Windows length = '+str(window_length), verbose)
-
-        # change to array
-        x_centerline = asarray(x_centerline)
-        y_centerline = asarray(y_centerline)
-
-
-        # Smooth the curve
-        x_centerline_smooth = smoothing_window(x_centerline, window_len=window_length/pz, window=type_window, verbose = verbose)
-        y_centerline_smooth = smoothing_window(y_centerline, window_len=window_length/pz, window=type_window, verbose = verbose)
-
-        # convert to list final result
-        x_centerline_smooth = x_centerline_smooth.tolist()
-        y_centerline_smooth = y_centerline_smooth.tolist()
-
-        # clear variable
-        del data
-
-        x_centerline_fit = x_centerline_smooth
-        y_centerline_fit = y_centerline_smooth
-        z_centerline_fit = z_centerline
-
-        # get derivative
-        x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = evaluate_derivative_3D(x_centerline_fit, y_centerline_fit, z_centerline, px, py, pz)
-
-        x_centerline_fit = asarray(x_centerline_fit)
-        y_centerline_fit = asarray(y_centerline_fit)
-        z_centerline_fit = asarray(z_centerline_fit)
-
-    elif algo_fitting == 'nurbs':
-        from msct_smooth import b_spline_nurbs
-        x_centerline_fit, y_centerline_fit, z_centerline_fit, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = b_spline_nurbs(x_centerline, y_centerline, z_centerline, nbControl=None, verbose=verbose)
-
-    else:
-        sct.printv('ERROR: wrong algorithm for fitting',1,'error')
-
-    return x_centerline_fit, y_centerline_fit, z_centerline_fit, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
+    return centerline.x_fit, centerline.y_fit, centerline.z_fit, centerline.x_deriv, centerline.y_deriv, centerline.z_deriv
 
 
 class SpinalCordStraightener(object):
@@ -170,85 +58,180 @@ class SpinalCordStraightener(object):
         self.window_length = window_length
         self.crop = crop
 
-        self.cpu_number = 0
-
         self.bspline_meshsize = '5x5x10'
         self.bspline_numberOfLevels = '3'
         self.bspline_order = '2'
         self.algo_landmark_rigid = 'translation-xy'
         self.all_labels = 1
         self.use_continuous_labels = 1
+        self.algo_warp = 'landmarks'  # 'landmarks': b-spline fit of landmarks (ANTs), 'centerline': computed from the centerline
+        self.nb_voxels_slab = 1000000  # warping fields are computed by slabs of slices of about this size (algo_warp='centerline')
 
         self.mse_straightening = 0.0
         self.max_distance_straightening = 0.0
 
-    def worker_landmarks_curved(self, arguments):
-        try:
-            iz = arguments[0]
-            iz_curved, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv, x_centerline_fit, y_centerline_fit, z_centerline = arguments[1]
-
-            temp_results = []
-
-            if iz in iz_curved:
-                # calculate d (ax+by+cz+d=0)
-                a = x_centerline_deriv[iz]
-                b = y_centerline_deriv[iz]
-                c = z_centerline_deriv[iz]
-                x = x_centerline_fit[iz]
-                y = y_centerline_fit[iz]
-                z = z_centerline[iz]
-                d = -(a * x + b * y + c * z)
-                # print a,b,c,d,x,y,z
-                # set coordinates for landmark at the center of the cross
-                coord = Coordinate([0, 0, 0, 0])
-                coord.x, coord.y, coord.z = x_centerline_fit[iz], y_centerline_fit[iz], z_centerline[iz]
-                temp_results.append(coord)
-
-                # set y coordinate to y_centerline_fit[iz] for elements 1 and 2 of the cross
-                cross_coordinates = [Coordinate(), Coordinate(), Coordinate(), Coordinate()]
-
-                cross_coordinates[0].y = y_centerline_fit[iz]
-                cross_coordinates[1].y = y_centerline_fit[iz]
-
-                # set x and z coordinates for landmarks +x and -x, forcing de landmark to be in the orthogonal plan and the distance landmark/curve to be gapxy
-                x_n = Symbol('x_n')
-                cross_coordinates[1].x, cross_coordinates[0].x = solve(
-                    (x_n - x) ** 2 + ((-1 / c) * (a * x_n + b * y + d) - z) ** 2 - self.gapxy ** 2, x_n)  # x for -x and +x
-                cross_coordinates[0].z = (-1 / c) * (a * cross_coordinates[0].x + b * y + d)  # z for +x
-                cross_coordinates[1].z = (-1 / c) * (a * cross_coordinates[1].x + b * y + d)  # z for -x
-
-                # set x coordinate to x_centerline_fit[iz] for elements 3 and 4 of the cross
-                cross_coordinates[2].x = x_centerline_fit[iz]
-                cross_coordinates[3].x = x_centerline_fit[iz]
-
-                # set coordinates for landmarks +y and -y. Here, x coordinate is 0 (already initialized).
-                y_n = Symbol('y_n')
-                cross_coordinates[3].y, cross_coordinates[2].y = solve(
-                    (y_n - y) ** 2 + ((-1 / c) * (a * x + b * y_n + d) - z) ** 2 - self.gapxy ** 2, y_n)  # y for -y and +y
-                cross_coordinates[2].z = (-1 / c) * (a * x + b * cross_coordinates[2].y + d)  # z for +y
-                cross_coordinates[3].z = (-1 / c) * (a * x + b * cross_coordinates[3].y + d)  # z for -y
-
-                for coord in cross_coordinates:
-                    temp_results.append(coord)
-            else:
-                if self.all_labels >= 1:
-                    temp_results.append(
-                        Coordinate([x_centerline_fit[iz], y_centerline_fit[iz], z_centerline[iz], 0], mode='continuous'))
-
-            return iz, temp_results
-
-        except KeyboardInterrupt:
-            return
-
-    def worker_landmarks_curved_results(self, results):
-        sorted(results, key=lambda l: l[0])
-        self.results_landmarks_curved = []
-        landmark_curved_value = 0
-        for iz, l_curved in results:
-            for landmark in l_curved:
-                landmark.value = landmark_curved_value
-                self.results_landmarks_curved.append(landmark)
-                landmark_curved_value += 1
+    def get_landmarks_curved(self, iz_curved, x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv):
+        """
+        Landmarks along the curved centerline, for all z at once. For each z in iz_curved, a cross is made of the
+        centerline point and of 4 points (+x, -x, +y, -y) in the plane orthogonal to the centerline, at distance gapxy.
+        Other z get the centerline point only (if all_labels).
+        In the plane a(x-x0)+b(y-y0)+c(z-z0)=0, points +x/-x keep y0 and points +y/-y keep x0, so their offsets are
+        gapxy*|c|/sqrt(a^2+c^2) along x and gapxy*|c|/sqrt(b^2+c^2) along y.
+        :return: array (nb_landmarks x 4) of [x, y, z, value], values are 1..nb_landmarks
+        """
+        iz, is_cross = self.get_landmarks_index(iz_curved)
+        x, y, z = asarray(x_centerline_fit, dtype=float)[iz], asarray(y_centerline_fit, dtype=float)[iz], asarray(z_centerline, dtype=float)[iz]
+        a, b, c = asarray(x_centerline_deriv, dtype=float)[iz], asarray(y_centerline_deriv, dtype=float)[iz], asarray(z_centerline_deriv, dtype=float)[iz]
+        dx = self.gapxy * abs(c) / sqrt(a ** 2 + c ** 2)
+        dy = self.gapxy * abs(c) / sqrt(b ** 2 + c ** 2)
+
+        landmarks, index_center = self.init_landmarks(is_cross)
+        landmarks[index_center, 0:3] = column_stack((x, y, z))
+        index_cross = index_center[is_cross]
+        x, y, z, a, b, c, dx, dy = [v[is_cross] for v in (x, y, z, a, b, c, dx, dy)]
+        for i, (sign_x, sign_y) in enumerate([(1, 0), (-1, 0), (0, 1), (0, -1)]):
+            landmarks[index_cross + i + 1, 0] = x + sign_x * dx
+            landmarks[index_cross + i + 1, 1] = y + sign_y * dy
+            landmarks[index_cross + i + 1, 2] = z - (a * sign_x * dx + b * sign_y * dy) / c
+        return landmarks
+
+    def get_landmarks_straight(self, iz_curved, iz_straight, x0, y0):
+        """
+        Landmarks along the straight centerline (x=x0, y=y0), with the same structure and values as get_landmarks_curved.
+        Crosses are placed at z=iz_straight, other landmarks keep their z.
+        :return: array (nb_landmarks x 4) of [x, y, z, value]
+        """
+        iz, is_cross = self.get_landmarks_index(iz_curved)
+        z = iz.astype(float)
+        z[is_cross] = iz_straight
+
+        landmarks, index_center = self.init_landmarks(is_cross)
+        landmarks[index_center, 0], landmarks[index_center, 1], landmarks[index_center, 2] = x0, y0, z
+        index_cross = index_center[is_cross]
+        for i, (offset_x, offset_y) in enumerate([(self.gapxy, 0), (-self.gapxy, 0), (0, self.gapxy), (0, -self.gapxy)]):
+            landmarks[index_cross + i + 1, 0] = x0 + offset_x
+            landmarks[index_cross + i + 1, 1] = y0 + offset_y
+            landmarks[index_cross + i + 1, 2] = z[is_cross]
+        return landmarks
+
+    def get_landmarks_index(self, iz_curved):
+        """Return the z indices carrying landmarks and whether each of them carries a cross."""
+        iz = arange(min(iz_curved), max(iz_curved) + 1)
+        is_cross = in1d(iz, iz_curved)
+        if self.all_labels < 1:
+            iz, is_cross = iz[is_cross], is_cross[is_cross]
+        return iz, is_cross
+
+    def init_landmarks(self, is_cross):
+        """Allocate landmarks (5 per cross, 1 otherwise). Return the array and the index of the center of each z."""
+        nb_landmarks_z = where(is_cross, 5, 1)
+        landmarks = zeros((nb_landmarks_z.sum(), 4))
+        landmarks[:, 3] = arange(1, len(landmarks) + 1)
+        return landmarks, cumsum(nb_landmarks_z) - nb_landmarks_z
+
+    def paint_landmarks(self, data, landmarks, padding):
+        """Attribute the value of each landmark to its voxel (rounded coordinates) and its neighbours in padded data."""
+        for x, y, z, value in landmarks:
+            x, y, z = int(round(x)) + padding, int(round(y)) + padding, int(round(z)) + padding
+            data[x - 1:x + 2, y - 1:y + 2, z - 1:z + 2] = value
+
+    def compute_warps_from_centerline(self, fname_centerline, fname_anat, x_centerline_fit, y_centerline_fit, z_centerline, fname_straight_ref, fname_curve2straight, fname_straight2curve):
+        """
+        Compute the warping fields curve->straight and straight->curve directly from the smoothed centerline.
+        The centerline is parametrized by its arc length s, and each of its points gets an orthonormal frame (t, u, v):
+        t is the tangent, u and v are the x and y axes of the image made orthogonal to t. The point at (a, b) along
+        (u, v) in the plane orthogonal to the centerline at s is paired with the point at (a, b) along (x, y) from the
+        straight centerline, at height s. Beyond its ends, the centerline is extended along its tangent.
+        Fields are computed by slabs of slices to bound memory.
+        :param fname_centerline: centerline in RPI orientation (gives the grid of the straight space, extended along z)
+        :param fname_anat: image defining the grid of the straight->curve field
+        :param x_centerline_fit, y_centerline_fit, z_centerline: smoothed centerline, in voxels of fname_centerline
+        :param fname_straight_ref: output image defining the straight space
+        """
+        from numpy import interp, linalg, vstack, ones, dot, concatenate, diff, newaxis, mgrid, float32, uint8
+        import nibabel
+
+        file_centerline = nibabel.load(fname_centerline)
+        hdr_centerline = file_centerline.get_header()
+        affine = hdr_centerline.get_best_affine()
+        nx, ny, nz = hdr_centerline.get_data_shape()[0:3]
+        px, py, pz = hdr_centerline.get_zooms()[0:3]
+        # unit vectors of the image axes in physical space
+        axis_x, axis_y = affine[0:3, 0] / px, affine[0:3, 1] / py
+
+        # centerline in physical space, parametrized by its arc length
+        z_centerline = asarray(z_centerline, dtype=float)
+        points = dot(affine, vstack((x_centerline_fit, y_centerline_fit, z_centerline, ones(len(z_centerline)))))[0:3].T
+        s = concatenate(([0], cumsum(linalg.norm(diff(points, axis=0), axis=1))))
+        tangents = get_tangents(points)
+        # extend the centerline along its tangent at both ends
+        length_ext = 10000.0
+        s_ext = concatenate(([s[0] - length_ext], s, [s[-1] + length_ext]))
+        z_ext = concatenate(([z_centerline[0] - length_ext / pz], z_centerline, [z_centerline[-1] + length_ext / pz]))
+        points = vstack((points[0] - length_ext * tangents[0], points, points[-1] + length_ext * tangents[-1]))
+        tangents = vstack((tangents[0], tangents, tangents[-1]))
+
+        def centerline_at(s_query):
+            """Return the point and the frame (t, u, v) of the centerline at arc lengths s_query (each: n x 3)."""
+            point = column_stack([interp(s_query, s_ext, points[:, i]) for i in range(3)])
+            t = column_stack([interp(s_query, s_ext, tangents[:, i]) for i in range(3)])
+            t /= linalg.norm(t, axis=1)[:, newaxis]
+            u = axis_x - dot(t, axis_x)[:, newaxis] * t
+            u /= linalg.norm(u, axis=1)[:, newaxis]
+            v = axis_y - dot(t, axis_y)[:, newaxis] * t - dot(u, axis_y)[:, newaxis] * u
+            v /= linalg.norm(v, axis=1)[:, newaxis]
+            return point, t, u, v
+
+        # straight space: grid of the centerline extended along z, straight centerline at the center of the slices
+        x0, y0, z0 = int(round(nx/2)), int(round(ny/2)), z_centerline[0]
+        nz_straight = int(round(z0 + s[-1] / pz + (nz - 1 - z_centerline[-1]))) + 1
+        hdr_straight = hdr_centerline.copy()
+        hdr_straight.set_data_dtype('uint8')
+        nibabel.save(nibabel.Nifti1Image(zeros((nx, ny, nz_straight), dtype=uint8), None, hdr_straight), fname_straight_ref)
+
+        # ITK fields are in LPS
+        ras2lps = array([-1.0, -1.0, 1.0])
+
+        # curve->straight: defined in the straight space, points to the curved space
+        sct.printv('.. curve->straight', self.verbose)
+        warp = zeros((nx, ny, nz_straight, 1, 3), dtype=float32)
+        size_slab = max(1, self.nb_voxels_slab / (nx * ny))
+        for z_start in range(0, nz_straight, size_slab):
+            i, j, k = [c.ravel() for c in mgrid[0:nx, 0:ny, z_start:min(z_start + size_slab, nz_straight)]]
+            point, t, u, v = centerline_at((k - z0) * pz)
+            target = point + ((i - x0) * px)[:, newaxis] * u + ((j - y0) * py)[:, newaxis] * v
+            source = dot(affine, vstack((i, j, k, ones(len(i)))))[0:3].T
+            warp[:, :, z_start:z_start + size_slab, 0, :] = ((target - source) * ras2lps).reshape(nx, ny, -1, 3)
+        hdr_warp = hdr_straight.copy()
+        hdr_warp.set_intent('vector', (), '')
+        hdr_warp.set_data_dtype('float32')
+        nibabel.save(nibabel.Nifti1Image(warp, None, hdr_warp), fname_curve2straight)
+
+        # straight->curve: defined in the anatomical space, points to the straight space
+        sct.printv('.. straight->curve', self.verbose)
+        hdr_anat = nibabel.load(fname_anat).get_header()
+        affine_anat = hdr_anat.get_best_affine()
+        nx_anat, ny_anat, nz_anat = hdr_anat.get_data_shape()[0:3]
+        # from physical space to voxels of the centerline
+        affine_inv = linalg.inv(affine)
+        warp = zeros((nx_anat, ny_anat, nz_anat, 1, 3), dtype=float32)
+        size_slab = max(1, self.nb_voxels_slab / (nx_anat * ny_anat))
+        for z_start in range(0, nz_anat, size_slab):
+            i, j, k = [c.ravel() for c in mgrid[0:nx_anat, 0:ny_anat, z_start:min(z_start + size_slab, nz_anat)]]
+            source = dot(affine_anat, vstack((i, j, k, ones(len(i)))))[0:3].T
+            # find the arc length of the plane containing each point (Newton's method, starting from the same z)
+            s_source = interp(dot(source, affine_inv[2, 0:3]) + affine_inv[2, 3], z_ext, s_ext)
+            for iteration in range(4):
+                point, t, u, v = centerline_at(s_source)
+                s_source += (t * (source - point)).sum(axis=1)
+            point, t, u, v = centerline_at(s_source)
+            a, b = (u * (source - point)).sum(axis=1), (v * (source - point)).sum(axis=1)
+            target = dot(affine, vstack((x0 + a / px, y0 + b / py, z0 + s_source / pz, ones(len(a)))))[0:3].T
+            warp[:, :, z_start:z_start + size_slab, 0, :] = ((target - source) * ras2lps).reshape(nx_anat, ny_anat, -1, 3)
+        hdr_warp = hdr_anat.copy()
+        hdr_warp.set_intent('vector', (), '')
+        hdr_warp.set_data_dtype('float32')
+        nibabel.save(nibabel.Nifti1Image(warp, None, hdr_warp), fname_straight2curve)
 
     def straighten(self):
         # Initialization
@@ -321,409 +304,302 @@ class SpinalCordStraightener(object):
             sct.printv('.. voxel size:  '+str(px)+'mm x '+str(py)+'mm x '+str(pz)+'mm', verbose)
 
             # smooth centerline
+            sct.set_stage('smooth centerline')
             x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(fname_centerline_orient, algo_fitting=algo_fitting, type_window=type_window, window_length=window_length,verbose=verbose)
 
-            # Get coordinates of landmarks along curved centerline
-            #==========================================================================================
-            sct.printv('\nGet coordinates of landmarks along curved centerline...', verbose)
-            # landmarks are created along the curved centerline every z=gapz. They consist of a "cross" of size gapx and gapy. In voxel space!!!
+            if self.algo_warp == 'centerline':
+                # Compute warping fields directly from the centerline (no landmarks, no b-spline fitting)
+                #==========================================================================================
+                sct.set_stage('warping fields')
+                sct.printv('\nCompute warping fields from the centerline...', verbose)
+                fname_straight_ref = 'tmp.straight_ref.nii.gz'
+                self.compute_warps_from_centerline(fname_centerline_orient, file_anat+ext_anat, x_centerline_fit, y_centerline_fit, z_centerline,
+                                                   fname_straight_ref, 'tmp.curve2straight.nii.gz', 'tmp.straight2curve.nii.gz')
+            else:
+                fname_straight_ref = 'tmp.landmarks_straight_crop.nii.gz'
+                # Get coordinates of landmarks along curved centerline
+                #==========================================================================================
+                sct.set_stage('landmarks')
+                sct.printv('\nGet coordinates of landmarks along curved centerline...', verbose)
+                # landmarks are created along the curved centerline every z=gapz. They consist of a "cross" of size gapx and gapy. In voxel space!!!
 
-            # find z indices along centerline given a specific gap: iz_curved
-            nz_nonz = len(z_centerline)
-            nb_landmark = int(round(float(nz_nonz)/gapz))
+                # find z indices along centerline given a specific gap: iz_curved
+                nz_nonz = len(z_centerline)
+                nb_landmark = int(round(float(nz_nonz)/gapz))
 
-            if nb_landmark == 0:
-                nb_landmark = 1
+                if nb_landmark == 0:
+                    nb_landmark = 1
 
-            if nb_landmark == 1:
-                iz_curved = [0]
-            else:
-                iz_curved = [i*gapz for i in range(0, nb_landmark - 1)]
-
-            iz_curved.append(nz_nonz-1)
-            #print iz_curved, len(iz_curved)
-            n_iz_curved = len(iz_curved)
-            #print n_iz_curved
-
-            # landmark_curved initialisation
-            # landmark_curved = [ [ [ 0 for i in range(0, 3)] for i in range(0, 5) ] for i in iz_curved ]
-
-            landmark_curved = []
-            ### TODO: THIS PART IS SLOW AND CAN BE MADE FASTER
-            ### >>=====================================================================================================
-            worker_arguments = (iz_curved, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv, x_centerline_fit, y_centerline_fit, z_centerline)
-            if self.cpu_number != 0:
-                from multiprocessing import Pool
-                arguments_landmarks = [(iz, worker_arguments) for iz in range(min(iz_curved), max(iz_curved) + 1, 1)]
-
-                pool = Pool(processes=self.cpu_number)
-                pool.map_async(self.worker_landmarks_curved, arguments_landmarks, callback=self.worker_landmarks_curved_results)
-
-                pool.close()
-                try:
-                    pool.join()  # waiting for all the jobs to be done
-                    if self.results_landmarks_curved:
-                        landmark_curved = self.results_landmarks_curved
-                    else:
-                        raise ValueError('ERROR: no curved landmarks constructed...')
-                except KeyboardInterrupt:
-                    print "\nWarning: Caught KeyboardInterrupt, terminating workers"
-                    pool.terminate()
-                    sys.exit(2)
-                except Exception as e:
-                    print 'Error during straightening on line {}'.format(sys.exc_info()[-1].tb_lineno)
-                    print e
-                    sys.exit(2)
-            else:
-                landmark_curved_temp = [self.worker_landmarks_curved((iz, worker_arguments)) for iz in range(min(iz_curved), max(iz_curved) + 1, 1)]
-                landmark_curved_value = 0
-                for iz, l_curved in landmark_curved_temp:
-                    for landmark in l_curved:
-                        landmark.value = landmark_curved_value
-                        landmark_curved.append(landmark)
-                        landmark_curved_value += 1
-
-            # Get coordinates of landmarks along straight centerline
-            #==========================================================================================
-            sct.printv('\nGet coordinates of landmarks along straight centerline...', verbose)
-            # landmark_straight = [ [ [ 0 for i in range(0,3)] for i in range (0,5) ] for i in iz_curved ] # same structure as landmark_curved
-
-            landmark_straight = []
-
-            # calculate the z indices corresponding to the Euclidean distance between two consecutive points on the curved centerline (approximation curve --> line)
-            # TODO: DO NOT APPROXIMATE CURVE --> LINE
-            if nb_landmark == 1:
-                iz_straight = [0 for i in range(0, nb_landmark+1)]
-            else:
-                iz_straight = [0 for i in range(0, nb_landmark)]
-
-            # print iz_straight,len(iz_straight)
-            iz_straight[0] = iz_curved[0]
-            for index in range(1, n_iz_curved, 1):
-                # compute vector between two consecutive points on the curved centerline
-                vector_centerline = [x_centerline_fit[iz_curved[index]] - x_centerline_fit[iz_curved[index-1]], \
-                                     y_centerline_fit[iz_curved[index]] - y_centerline_fit[iz_curved[index-1]], \
-                                     z_centerline[iz_curved[index]] - z_centerline[iz_curved[index-1]] ]
-                # compute norm of this vector
-                norm_vector_centerline = linalg.norm(vector_centerline, ord=2)
-                # round to closest integer value
-                norm_vector_centerline_rounded = int(round(norm_vector_centerline, 0))
-                # assign this value to the current z-coordinate on the straight centerline
-                iz_straight[index] = iz_straight[index-1] + norm_vector_centerline_rounded
-
-            # initialize x0 and y0 to be at the center of the FOV
-            x0 = int(round(nx/2))
-            y0 = int(round(ny/2))
-            landmark_curved_value = 1
-            for iz in range(min(iz_curved), max(iz_curved)+1, 1):
-                if iz in iz_curved:
-                    index = iz_curved.index(iz)
-                    # set coordinates for landmark at the center of the cross
-                    landmark_straight.append(Coordinate([x0, y0, iz_straight[index], landmark_curved_value]))
-                    # set x, y and z coordinates for landmarks +x
-                    landmark_straight.append(Coordinate([x0 + gapxy, y0, iz_straight[index], landmark_curved_value+1]))
-                    # set x, y and z coordinates for landmarks -x
-                    landmark_straight.append(Coordinate([x0 - gapxy, y0, iz_straight[index], landmark_curved_value+2]))
-                    # set x, y and z coordinates for landmarks +y
-                    landmark_straight.append(Coordinate([x0, y0 + gapxy, iz_straight[index], landmark_curved_value+3]))
-                    # set x, y and z coordinates for landmarks -y
-                    landmark_straight.append(Coordinate([x0, y0 - gapxy, iz_straight[index], landmark_curved_value+4]))
-                    landmark_curved_value += 5
+                if nb_landmark == 1:
+                    iz_curved = [0]
                 else:
-                    if self.all_labels >= 1:
-                        landmark_straight.append(Coordinate([x0, y0, iz, landmark_curved_value]))
-                        landmark_curved_value += 1
-
-            # Create NIFTI volumes with landmarks
-            #==========================================================================================
-            # Pad input volume to deal with the fact that some landmarks on the curved centerline might be outside the FOV
-            # N.B. IT IS VERY IMPORTANT TO PAD ALSO ALONG X and Y, OTHERWISE SOME LANDMARKS MIGHT GET OUT OF THE FOV!!!
-            #sct.run('fslview ' + fname_centerline_orient)
-            sct.printv('\nPad input volume to account for landmarks that fall outside the FOV...', verbose)
-            sct.run('isct_c3d '+fname_centerline_orient+' -pad '+str(padding)+'x'+str(padding)+'x'+str(padding)+'vox '+str(padding)+'x'+str(padding)+'x'+str(padding)+'vox 0 -o tmp.centerline_pad.nii.gz', verbose)
-
-            # Open padded centerline for reading
-            sct.printv('\nOpen padded centerline for reading...', verbose)
-            file = load('tmp.centerline_pad.nii.gz')
-            data = file.get_data()
-            hdr = file.get_header()
-            landmark_curved_rigid = []
-
-            if self.algo_landmark_rigid is not None and self.algo_landmark_rigid != 'None':
-                # converting landmarks straight and curved to physical coordinates
-                from msct_image import Image
-                image_curved = Image(fname_centerline_orient)
-                # Reorganize landmarks
-                points_fixed, points_moving = [], []
-                for coord in landmark_straight:
-                    point_straight = image_curved.transfo_pix2phys([[coord.x, coord.y, coord.z]])
-                    points_fixed.append([point_straight[0][0], point_straight[0][1], point_straight[0][2]])
-                for coord in landmark_curved:
-                    point_curved = image_curved.transfo_pix2phys([[coord.x, coord.y, coord.z]])
-                    points_moving.append([point_curved[0][0], point_curved[0][1], point_curved[0][2]])
-
-                points_moving_barycenter = [0.0, 0.0, 0.0]
-                # Register curved landmarks on straight landmarks based on python implementation
-                sct.printv('\nComputing rigid transformation (algo='+self.algo_landmark_rigid+') ...', verbose)
-                import msct_register_landmarks
-                (rotation_matrix, translation_array, points_moving_reg, points_moving_barycenter) = msct_register_landmarks.getRigidTransformFromLandmarks(
-                    points_fixed, points_moving, constraints=self.algo_landmark_rigid, show=False)
-
-                # reorganize registered pointsx
-                image_curved = Image(fname_centerline_orient)
-                for index_curved, ind in enumerate(range(0, len(points_moving_reg), 1)):
-                    coord = Coordinate()
-                    point_curved = image_curved.transfo_phys2continuouspix([[points_moving_reg[ind][0], points_moving_reg[ind][1], points_moving_reg[ind][2]]])
-                    coord.x, coord.y, coord.z, coord.value = point_curved[0][0], point_curved[0][1], point_curved[0][2], index_curved+1
-                    landmark_curved_rigid.append(coord)
-
-                # Create volumes containing curved and straight landmarks
-                data_curved_landmarks = data * 0
-                data_curved_rigid_landmarks = data * 0
-                data_straight_landmarks = data * 0
-
-                # Loop across cross index
-                for index in range(0, len(landmark_curved_rigid)):
-                    x, y, z = int(round(landmark_curved[index].x)), \
-                              int(round(landmark_curved[index].y)), \
-                              int(round(landmark_curved[index].z))
-
-                    # attribute landmark_value to the voxel and its neighbours
-                    data_curved_landmarks[x + padding - 1:x + padding + 2, y + padding - 1:y + padding + 2,
-                    z + padding - 1:z + padding + 2] = landmark_curved[index].value
-
-                    # get x, y and z coordinates of curved landmark (rounded to closest integer)
-                    x, y, z = int(round(landmark_curved_rigid[index].x)), \
-                              int(round(landmark_curved_rigid[index].y)), \
-                              int(round(landmark_curved_rigid[index].z))
-
-                    # attribute landmark_value to the voxel and its neighbours
-                    data_curved_rigid_landmarks[x + padding - 1:x + padding + 2, y + padding - 1:y + padding + 2,
-                    z + padding - 1:z + padding + 2] = landmark_curved_rigid[index].value
-
-                    # get x, y and z coordinates of straight landmark (rounded to closest integer)
-                    x, y, z = int(round(landmark_straight[index].x)), \
-                              int(round(landmark_straight[index].y)), \
-                              int(round(landmark_straight[index].z))
-
-                    # attribute landmark_value to the voxel and its neighbours
-                    data_straight_landmarks[x + padding - 1:x + padding + 2, y + padding - 1:y + padding + 2,
-                    z + padding - 1:z + padding + 2] = landmark_straight[index].value
-
-                # Write NIFTI volumes
-                sct.printv('\nWrite NIFTI volumes...', verbose)
-                hdr.set_data_dtype('uint32')  # set imagetype to uint8 #TODO: maybe use int32
-                img = Nifti1Image(data_curved_landmarks, None, hdr)
-                save(img, 'tmp.landmarks_curved.nii.gz')
-                sct.printv('.. File created: tmp.landmarks_curved.nii.gz', verbose)
-                hdr.set_data_dtype('uint32')  # set imagetype to uint8 #TODO: maybe use int32
-                img = Nifti1Image(data_curved_rigid_landmarks, None, hdr)
-                save(img, 'tmp.landmarks_curved_rigid.nii.gz')
-                sct.printv('.. File created: tmp.landmarks_curved_rigid.nii.gz', verbose)
-                img = Nifti1Image(data_straight_landmarks, None, hdr)
-                save(img, 'tmp.landmarks_straight.nii.gz')
-                sct.printv('.. File created: tmp.landmarks_straight.nii.gz', verbose)
+                    iz_curved = [i*gapz for i in range(0, nb_landmark - 1)]
 
-                if self.algo_landmark_rigid == 'rigid-decomposed':
-                    # writing rigid transformation file
-                    text_file = open("tmp.curve2straight_rigid1.txt", "w")
-                    text_file.write("#Insight Transform File V1.0\n")
-                    text_file.write("#Transform 0\n")
-                    text_file.write("Transform: AffineTransform_double_3_3\n")
-                    text_file.write("Parameters: 1.0 0.0 0.0 0.0 1.0 0.0 0.0 0.0 1.0 %.9f %.9f %.9f\n" % (
-                        translation_array[0, 0], translation_array[0, 1], translation_array[0, 2]))
-                    text_file.write("FixedParameters: 0 0 0\n")
-                    text_file.close()
-
-                    text_file = open("tmp.curve2straight_rigid2.txt", "w")
-                    text_file.write("#Insight Transform File V1.0\n")
-                    text_file.write("#Transform 0\n")
-                    text_file.write("Transform: AffineTransform_double_3_3\n")
-                    text_file.write("Parameters: %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f 0.0 0.0 0.0\n" % (
-                        rotation_matrix[0, 0], rotation_matrix[0, 1], rotation_matrix[0, 2], rotation_matrix[1, 0],
-                        rotation_matrix[1, 1], rotation_matrix[1, 2], rotation_matrix[2, 0], rotation_matrix[2, 1],
-                        rotation_matrix[2, 2]))
-                    text_file.write("FixedParameters: %.9f %.9f %.9f\n" % (
-                        points_moving_barycenter[0,0], points_moving_barycenter[0,1], points_moving_barycenter[0,2]))
-                    text_file.close()
-                else:
-                    # writing rigid transformation file
-                    text_file = open("tmp.curve2straight_rigid.txt", "w")
-                    text_file.write("#Insight Transform File V1.0\n")
-                    text_file.write("#Transform 0\n")
-                    text_file.write("Transform: AffineTransform_double_3_3\n")
-                    text_file.write("Parameters: %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f\n" % (
-                        rotation_matrix[0, 0], rotation_matrix[0, 1], rotation_matrix[0, 2], rotation_matrix[1, 0],
-                        rotation_matrix[1, 1], rotation_matrix[1, 2], rotation_matrix[2, 0], rotation_matrix[2, 1],
-                        rotation_matrix[2, 2], translation_array[0, 0], translation_array[0, 1],
-                        translation_array[0, 2]))
-                    text_file.write("FixedParameters: %.9f %.9f %.9f\n" % (points_moving_barycenter[0], points_moving_barycenter[1], points_moving_barycenter[2]))
-                    text_file.close()
+                iz_curved.append(nz_nonz-1)
+                #print iz_curved, len(iz_curved)
+                n_iz_curved = len(iz_curved)
+                #print n_iz_curved
 
-            else:
-                # Create volumes containing curved and straight landmarks
-                data_curved_landmarks = data * 0
-                data_straight_landmarks = data * 0
-
-                # Loop across cross index
-                for index in range(0, len(landmark_curved)):
-                    x, y, z = int(round(landmark_curved[index].x)), \
-                              int(round(landmark_curved[index].y)), \
-                              int(round(landmark_curved[index].z))
-
-                    # attribute landmark_value to the voxel and its neighbours
-                    data_curved_landmarks[x + padding - 1:x + padding + 2, y + padding - 1:y + padding + 2,
-                    z + padding - 1:z + padding + 2] = landmark_curved[index].value
-
-                    # get x, y and z coordinates of straight landmark (rounded to closest integer)
-                    x, y, z = int(round(landmark_straight[index].x)), \
-                              int(round(landmark_straight[index].y)), \
-                              int(round(landmark_straight[index].z))
-
-                    # attribute landmark_value to the voxel and its neighbours
-                    data_straight_landmarks[x + padding - 1:x + padding + 2, y + padding - 1:y + padding + 2,
-                    z + padding - 1:z + padding + 2] = landmark_straight[index].value
-
-                # Write NIFTI volumes
-                sct.printv('\nWrite NIFTI volumes...', verbose)
-                hdr.set_data_dtype('uint32')  # set imagetype to uint8 #TODO: maybe use int32
-                img = Nifti1Image(data_curved_landmarks, None, hdr)
-                save(img, 'tmp.landmarks_curved.nii.gz')
-                sct.printv('.. File created: tmp.landmarks_curved.nii.gz', verbose)
-                img = Nifti1Image(data_straight_landmarks, None, hdr)
-                save(img, 'tmp.landmarks_straight.nii.gz')
-                sct.printv('.. File created: tmp.landmarks_straight.nii.gz', verbose)
-
-                # Estimate deformation field by pairing landmarks
+                landmark_curved = self.get_landmarks_curved(iz_curved, x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv)
+
+                # Get coordinates of landmarks along straight centerline
+                #==========================================================================================
+                sct.printv('\nGet coordinates of landmarks along straight centerline...', verbose)
+                # calculate the z indices corresponding to the Euclidean distance between two consecutive points on the curved centerline (approximation curve --> line)
+                # TODO: DO NOT APPROXIMATE CURVE --> LINE
+                if nb_landmark == 1:
+                    iz_straight = [0 for i in range(0, nb_landmark+1)]
+                else:
+                    iz_straight = [0 for i in range(0, nb_landmark)]
+
+                # print iz_straight,len(iz_straight)
+                iz_straight[0] = iz_curved[0]
+                for index in range(1, n_iz_curved, 1):
+                    # compute vector between two consecutive points on the curved centerline
+                    vector_centerline = [x_centerline_fit[iz_curved[index]] - x_centerline_fit[iz_curved[index-1]], \
+                                         y_centerline_fit[iz_curved[index]] - y_centerline_fit[iz_curved[index-1]], \
+                                         z_centerline[iz_curved[index]] - z_centerline[iz_curved[index-1]] ]
+                    # compute norm of this vector
+                    norm_vector_centerline = linalg.norm(vector_centerline, ord=2)
+                    # round to closest integer value
+                    norm_vector_centerline_rounded = int(round(norm_vector_centerline, 0))
+                    # assign this value to the current z-coordinate on the straight centerline
+                    iz_straight[index] = iz_straight[index-1] + norm_vector_centerline_rounded
+
+                # initialize x0 and y0 to be at the center of the FOV
+                x0 = int(round(nx/2))
+                y0 = int(round(ny/2))
+                landmark_straight = self.get_landmarks_straight(iz_curved, iz_straight, x0, y0)
+
+                # Create NIFTI volumes with landmarks
                 #==========================================================================================
-                # convert landmarks to INT
-                sct.printv('\nConvert landmarks to INT...', verbose)
-                sct.run('isct_c3d tmp.landmarks_straight.nii.gz -type int -o tmp.landmarks_straight.nii.gz', verbose)
-                sct.run('isct_c3d tmp.landmarks_curved.nii.gz -type int -o tmp.landmarks_curved.nii.gz', verbose)
-
-                # This stands to avoid overlapping between landmarks
-                # TODO: do symmetric removal
-                sct.printv('\nMake sure all labels between landmark_straight and landmark_curved match 1...', verbose)
-                label_process_straight = ProcessLabels(fname_label="tmp.landmarks_straight.nii.gz",
-                                              fname_output=["tmp.landmarks_straight.nii.gz", "tmp.landmarks_curved.nii.gz"],
-                                              fname_ref="tmp.landmarks_curved.nii.gz", verbose=verbose)
-                label_process_straight.process('remove-symm')
-
-                # Estimate rigid transformation
-                sct.printv('\nEstimate rigid transformation between paired landmarks...', verbose)
-                sct.run('isct_ANTSUseLandmarkImagesToGetAffineTransform tmp.landmarks_straight.nii.gz tmp.landmarks_curved.nii.gz rigid tmp.curve2straight_rigid.txt', verbose)
-
-                # Apply rigid transformation
-                sct.printv('\nApply rigid transformation to curved landmarks...', verbose)
-                #sct.run('sct_apply_transfo -i tmp.landmarks_curved.nii.gz -o tmp.landmarks_curved_rigid.nii.gz -d tmp.landmarks_straight.nii.gz -w tmp.curve2straight_rigid.txt -x nn', verbose)
-                Transform(input_filename="tmp.landmarks_curved.nii.gz", source_reg="tmp.landmarks_curved_rigid.nii.gz", output_filename="tmp.landmarks_straight.nii.gz", warp="tmp.curve2straight_rigid.txt", interp="nn", verbose=verbose).apply()
-
-            if verbose == 2:
-                from mpl_toolkits.mplot3d import Axes3D
-                import matplotlib.pyplot as plt
-
-                fig = plt.figure()
-                ax = Axes3D(fig)
-                ax.plot(x_centerline_fit, y_centerline_fit, z_centerline, zdir='z')
-                ax.plot([coord.x for coord in landmark_curved],
-                        [coord.y for coord in landmark_curved],
-                        [coord.z for coord in landmark_curved], '.')
-                ax.plot([coord.x for coord in landmark_straight],
-                        [coord.y for coord in landmark_straight],
-                        [coord.z for coord in landmark_straight], 'r.')
+                # Pad input volume to deal with the fact that some landmarks on the curved centerline might be outside the FOV
+                # N.B. IT IS VERY IMPORTANT TO PAD ALSO ALONG X and Y, OTHERWISE SOME LANDMARKS MIGHT GET OUT OF THE FOV!!!
+                #sct.run('fslview ' + fname_centerline_orient)
+                sct.set_stage('landmark images')
+                sct.printv('\nPad input volume to account for landmarks that fall outside the FOV...', verbose)
+                sct.run('isct_c3d '+fname_centerline_orient+' -pad '+str(padding)+'x'+str(padding)+'x'+str(padding)+'vox '+str(padding)+'x'+str(padding)+'x'+str(padding)+'vox 0 -o tmp.centerline_pad.nii.gz', verbose)
+
+                # Open padded centerline for reading
+                sct.printv('\nOpen padded centerline for reading...', verbose)
+                file = load('tmp.centerline_pad.nii.gz')
+                data = file.get_data()
+                hdr = file.get_header()
+                landmark_curved_rigid = zeros((0, 4))
+
                 if self.algo_landmark_rigid is not None and self.algo_landmark_rigid != 'None':
-                    ax.plot([coord.x for coord in landmark_curved_rigid],
-                            [coord.y for coord in landmark_curved_rigid],
-                            [coord.z for coord in landmark_curved_rigid], 'b.')
-                ax.set_xlabel('x')
-                ax.set_ylabel('y')
-                ax.set_zlabel('z')
-                plt.show()
-
-            if (self.use_continuous_labels == 1 and self.algo_landmark_rigid is not None and self.algo_landmark_rigid != "None") or self.use_continuous_labels=='1':
-                landmark_curved_rigid, landmark_straight = ProcessLabels.remove_label_coord(landmark_curved_rigid, landmark_straight, symmetry=True)
-
-                # Writting landmark curve in text file
-                landmark_straight_file = open("LandmarksRealStraight.txt", "w+")
-                for i in landmark_straight:
-                    landmark_straight_file.write(
-                        str(i.x + padding) + "," + str(i.y + padding) + "," + str(i.z + padding) + "\n")
-                landmark_straight_file.close()
-
-                # Writting landmark curve in text file
-                landmark_curved_file = open("LandmarksRealCurve.txt", "w+")
-                for i in landmark_curved_rigid:
-                    landmark_curved_file.write(
-                        str(i.x + padding) + "," + str(i.y + padding) + "," + str(i.z + padding) + "\n")
-                landmark_curved_file.close()
-
-                # Estimate b-spline transformation curve --> straight
-                sct.printv('\nEstimate b-spline transformation: curve --> straight...', verbose)
-                sct.run('isct_ANTSUseLandmarkImagesWithTextFileToGetBSplineDisplacementField tmp.landmarks_straight.nii.gz tmp.landmarks_curved_rigid.nii.gz tmp.warp_curve2straight.nii.gz '+self.bspline_meshsize+' '+self.bspline_numberOfLevels+' LandmarksRealCurve.txt LandmarksRealStraight.txt '+self.bspline_order+' 0', verbose)
-            else:
-                # This stands to avoid overlapping between landmarks
-                sct.printv('\nMake sure all labels between landmark_straight and landmark_curved match 2...', verbose)
-                label_process = ProcessLabels(fname_label="tmp.landmarks_curved_rigid.nii.gz",
-                                              fname_output=["tmp.landmarks_curved_rigid.nii.gz", "tmp.landmarks_straight.nii.gz"],
-                                              fname_ref="tmp.landmarks_straight.nii.gz", verbose=verbose)
-                label_process.process('remove-symm')
-
-                # Estimate b-spline transformation curve --> straight
-                sct.printv('\nEstimate b-spline transformation: curve --> straight...', verbose)
-                sct.run('isct_ANTSUseLandmarkImagesToGetBSplineDisplacementField tmp.landmarks_straight.nii.gz tmp.landmarks_curved_rigid.nii.gz tmp.warp_curve2straight.nii.gz '+self.bspline_meshsize+' '+self.bspline_numberOfLevels+' '+self.bspline_order+' 0', verbose)
-
-            # remove padding for straight labels
-            if crop == 1:
-                ImageCropper(input_file="tmp.landmarks_straight.nii.gz", output_file="tmp.landmarks_straight_crop.nii.gz", dim="0,1,2", bmax=True, verbose=verbose).crop()
-                pass
-            else:
-                sct.run('cp tmp.landmarks_straight.nii.gz tmp.landmarks_straight_crop.nii.gz', verbose)
+                    # converting landmarks straight and curved to physical coordinates
+                    from msct_image import Image
+                    image_curved = Image(fname_centerline_orient)
+                    points_fixed = image_curved.transfo_pix2phys(landmark_straight[:, 0:3].tolist())
+                    points_moving = image_curved.transfo_pix2phys(landmark_curved[:, 0:3].tolist())
+
+                    points_moving_barycenter = [0.0, 0.0, 0.0]
+                    # Register curved landmarks on straight landmarks based on python implementation
+                    sct.printv('\nComputing rigid transformation (algo='+self.algo_landmark_rigid+') ...', verbose)
+                    import msct_register_landmarks
+                    (rotation_matrix, translation_array, points_moving_reg, points_moving_barycenter) = msct_register_landmarks.getRigidTransformFromLandmarks(
+                        points_fixed, points_moving, constraints=self.algo_landmark_rigid, show=False)
+
+                    # reorganize registered points
+                    landmark_curved_rigid = landmark_curved.copy()
+                    landmark_curved_rigid[:, 0:3] = image_curved.transfo_phys2continuouspix([point[0:3] for point in points_moving_reg])
+
+                    # Create volumes containing curved and straight landmarks
+                    data_curved_landmarks = data * 0
+                    data_curved_rigid_landmarks = data * 0
+                    data_straight_landmarks = data * 0
+                    self.paint_landmarks(data_curved_landmarks, landmark_curved, padding)
+                    self.paint_landmarks(data_curved_rigid_landmarks, landmark_curved_rigid, padding)
+                    self.paint_landmarks(data_straight_landmarks, landmark_straight, padding)
+
+                    # Write NIFTI volumes
+                    sct.printv('\nWrite NIFTI volumes...', verbose)
+                    hdr.set_data_dtype('uint32')  # set imagetype to uint8 #TODO: maybe use int32
+                    img = Nifti1Image(data_curved_landmarks, None, hdr)
+                    save(img, 'tmp.landmarks_curved.nii.gz')
+                    sct.printv('.. File created: tmp.landmarks_curved.nii.gz', verbose)
+                    hdr.set_data_dtype('uint32')  # set imagetype to uint8 #TODO: maybe use int32
+                    img = Nifti1Image(data_curved_rigid_landmarks, None, hdr)
+                    save(img, 'tmp.landmarks_curved_rigid.nii.gz')
+                    sct.printv('.. File created: tmp.landmarks_curved_rigid.nii.gz', verbose)
+                    img = Nifti1Image(data_straight_landmarks, None, hdr)
+                    save(img, 'tmp.landmarks_straight.nii.gz')
+                    sct.printv('.. File created: tmp.landmarks_straight.nii.gz', verbose)
+
+                    if self.algo_landmark_rigid == 'rigid-decomposed':
+                        # writing rigid transformation file
+                        text_file = open("tmp.curve2straight_rigid1.txt", "w")
+                        text_file.write("#Insight Transform File V1.0\n")
+                        text_file.write("#Transform 0\n")
+                        text_file.write("Transform: AffineTransform_double_3_3\n")
+                        text_file.write("Parameters: 1.0 0.0 0.0 0.0 1.0 0.0 0.0 0.0 1.0 %.9f %.9f %.9f\n" % (
+                            translation_array[0, 0], translation_array[0, 1], translation_array[0, 2]))
+                        text_file.write("FixedParameters: 0 0 0\n")
+                        text_file.close()
+
+                        text_file = open("tmp.curve2straight_rigid2.txt", "w")
+                        text_file.write("#Insight Transform File V1.0\n")
+                        text_file.write("#Transform 0\n")
+                        text_file.write("Transform: AffineTransform_double_3_3\n")
+                        text_file.write("Parameters: %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f 0.0 0.0 0.0\n" % (
+                            rotation_matrix[0, 0], rotation_matrix[0, 1], rotation_matrix[0, 2], rotation_matrix[1, 0],
+                            rotation_matrix[1, 1], rotation_matrix[1, 2], rotation_matrix[2, 0], rotation_matrix[2, 1],
+                            rotation_matrix[2, 2]))
+                        text_file.write("FixedParameters: %.9f %.9f %.9f\n" % (
+                            points_moving_barycenter[0,0], points_moving_barycenter[0,1], points_moving_barycenter[0,2]))
+                        text_file.close()
+                    else:
+                        # writing rigid transformation file
+                        text_file = open("tmp.curve2straight_rigid.txt", "w")
+                        text_file.write("#Insight Transform File V1.0\n")
+                        text_file.write("#Transform 0\n")
+                        text_file.write("Transform: AffineTransform_double_3_3\n")
+                        text_file.write("Parameters: %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f %.9f\n" % (
+                            rotation_matrix[0, 0], rotation_matrix[0, 1], rotation_matrix[0, 2], rotation_matrix[1, 0],
+                            rotation_matrix[1, 1], rotation_matrix[1, 2], rotation_matrix[2, 0], rotation_matrix[2, 1],
+                            rotation_matrix[2, 2], translation_array[0, 0], translation_array[0, 1],
+                            translation_array[0, 2]))
+                        text_file.write("FixedParameters: %.9f %.9f %.9f\n" % (points_moving_barycenter[0], points_moving_barycenter[1], points_moving_barycenter[2]))
+                        text_file.close()
 
-            # Concatenate rigid and non-linear transformations...
-            sct.printv('\nConcatenate rigid and non-linear transformations...', verbose)
-            #sct.run('isct_ComposeMultiTransform 3 tmp.warp_rigid.nii -R tmp.landmarks_straight.nii tmp.warp.nii tmp.curve2straight_rigid.txt')
-            # !!! DO NOT USE sct.run HERE BECAUSE isct_ComposeMultiTransform OUTPUTS A NON-NULL STATUS !!!
-            if self.algo_landmark_rigid == 'rigid-decomposed':
-                # cmd = 'isct_ComposeMultiTransform 3 tmp.curve2straight_translation.nii.gz -R tmp.landmarks_straight_crop.nii.gz tmp.empty_warping_field.nii.gz tmp.curve2straight_rigid1.txt '
-                # sct.run(cmd, self.verbose)
+                else:
+                    # Create volumes containing curved and straight landmarks
+                    data_curved_landmarks = data * 0
+                    data_straight_landmarks = data * 0
+
+                    self.paint_landmarks(data_curved_landmarks, landmark_curved, padding)
+                    self.paint_landmarks(data_straight_landmarks, landmark_straight, padding)
+
+                    # Write NIFTI volumes
+                    sct.printv('\nWrite NIFTI volumes...', verbose)
+                    hdr.set_data_dtype('uint32')  # set imagetype to uint8 #TODO: maybe use int32
+                    img = Nifti1Image(data_curved_landmarks, None, hdr)
+                    save(img, 'tmp.landmarks_curved.nii.gz')
+                    sct.printv('.. File created: tmp.landmarks_curved.nii.gz', verbose)
+                    img = Nifti1Image(data_straight_landmarks, None, hdr)
+                    save(img, 'tmp.landmarks_straight.nii.gz')
+                    sct.printv('.. File created: tmp.landmarks_straight.nii.gz', verbose)
+
+                    # Estimate deformation field by pairing landmarks
+                    #==========================================================================================
+                    # convert landmarks to INT
+                    sct.printv('\nConvert landmarks to INT...', verbose)
+                    sct.run('isct_c3d tmp.landmarks_straight.nii.gz -type int -o tmp.landmarks_straight.nii.gz', verbose)
+                    sct.run('isct_c3d tmp.landmarks_curved.nii.gz -type int -o tmp.landmarks_curved.nii.gz', verbose)
+
+                    # This stands to avoid overlapping between landmarks
+                    # TODO: do symmetric removal
+                    sct.printv('\nMake sure all labels between landmark_straight and landmark_curved match 1...', verbose)
+                    label_process_straight = ProcessLabels(fname_label="tmp.landmarks_straight.nii.gz",
+                                                  fname_output=["tmp.landmarks_straight.nii.gz", "tmp.landmarks_curved.nii.gz"],
+                                                  fname_ref="tmp.landmarks_curved.nii.gz", verbose=verbose)
+                    label_process_straight.process('remove-symm')
+
+                    # Estimate rigid transformation
+                    sct.printv('\nEstimate rigid transformation between paired landmarks...', verbose)
+                    sct.run('isct_ANTSUseLandmarkImagesToGetAffineTransform tmp.landmarks_straight.nii.gz tmp.landmarks_curved.nii.gz rigid tmp.curve2straight_rigid.txt', verbose)
+
+                    # Apply rigid transformation
+                    sct.printv('\nApply rigid transformation to curved landmarks...', verbose)
+                    #sct.run('sct_apply_transfo -i tmp.landmarks_curved.nii.gz -o tmp.landmarks_curved_rigid.nii.gz -d tmp.landmarks_straight.nii.gz -w tmp.curve2straight_rigid.txt -x nn', verbose)
+                    Transform(input_filename="tmp.landmarks_curved.nii.gz", source_reg="tmp.landmarks_curved_rigid.nii.gz", output_filename="tmp.landmarks_straight.nii.gz", warp="tmp.curve2straight_rigid.txt", interp="nn", verbose=verbose).apply()
+
+                if verbose == 2:
+                    from mpl_toolkits.mplot3d import Axes3D
+                    import matplotlib.pyplot as plt
+
+                    fig = plt.figure()
+                    ax = Axes3D(fig)
+                    ax.plot(x_centerline_fit, y_centerline_fit, z_centerline, zdir='z')
+                    ax.plot(landmark_curved[:, 0], landmark_curved[:, 1], landmark_curved[:, 2], '.')
+                    ax.plot(landmark_straight[:, 0], landmark_straight[:, 1], landmark_straight[:, 2], 'r.')
+                    if self.algo_landmark_rigid is not None and self.algo_landmark_rigid != 'None':
+                        ax.plot(landmark_curved_rigid[:, 0], landmark_curved_rigid[:, 1], landmark_curved_rigid[:, 2], 'b.')
+                    ax.set_xlabel('x')
+                    ax.set_ylabel('y')
+                    ax.set_zlabel('z')
+                    plt.show()
+
+                if (self.use_continuous_labels == 1 and self.algo_landmark_rigid is not None and self.algo_landmark_rigid != "None") or self.use_continuous_labels=='1':
+                    # keep landmarks whose value exists in both sets
+                    values = intersect1d(landmark_curved_rigid[:, 3], landmark_straight[:, 3])
+                    landmark_curved_rigid = landmark_curved_rigid[in1d(landmark_curved_rigid[:, 3], values)]
+                    landmark_straight = landmark_straight[in1d(landmark_straight[:, 3], values)]
+
+                    # Writting landmark curve in text file
+                    savetxt("LandmarksRealStraight.txt", landmark_straight[:, 0:3] + padding, fmt='%s', delimiter=',')
+                    savetxt("LandmarksRealCurve.txt", landmark_curved_rigid[:, 0:3] + padding, fmt='%s', delimiter=',')
+
+                    # Estimate b-spline transformation curve --> straight
+                    sct.printv('\nEstimate b-spline transformation: curve --> straight...', verbose)
+                    sct.run('isct_ANTSUseLandmarkImagesWithTextFileToGetBSplineDisplacementField tmp.landmarks_straight.nii.gz tmp.landmarks_curved_rigid.nii.gz tmp.warp_curve2straight.nii.gz '+self.bspline_meshsize+' '+self.bspline_numberOfLevels+' LandmarksRealCurve.txt LandmarksRealStraight.txt '+self.bspline_order+' 0', verbose)
+                else:
+                    # This stands to avoid overlapping between landmarks
+                    sct.printv('\nMake sure all labels between landmark_straight and landmark_curved match 2...', verbose)
+                    label_process = ProcessLabels(fname_label="tmp.landmarks_curved_rigid.nii.gz",
+                                                  fname_output=["tmp.landmarks_curved_rigid.nii.gz", "tmp.landmarks_straight.nii.gz"],
+                                                  fname_ref="tmp.landmarks_straight.nii.gz", verbose=verbose)
+                    label_process.process('remove-symm')
+
+                    # Estimate b-spline transformation curve --> straight
+                    sct.printv('\nEstimate b-spline transformation: curve --> straight...', verbose)
+                    sct.run('isct_ANTSUseLandmarkImagesToGetBSplineDisplacementField tmp.landmarks_straight.nii.gz tmp.landmarks_curved_rigid.nii.gz tmp.warp_curve2straight.nii.gz '+self.bspline_meshsize+' '+self.bspline_numberOfLevels+' '+self.bspline_order+' 0', verbose)
+
+                # remove padding for straight labels
+                if crop == 1:
+                    ImageCropper(input_file="tmp.landmarks_straight.nii.gz", output_file="tmp.landmarks_straight_crop.nii.gz", dim="0,1,2", bmax=True, verbose=verbose).crop()
+                    pass
+                else:
+                    sct.run('cp tmp.landmarks_straight.nii.gz tmp.landmarks_straight_crop.nii.gz', verbose)
 
-                cmd = 'isct_ComposeMultiTransform 3 tmp.curve2straight.nii.gz -R tmp.landmarks_straight_crop.nii.gz tmp.curve2straight_rigid1.txt tmp.curve2straight_rigid2.txt tmp.warp_curve2straight.nii.gz'
-                sct.run(cmd, self.verbose)
-            else:
-                cmd = 'isct_ComposeMultiTransform 3 tmp.curve2straight.nii.gz -R tmp.landmarks_straight_crop.nii.gz tmp.warp_curve2straight.nii.gz tmp.curve2straight_rigid.txt'
-                sct.run(cmd, self.verbose)
+                # Concatenate rigid and non-linear transformations...
+                sct.set_stage('warping fields')
+                sct.printv('\nConcatenate rigid and non-linear transformations...', verbose)
+                #sct.run('isct_ComposeMultiTransform 3 tmp.warp_rigid.nii -R tmp.landmarks_straight.nii tmp.warp.nii tmp.curve2straight_rigid.txt')
+                # !!! DO NOT USE sct.run HERE BECAUSE isct_ComposeMultiTransform OUTPUTS A NON-NULL STATUS !!!
+                if self.algo_landmark_rigid == 'rigid-decomposed':
+                    # cmd = 'isct_ComposeMultiTransform 3 tmp.curve2straight_translation.nii.gz -R tmp.landmarks_straight_crop.nii.gz tmp.empty_warping_field.nii.gz tmp.curve2straight_rigid1.txt '
+                    # sct.run(cmd, self.verbose)
 
-            # Estimate b-spline transformation straight --> curve
-            # TODO: invert warping field instead of estimating a new one
-            sct.printv('\nEstimate b-spline transformation: straight --> curve...', verbose)
-            if (self.use_continuous_labels==1 and self.algo_landmark_rigid is not None and self.algo_landmark_rigid != "None") or self.use_continuous_labels=='1':
-                sct.run('isct_ANTSUseLandmarkImagesWithTextFileToGetBSplineDisplacementField tmp.landmarks_curved_rigid.nii.gz tmp.landmarks_straight.nii.gz tmp.warp_straight2curve.nii.gz '+self.bspline_meshsize+' '+self.bspline_numberOfLevels+' LandmarksRealStraight.txt LandmarksRealCurve.txt '+self.bspline_order+' 0', verbose)
-            else:
-                sct.run('isct_ANTSUseLandmarkImagesToGetBSplineDisplacementField tmp.landmarks_curved_rigid.nii.gz tmp.landmarks_straight.nii.gz tmp.warp_straight2curve.nii.gz '+self.bspline_meshsize+' '+self.bspline_numberOfLevels+' '+self.bspline_order+' 0', verbose)
+                    cmd = 'isct_ComposeMultiTransform 3 tmp.curve2straight.nii.gz -R tmp.landmarks_straight_crop.nii.gz tmp.curve2straight_rigid1.txt tmp.curve2straight_rigid2.txt tmp.warp_curve2straight.nii.gz'
+                    sct.run(cmd, self.verbose)
+                else:
+                    cmd = 'isct_ComposeMultiTransform 3 tmp.curve2straight.nii.gz -R tmp.landmarks_straight_crop.nii.gz tmp.warp_curve2straight.nii.gz tmp.curve2straight_rigid.txt'
+                    sct.run(cmd, self.verbose)
+
+                # Estimate b-spline transformation straight --> curve
+                # TODO: invert warping field instead of estimating a new one
+                sct.printv('\nEstimate b-spline transformation: straight --> curve...', verbose)
+                if (self.use_continuous_labels==1 and self.algo_landmark_rigid is not None and self.algo_landmark_rigid != "None") or self.use_continuous_labels=='1':
+                    sct.run('isct_ANTSUseLandmarkImagesWithTextFileToGetBSplineDisplacementField tmp.landmarks_curved_rigid.nii.gz tmp.landmarks_straight.nii.gz tmp.warp_straight2curve.nii.gz '+self.bspline_meshsize+' '+self.bspline_numberOfLevels+' LandmarksRealStraight.txt LandmarksRealCurve.txt '+self.bspline_order+' 0', verbose)
+                else:
+                    sct.run('isct_ANTSUseLandmarkImagesToGetBSplineDisplacementField tmp.landmarks_curved_rigid.nii.gz tmp.landmarks_straight.nii.gz tmp.warp_straight2curve.nii.gz '+self.bspline_meshsize+' '+self.bspline_numberOfLevels+' '+self.bspline_order+' 0', verbose)
 
 
-            # Concatenate rigid and non-linear transformations...
-            sct.printv('\nConcatenate rigid and non-linear transformations...', verbose)
-            print 'TEST: ', self.algo_landmark_rigid
-            if self.algo_landmark_rigid == 'rigid-decomposed':
-                cmd = 'isct_ComposeMultiTransform 3 tmp.straight2curve.nii.gz -R ' + file_anat + ext_anat + ' -i tmp.curve2straight_rigid1.txt tmp.warp_straight2curve.nii.gz'  # old
-            else:
-                cmd = 'isct_ComposeMultiTransform 3 tmp.straight2curve.nii.gz -R ' + file_anat + ext_anat + ' -i tmp.curve2straight_rigid.txt tmp.warp_straight2curve.nii.gz' # old
-            #cmd = 'isct_ComposeMultiTransform 3 tmp.straight2curve.nii.gz -R ' + file_anat + ext_anat + ' tmp.warp_straight2curve.nii.gz -i tmp.curve2straight_rigid.txt' # new
-            #sct.printv(cmd, verbose, 'code')
-            #commands.getstatusoutput(cmd)
-            sct.run(cmd, self.verbose)
+                # Concatenate rigid and non-linear transformations...
+                sct.printv('\nConcatenate rigid and non-linear transformations...', verbose)
+                print 'TEST: ', self.algo_landmark_rigid
+                if self.algo_landmark_rigid == 'rigid-decomposed':
+                    cmd = 'isct_ComposeMultiTransform 3 tmp.straight2curve.nii.gz -R ' + file_anat + ext_anat + ' -i tmp.curve2straight_rigid1.txt tmp.warp_straight2curve.nii.gz'  # old
+                else:
+                    cmd = 'isct_ComposeMultiTransform 3 tmp.straight2curve.nii.gz -R ' + file_anat + ext_anat + ' -i tmp.curve2straight_rigid.txt tmp.warp_straight2curve.nii.gz' # old
+                #cmd = 'isct_ComposeMultiTransform 3 tmp.straight2curve.nii.gz -R ' + file_anat + ext_anat + ' tmp.warp_straight2curve.nii.gz -i tmp.curve2straight_rigid.txt' # new
+                #sct.printv(cmd, verbose, 'code')
+                #commands.getstatusoutput(cmd)
+                sct.run(cmd, self.verbose)
 
             # Apply transformation to input image
+            sct.set_stage('apply transformations')
             sct.printv('\nApply transformation to input image...', verbose)
-            Transform(input_filename=str(file_anat+ext_anat), source_reg="tmp.anat_rigid_warp.nii.gz", output_filename="tmp.landmarks_straight_crop.nii.gz", interp=interpolation_warp, warp="tmp.curve2straight.nii.gz", verbose=verbose).apply()
+            Transform(input_filename=str(file_anat+ext_anat), source_reg="tmp.anat_rigid_warp.nii.gz", output_filename=fname_straight_ref, interp=interpolation_warp, warp="tmp.curve2straight.nii.gz", verbose=verbose).apply()
 
             # compute the error between the straightened centerline/segmentation and the central vertical line.
             # Ideally, the error should be zero.
             # Apply deformation to input image
             sct.printv('\nApply transformation to centerline image...', verbose)
             # sct.run('sct_apply_transfo -i '+fname_centerline_orient+' -o tmp.centerline_straight.nii.gz -d tmp.landmarks_straight_crop.nii.gz -x nn -w tmp.curve2straight.nii.gz')
-            Transform(input_filename=fname_centerline_orient, source_reg="tmp.centerline_straight.nii.gz", output_filename="tmp.landmarks_straight_crop.nii.gz", interp="nn", warp="tmp.curve2straight.nii.gz", verbose=verbose).apply()
+            Transform(input_filename=fname_centerline_orient, source_reg="tmp.centerline_straight.nii.gz", output_filename=fname_straight_ref, interp="nn", warp="tmp.curve2straight.nii.gz", verbose=verbose).apply()
             #c = sct.run('sct_crop_image -i tmp.centerline_straight.nii.gz -o tmp.centerline_straight_crop.nii.gz -dim 2 -bzmax')
             from msct_image import Image
             file_centerline_straight = Image('tmp.centerline_straight.nii.gz', verbose=verbose)
@@ -760,6 +636,7 @@ class SpinalCordStraightener(object):
 
         # Generate output file (in current folder)
         # TODO: do not uncompress the warping field, it is too time consuming!
+        sct.set_stage('output')
         sct.printv('\nGenerate output file (in current folder)...', verbose)
         sct.generate_output_file(path_tmp+'/tmp.curve2straight.nii.gz', 'warp_curve2straight.nii.gz', verbose)  # warping field
         sct.generate_output_file(path_tmp+'/tmp.straight2curve.nii.gz', 'warp_straight2curve.nii.gz', verbose)  # warping field
@@ -844,14 +721,15 @@ if __name__ == "__main__":
 
     parser.add_option(name="-params",
                       type_value=[[','], 'str'],
-                      description="""Parameters for spinal cord straightening. Separate arguments with ",".\nuse_continuous_labels : 0,1. Default = False\nalgo_fitting: {hanning,nurbs} algorithm for curve fitting. Default=hanning\nbspline_meshsize: <int>x<int>x<int> size of mesh for B-Spline registration. Default=5x5x10\nbspline_numberOfLevels: <int> number of levels for BSpline interpolation. Default=3\nbspline_order: <int> Order of BSpline for interpolation. Default=2\nalgo_landmark_rigid {rigid,xy,translation,translation-xy,rotation,rotation-xy} constraints on landmark-based rigid pre-registration""",
+                      description="""Parameters for spinal cord straightening. Separate arguments with ",".\nuse_continuous_labels : 0,1. Default = False\nalgo_fitting: {hanning,nurbs} algorithm for curve fitting. Default=hanning\nbspline_meshsize: <int>x<int>x<int> size of mesh for B-Spline registration. Default=5x5x10\nbspline_numberOfLevels: <int> number of levels for BSpline interpolation. Default=3\nbspline_order: <int> Order of BSpline for interpolation. Default=2\nalgo_landmark_rigid {rigid,xy,translation,translation-xy,rotation,rotation-xy} constraints on landmark-based rigid pre-registration\nalgo_warp {landmarks,centerline}: landmarks: warping fields are estimated by ANTs from landmarks, centerline: warping fields are computed directly from the centerline (faster). Default=landmarks""",
                       mandatory=False,
                       example="algo_fitting=nurbs,bspline_meshsize=5x5x12,algo_landmark_rigid=xy")
 
     parser.add_option(name="-cpu-nb",
                       type_value="int",
-                      description="Number of CPU used for straightening. 0: no multiprocessing. If not provided, it uses all the available cores.",
+                      description="Number of CPU used for straightening. Landmarks are now computed without multiprocessing: this option has no effect.",
                       mandatory=False,
+                      deprecated=True,
                       example="8")
 
     arguments = parser.parse(sys.argv[1:])
@@ -877,8 +755,6 @@ if __name__ == "__main__":
         sc_straight.crop = int(arguments["-f"])
     if "-v" in arguments:
         sc_straight.verbose = int(arguments["-v"])
-    if "-cpu-nb" in arguments:
-        sc_straight.cpu_number = int(arguments["-cpu-nb"])
 
     if "-params" in arguments:
         params_user = arguments['-params']
@@ -899,6 +775,8 @@ if __name__ == "__main__":
                 sc_straight.all_labels = int(param_split[1])
             elif param_split[0] == 'use_continuous_labels':
                 sc_straight.use_continuous_labels = int(param_split[1])
+            elif param_split[0] == 'algo_warp':
+                sc_straight.algo_warp = param_split[1]
             elif param_split[0] == 'gapz':
                 sc_straight.gapz = int(param_split[1])
 
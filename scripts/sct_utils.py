@@ -67,10 +67,36 @@ def run(cmd, verbose=1):
     # print sys._getframe().f_back.f_code.co_name
     if verbose:
         print(bcolors.blue+cmd+bcolors.normal)
+    # if profiling is enabled (SCT_PROFILE), record time and resources used by the command
+    profiler = get_profiler()
+    if profiler is not None:
+        import time
+        caller = sys._getframe(1)
+        caller = os.path.basename(caller.f_code.co_filename)+':'+caller.f_code.co_name+':'+str(caller.f_lineno)
+        time_start = time.time()
+    # if the cache is enabled (SCT_CACHE), restore outputs of the command if it was already run on the same inputs
+    cache, cache_entry = get_run_cache(cmd), None
+    if cache is not None:
+        try:
+            restored, cache_entry = cache.lookup(cmd)
+            if restored:
+                printv('  Outputs restored from cache ('+cache_entry.key+')', verbose)
+                if profiler is not None:
+                    profiler.add_command(cmd, caller, time_start, time.time()-time_start, 'cached')
+                return 0, cache_entry.output
+        except Exception, e:
+            printv('WARNING: cache lookup failed ('+str(e)+'). Running command.', verbose, 'warning')
+            cache_entry = None
     process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     output_final = ''
     while True:
         output = process.stdout.readline()
+        if output == '' and profiler is not None:
+            # end of output: wait for the process to get its resource usage
+            pid, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            profiler.add_command(cmd, caller, time_start, time.time()-time_start, process.returncode, rusage)
+            break
         if output == '' and process.poll() is not None:
             break
         if output:
@@ -84,30 +110,37 @@ def run(cmd, verbose=1):
         # printv('\nERROR in '+stack()[1][1]+'\n', 1, 'error')  # print name of parent function
         # sys.exit()
     else:
+        if cache_entry is not None:
+            try:
+                cache.store(cache_entry, output_final[0:-1])
+            except Exception, e:
+                printv('WARNING: could not store outputs in cache ('+str(e)+').', verbose, 'warning')
         # no need to output process.returncode (because different from 0)
         return process.returncode, output_final[0:-1]
 
 
-
 #=======================================================================================================================
 # check RAM usage
 # work only on Mac OSX
 #=======================================================================================================================
+# return total RAM in MB
 def checkRAM(os,verbose=1):
     if (os == 'linux'):
         status, output = run('grep MemTotal /proc/meminfo', 0)
-        print output
+        if verbose:
+            print output
         ram_split = output.split()
-        ram_total = float(ram_split[1])
-        status, output = run('free -m', 0)
-        print output
+        ram_total = float(ram_split[1])  # in kB
+        if verbose:
+            status, output = run('free -m', 0)
+            print output
         return ram_total/1024
 
     elif (os == 'osx'):
         status, output = run('hostinfo | grep memory', 0)
         print output
         ram_split = output.split(' ')
-        ram_total = float(ram_split[3])
+        ram_total = float(ram_split[3]) * 1024  # hostinfo gives GB
 
         # Get process info
         ps = subprocess.Popen(['ps', '-caxm', '-orss,comm'], stdout=subprocess.PIPE).communicate()[0]
@@ -282,34 +315,29 @@ def find_file_within_folder(fname, directory):
     return all_path
 
 
+#=======================================================================================================================
+# find_nifti_file
+#=======================================================================================================================
+def find_nifti_file(fname):
+    """Return the file name of a nifti image, adding its extension if needed (like FSL tools do), or '' if not found."""
+    for ext in ['', '.nii', '.nii.gz', '.hdr', '.hdr.gz']:
+        if os.path.isfile(fname+ext):
+            return fname+ext
+    return ''
+
+
 #=======================================================================================================================
 # get_dimension
 #=======================================================================================================================
-# Get dimensions of a nifti file using FSL
+# Get dimensions of a nifti file by reading its header with nibabel (voxel data are not loaded).
 def get_dimension(fname):
-    # apply fslsize on data
-    cmd = 'fslsize '+fname
-    status, output = commands.getstatusoutput(cmd)
-    # split output according to \n field
-    output_split = output.split()
-
-    if output_split[0] == 'ERROR:':
-        printv('\n'+output, 1, 'error')
-    else:
-        # extract dimensions as integer
-        try:
-            nx = int(output_split[1])
-            ny = int(output_split[3])
-            nz = int(output_split[5])
-            nt = int(output_split[7])
-            px = float(output_split[9])
-            py = float(output_split[11])
-            pz = float(output_split[13])
-            pt = float(output_split[15])
-            return nx, ny, nz, nt, px, py, pz, pt
-        except Exception, e:
-            print "Output of the command: \n", output_split
-            raise Exception
+    fname_header = find_nifti_file(fname)
+    if fname_header == '':
+        printv('\nERROR: '+fname+' is not a valid NIfTI file. Exit program.\n', 1, 'error')
+    try:
+        return read_nifti_dimension(fname_header)
+    except Exception, e:
+        printv('\nERROR: could not read header of '+fname+'\n'+str(e), 1, 'error')
 
 
 #=======================================================================================================================
@@ -387,6 +415,148 @@ def printv(string, verbose=1, type='normal'):
         sys.exit(2)
 
 
+#=======================================================================================================================
+# read_nifti_dimension
+#=======================================================================================================================
+# Results are kept in a small LRU cache keyed on (path, mtime, size), so that repeated calls on the same file are free.
+_header_cache = None
+_header_cache_size = 64
+
+
+def read_nifti_dimension(fname):
+    """Read (nx, ny, nz, nt, px, py, pz, pt) from the header of fname, without loading the voxel data."""
+    global _header_cache
+    from collections import OrderedDict
+    if _header_cache is None:
+        _header_cache = OrderedDict()
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_mtime, stat.st_size)
+    if key in _header_cache:
+        # move entry at the end (most recently used)
+        dim = _header_cache.pop(key)
+        _header_cache[key] = dim
+        return dim
+
+    from nibabel import load
+    hdr = load(fname).get_header()
+    shape = list(hdr.get_data_shape()) + [1, 1, 1, 1]
+    pixdim = hdr['pixdim']
+    dim = (int(shape[0]), int(shape[1]), int(shape[2]), int(shape[3]),
+           float(pixdim[1]), float(pixdim[2]), float(pixdim[3]), float(pixdim[4]))
+
+    _header_cache[key] = dim
+    if len(_header_cache) > _header_cache_size:
+        _header_cache.popitem(last=False)
+    return dim
+
+
+#=======================================================================================================================
+# run_many: run independent commands concurrently
+#=======================================================================================================================
+def run_many(list_cmd, verbose=1, nb_workers=None, ram_per_job=None, error_exit=True):
+    """
+    Run independent UNIX commands concurrently, with at most nb_workers commands running at the same time.
+    The output of each command is printed in one block when it finishes (outputs are never interleaved).
+    On KeyboardInterrupt, all running commands are killed and the exception is raised again.
+    :param list_cmd: list of commands. Each item is either a command or a tuple (command, working folder).
+    :param nb_workers: number of concurrent commands. Default: see get_nb_workers.
+    :param ram_per_job: memory needed by each command (in GB). If set, nb_workers is limited by the total RAM.
+    :param error_exit: if True, exit program (as run() does) if one of the commands failed.
+    :return: list of (status, output), in the same order as list_cmd
+    """
+    import threading
+    import signal
+    import time
+
+    jobs = [cmd if isinstance(cmd, tuple) else (cmd, None) for cmd in list_cmd]
+    if nb_workers is None:
+        nb_workers = get_nb_workers(ram_per_job)
+    nb_workers = max(1, min(int(nb_workers), len(jobs)))
+    profiler = get_profiler()
+    caller = sys._getframe(1)
+    caller = os.path.basename(caller.f_code.co_filename)+':'+caller.f_code.co_name+':'+str(caller.f_lineno)
+    env = dict(os.environ)
+    if nb_workers > 1:
+        # scripts run concurrently must not store outputs in the cache of run() (see msct_cache)
+        env['SCT_RUN_CONCURRENT'] = '1'
+        # commands already run concurrently: scripts they start must not use all cores themselves
+        env['SCT_NB_WORKERS'] = '1'
+        # ... nor ITK tools (e.g. ANTs) their own thread pool of all cores
+        env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = '1'
+
+    results = [None] * len(jobs)
+    processes = dict()  # running processes
+    lock = threading.Lock()
+    stop = threading.Event()
+    index_next = [0]
+
+    def worker():
+        while not stop.is_set():
+            with lock:
+                i = index_next[0]
+                if i >= len(jobs):
+                    return
+                index_next[0] += 1
+            cmd, cwd = jobs[i]
+            time_start = time.time()
+            rusage = None
+            try:
+                # each command is started in its own process group, so that it can be killed with its children
+                process = subprocess.Popen(cmd, shell=True, cwd=cwd, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+                with lock:
+                    processes[i] = process
+                output = process.stdout.read()
+                pid, status, rusage = os.wait4(process.pid, 0)
+                status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            except Exception, e:
+                status, output = 1, str(e)
+            with lock:
+                processes.pop(i, None)
+                results[i] = (status, output.strip())
+                if verbose:
+                    print(bcolors.blue+'['+str(i+1)+'/'+str(len(jobs))+'] '+cmd+bcolors.normal)
+                    if verbose == 2 or status != 0:
+                        print results[i][1]
+                if profiler is not None:
+                    profiler.add_command(cmd, caller, time_start, time.time()-time_start, status, rusage)
+
+    threads = [threading.Thread(target=worker) for i in range(nb_workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        # join with timeout, otherwise KeyboardInterrupt is not received while waiting
+        while [thread for thread in threads if thread.is_alive()]:
+            for thread in threads:
+                thread.join(0.1)
+    except KeyboardInterrupt:
+        stop.set()
+        with lock:
+            for process in processes.values():
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        printv('\nWARNING: Caught KeyboardInterrupt, running commands were terminated.', 1, 'warning')
+        raise
+
+    if error_exit:
+        for i, (status, output) in enumerate(results):
+            if status != 0:
+                printv('ERROR\n'+jobs[i][0]+'\n'+output, 1, 'error')
+    return results
+
+
+#=======================================================================================================================
+# set_stage: start a named stage of a script (the previous stage ends). Only used for profiling (see msct_profiler).
+#=======================================================================================================================
+def set_stage(name):
+    profiler = get_profiler()
+    if profiler is not None:
+        profiler.set_stage(name)
+
+
 #=======================================================================================================================
 # sign
 #=======================================================================================================================
@@ -427,6 +597,27 @@ def delete_nifti(fname_in):
         os.system('rm '+path_in+file_in+'.nii.gz')
 
 
+#=======================================================================================================================
+# get_env_path: path given by an environment variable, resolved once
+#=======================================================================================================================
+def get_env_path(name):
+    """
+    Return the value of an environment variable that is a path ('' if not set). A relative path is made absolute the
+    first time (scripts change folder, e.g. to tmp.*) and written back into the environment, so that child scripts
+    inherit the same path.
+    """
+    path = os.environ.get(name, '')
+    if path != '' and not os.path.isabs(path):
+        path = os.path.abspath(path)
+        os.environ[name] = path
+    return path
+
+
+# resolve paths before scripts change folder
+get_env_path('SCT_CACHE')
+get_env_path('SCT_PROFILE')
+
+
 #=======================================================================================================================
 # get_interpolation: get correct interpolation field depending on program used. Supported programs: ants, flirt, WarpImageMultiTransform
 #=======================================================================================================================
@@ -456,6 +647,84 @@ def get_interpolation(program, interp):
     # return
     return interp_program
 
+
+#=======================================================================================================================
+# get_nb_workers: number of commands that can run concurrently
+#=======================================================================================================================
+def get_nb_workers(ram_per_job=None):
+    """
+    Number of cores, or value of the environment variable SCT_NB_WORKERS if set. If ram_per_job (in GB) is given, the
+    number of workers is also limited by the total RAM (see checkRAM).
+    """
+    from multiprocessing import cpu_count
+    nb_workers = int(os.environ.get('SCT_NB_WORKERS', cpu_count()))
+    if ram_per_job:
+        try:
+            ram_total = checkRAM(Os().os, 0) / 1024  # in GB
+            nb_workers = min(nb_workers, int(ram_total / ram_per_job))
+        except Exception:
+            pass
+    return max(1, nb_workers)
+
+
+#=======================================================================================================================
+# get_profiler: return the profiler if enabled with the environment variable SCT_PROFILE (see msct_profiler)
+#=======================================================================================================================
+_profiler = None
+
+
+def get_profiler():
+    global _profiler
+    fname_profile = get_env_path('SCT_PROFILE')
+    if fname_profile == '':
+        return None
+    if _profiler is None or _profiler.fname != fname_profile:
+        import atexit
+        from msct_profiler import Profiler
+        _profiler = Profiler(fname_profile)
+        # close the last stage when the script ends
+        atexit.register(_profiler.set_stage, None)
+    return _profiler
+
+
+#=======================================================================================================================
+# get_run_cache: return the cache of run() if enabled with the environment variable SCT_CACHE (see msct_cache)
+#=======================================================================================================================
+_run_cache = None
+
+
+def get_run_cache(cmd=None):
+    global _run_cache
+    path_cache = get_env_path('SCT_CACHE')
+    if path_cache == '':
+        return None
+    if _run_cache is None or _run_cache.path_cache != path_cache:
+        from msct_cache import RunCache
+        _run_cache = RunCache(path_cache)
+    if cmd is not None and not _run_cache.is_cacheable(cmd):
+        return None
+    return _run_cache
+
+
+#=======================================================================================================================
+# write_atomic: write a file through a temporary file, so that concurrent scripts never read an incomplete file
+#=======================================================================================================================
+def write_atomic(fname, write_file):
+    """
+    Write fname with write_file(fname_tmp), where fname_tmp is a temporary file of the same folder and with the same
+    extension, then rename it to fname (the folder is created if needed).
+    """
+    path_fname, file_fname, ext_fname = extract_fname(fname)
+    if path_fname and not os.path.isdir(path_fname):
+        os.makedirs(path_fname)
+    fname_tmp = path_fname+file_fname+'.tmp'+str(os.getpid())+ext_fname
+    try:
+        write_file(fname_tmp)
+        os.rename(fname_tmp, fname)
+    finally:
+        if os.path.isfile(fname_tmp):
+            os.remove(fname_tmp)
+
 class UnsupportedOs(Exception):
     def __init__(self, value):
         self.value = value
@@ -21,7 +21,9 @@ import time
 
 from msct_parser import Parser
 import sct_utils as sct
-from sct_extract_metric import read_label_file
+from msct_atlas import read_label_file
+from msct_warp import WarpingChain, is_supported
+from sct_apply_transfo import get_ram_per_job
 
 
 
@@ -114,20 +116,26 @@ class WarpTemplate:
             sct.run('rm -rf '+self.folder_out)
         sct.run('mkdir '+self.folder_out)
 
+        # the warping field is composed once into a sampling grid shared by all labels (see msct_warp). Otherwise,
+        # labels are warped with sct_apply_transfo.
+        warping_chain = None
+        if is_supported([self.fname_transfo]):
+            warping_chain = WarpingChain([self.fname_transfo], self.fname_src, self.verbose)
+
         # Warp template objects
         if self.warp_template == 1:
             sct.printv('\nWarp template objects...', self.verbose)
-            warp_label(self.path_template, self.folder_template, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+            warp_label(self.path_template, self.folder_template, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out, warping_chain)
 
         # Warp atlas
         if self.warp_atlas == 1:
             sct.printv('\nWarp atlas of white matter tracts...', self.verbose)
-            warp_label(self.path_template, self.folder_atlas, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+            warp_label(self.path_template, self.folder_atlas, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out, warping_chain)
 
         # Warp spinal levels
         if self.warp_spinal_levels == 1:
             sct.printv('\nWarp spinal levels...', self.verbose)
-            warp_label(self.path_template, self.folder_spinal_levels, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+            warp_label(self.path_template, self.folder_spinal_levels, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out, warping_chain)
 
         # to view results
         sct.printv('\nDone! To view results, type:', self.verbose)
@@ -137,19 +145,26 @@ class WarpTemplate:
 
 # Warp labels
 # ==========================================================================================
-def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, path_out):
+def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, path_out, warping_chain=None):
     # read label file and check if file exists
     sct.printv('\nRead label file...', param.verbose)
     template_label_ids, template_label_names, template_label_file = read_label_file(path_label+folder_label, file_label)
     # create output folder
     sct.run('mkdir '+path_out+folder_label, param.verbose)
     # Warp label
-    for i in xrange(0, len(template_label_file)):
-        fname_label = path_label+folder_label+template_label_file[i]
-        # check if file exists
-        # sct.check_file_exist(fname_label)
-        # apply transfo
-        sct.run('sct_apply_transfo -i '+fname_label+' -o '+path_out+folder_label+template_label_file[i] +' -d '+fname_src+' -w '+fname_transfo+' -x '+get_interp(template_label_file[i]), param.verbose)
+    if warping_chain is not None:
+        # all labels are resampled through the same sampling grid, and written concurrently
+        warping_chain.apply_many([path_label+folder_label+f for f in template_label_file],
+                                 [path_out+folder_label+f for f in template_label_file],
+                                 [get_interp(f) for f in template_label_file])
+    else:
+        # labels are independent: run them concurrently
+        list_cmd = []
+        for i in xrange(0, len(template_label_file)):
+            fname_label = path_label+folder_label+template_label_file[i]
+            # apply transfo
+            list_cmd.append('sct_apply_transfo -i '+fname_label+' -o '+path_out+folder_label+template_label_file[i] +' -d '+fname_src+' -w '+fname_transfo+' -x '+get_interp(template_label_file[i]))
+        sct.run_many(list_cmd, param.verbose, ram_per_job=get_ram_per_job(fname_src, [fname_transfo]))
     # Copy list.txt
     sct.run('cp '+path_label+folder_label+param.file_info_label+' '+path_out+folder_label, 0)
 
@@ -13,6 +13,8 @@
 
 #import sct_utils as sct
 import commands
+import numpy
+import nibabel
 
 
 def test(data_path):
@@ -28,7 +30,35 @@ def test(data_path):
 
     # return
     #return sct.run(cmd, 0)
-    return commands.getstatusoutput(cmd)
+    status, output = commands.getstatusoutput(cmd)
+
+    # same command with the native engine (transformations composed once, resampling in-process)
+    s, o = commands.getstatusoutput(cmd + ' -e native -o template_native.nii.gz')
+    status += s
+    output += o
+
+    # 4D data (native engine): two volumes, the second being twice the first. Each output volume must match the 3D
+    # output
+    image = nibabel.load(data_path + folder_data[0] + file_data[0])
+    data = numpy.asarray(image.get_data(), dtype=numpy.float32)[:, :, :, numpy.newaxis]
+    nibabel.save(nibabel.Nifti1Image(numpy.concatenate((data, 2 * data), axis=3), image.get_affine()), 'template_4d.nii.gz')
+    cmd_4d = 'sct_apply_transfo -i template_4d.nii.gz' \
+             + ' -d ' + data_path + folder_data[1] + file_data[1] \
+             + ' -w ' + data_path + folder_data[1] + file_data[2] \
+             + ' -e native -o template_4d_native.nii.gz'
+    s, o = commands.getstatusoutput(cmd_4d)
+    status += s
+    output += o
+    if s == 0 and status == 0:
+        data_3d = nibabel.load('template_native.nii.gz').get_data()
+        data_4d = nibabel.load('template_4d_native.nii.gz').get_data()
+        tolerance = 1e-3 * numpy.abs(data_3d).max()
+        if data_4d.shape[3] != 2 or numpy.abs(data_4d[..., 0] - data_3d).max() > tolerance \
+                or numpy.abs(data_4d[..., 1] - 2 * data_3d).max() > 2 * tolerance:
+            status += 1
+            output += '\nERROR: volumes of the 4D output do not match the 3D output.'
+
+    return status, output
 
 
 if __name__ == "__main__":
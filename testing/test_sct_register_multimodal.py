@@ -15,12 +15,14 @@
 
 #import sct_utils as sct
 import commands
+import numpy
+import nibabel
 
 
 def test(path_data):
 
     folder_data = 'mt/'
-    file_data = ['mt0.nii.gz', 'mt1.nii.gz']
+    file_data = ['mt0.nii.gz', 'mt1.nii.gz', 'mt1_seg.nii.gz']
 
     cmd = 'sct_register_multimodal -i ' + path_data + folder_data + file_data[0] \
           + ' -d ' + path_data + folder_data + file_data[1] \
@@ -31,7 +33,46 @@ def test(path_data):
           + ' -v 1'
 
     #return sct.run(cmd, 0)
-    return commands.getstatusoutput(cmd)
+    status, output = commands.getstatusoutput(cmd)
+
+    # slice-wise registration of segmentations, with translations estimated by phase correlation: the segmentation of
+    # mt1 is registered to a copy shifted by a known translation, and the result must overlap the shifted copy
+    shift = (2, -3)  # in voxels, along x and y
+    image_seg = nibabel.load(path_data + folder_data + file_data[2])
+    data_seg = image_seg.get_data()
+    data_seg_shifted = numpy.roll(numpy.roll(data_seg, shift[0], axis=0), shift[1], axis=1)
+    nibabel.save(nibabel.Nifti1Image(data_seg_shifted, image_seg.get_affine(), image_seg.get_header()), 'mt1_seg_shifted.nii.gz')
+
+    cmd = 'sct_register_multimodal -i ' + path_data + folder_data + file_data[2] \
+          + ' -d mt1_seg_shifted.nii.gz' \
+          + ' -iseg ' + path_data + folder_data + file_data[2] \
+          + ' -dseg mt1_seg_shifted.nii.gz' \
+          + ' -o data_reg_fft.nii.gz'  \
+          + ' -p step=1,type=seg,algo=slicereg2d_fft'  \
+          + ' -x linear' \
+          + ' -r 0' \
+          + ' -v 1'
+
+    s, o = commands.getstatusoutput(cmd)
+    status += s
+    output += o
+
+    # check the translation: center of mass of the registered segmentation vs. shifted segmentation
+    if s == 0:
+        center_reg = center_of_mass(nibabel.load('data_reg_fft.nii.gz').get_data())
+        center_shifted = center_of_mass(data_seg_shifted)
+        if numpy.abs(center_reg - center_shifted).max() > 0.5:
+            status += 1
+            output += '\nERROR: wrong translation (center of mass: '+str(center_reg)+' instead of '+str(center_shifted)+')'
+
+    return status, output
+
+
+def center_of_mass(data):
+    """Center of mass (in voxels) of a 3D image."""
+    data = numpy.asarray(data, dtype=float)
+    grid = numpy.indices(data.shape)
+    return numpy.array([(grid[i] * data).sum() / data.sum() for i in range(3)])
 
 
 if __name__ == "__main__":